@@ -0,0 +1,182 @@
+# Places buffers in the global buffer instead of hand-picking
+# BANK_ADDR()s. Knows which banks each IO controller can reach, so it
+# also hands back the switch mask to program with configure_io.
+#
+#   gb = GlobalBufferAllocator(width=32)
+#   im = gb.allocate("input", im.nbytes, io_ctrl=0)
+#   out = gb.allocate("output", gold.nbytes, io_ctrl=1)
+#   configure_io(IO_INPUT_STREAM, im.addr, len(im), io_ctrl=im.io_ctrl, mask=im.mask)
+#
+# A stream striped across several IO controllers gets one sub-buffer
+# per controller, see commands.stripe():
+#
+#   parts = gb.allocate_striped("input", im.nbytes, io_ctrls=[0, 2])
+#   configure_striped_io(IO_INPUT_STREAM, [p.addr for p in parts], len(im),
+#                        [p.io_ctrl for p in parts], [p.mask for p in parts])
+#
+# Or ask for a commands.Layout, which configure_io, WRITE_DATA and
+# READ_DATA take in place of an address. Interleaved layouts put every
+# other tile in its own bank, so that loading the next tile doesn't
+# fight the IO controller over the bank it is streaming from:
+#
+#   im = gb.allocate_layout("input", tile.nbytes, "interleaved", io_ctrls=[0])
+#   WRITE_DATA.from_layout(im, tile, chunk=k)
+#   configure_io(IO_INPUT_STREAM, im, len(tile), chunk=k)
+#
+# Buffers can be given a lifetime [start, end) in whatever steps the
+# schedule uses (tiles, frames, ...). Buffers whose lifetimes don't
+# overlap can share space.
+
+from collections import namedtuple
+from commands import GB_BANKS, GB_BANK_SIZE, Layout, gb_banks, switch_mask
+
+
+class AllocationError(Exception):
+    pass
+
+
+class Buffer(namedtuple("Buffer", ["name", "addr", "nbytes", "io_ctrl", "mask", "start", "end"])):
+    @property
+    def banks(self):
+        return gb_banks(self.addr, self.nbytes)
+
+    def live_with(self, start, end):
+        return self.start < end and start < self.end
+
+
+class GlobalBufferAllocator:
+    def __init__(self, width=32, align=8):
+        # 1 IO controller per 4 tile width, each owns an equal share of
+        # the banks.
+        self.width = width
+        self.num_controllers = width // 4
+        self.banks_per_controller = GB_BANKS // self.num_controllers
+        self.align = align
+        self.buffers = []
+
+    def region(self, io_ctrl):
+        """Range of addresses a buffer streamed by `io_ctrl` may use."""
+        if io_ctrl is None:
+            return 0, GB_BANKS * GB_BANK_SIZE
+        if not 0 <= io_ctrl < self.num_controllers:
+            raise AllocationError(f"There is no IO controller {io_ctrl} with {self.num_controllers} controllers.")
+        first = io_ctrl * self.banks_per_controller
+        return first * GB_BANK_SIZE, (first + self.banks_per_controller) * GB_BANK_SIZE
+
+    def switch_mask(self, io_ctrl, addr, nbytes):
+        if io_ctrl is None:
+            return None
+        return switch_mask(io_ctrl, addr, nbytes, self.width)
+
+    def allocate(self, name, nbytes, io_ctrl=None, start=0, end=float("inf"), prefer=None, avoid_banks=()):
+        """Places `nbytes` for `name` where `io_ctrl` can stream it,
+        live from step `start` up to (not including) `end`, and outside
+        of `avoid_banks`.
+
+        Takes `prefer` if it is free. Otherwise prefers spots in banks
+        that are already in use, then ones that don't straddle a bank
+        boundary, then the lowest address.
+        """
+        lo, hi = self.region(io_ctrl)
+        size = -(-nbytes // self.align) * self.align
+        if size > hi - lo:
+            raise AllocationError(
+                f"`{name}` needs {nbytes} bytes but IO controller {io_ctrl} can only reach {hi - lo}."
+            )
+
+        live = sorted(
+            (b for b in self.buffers if b.live_with(start, end) and b.addr < hi and lo < b.addr + b.nbytes),
+            key=lambda b: b.addr,
+        )
+        used_banks = {bank for b in self.buffers for bank in b.banks}
+
+        def fits(addr):
+            if set(gb_banks(addr, size)) & set(avoid_banks):
+                return False
+            return addr + size <= hi and all(
+                addr + size <= b.addr or b.addr + b.nbytes <= addr for b in live
+            )
+
+        def cost(addr):
+            banks = range(addr // GB_BANK_SIZE, (addr + size - 1) // GB_BANK_SIZE + 1)
+            return (len(set(banks) - used_banks), len(banks), addr)
+
+        # The free spots start either at the bottom of the region, the
+        # end of a live buffer, or the start of a bank.
+        candidates = {lo} | {
+            -(-(b.addr + b.nbytes) // self.align) * self.align for b in live
+        } | set(range(lo, hi, GB_BANK_SIZE))
+        if prefer is not None:
+            candidates.add(prefer)
+        candidates = [addr for addr in candidates if lo <= addr and fits(addr)]
+        if not candidates:
+            raise AllocationError(
+                f"No room for `{name}` ({nbytes} bytes) in the banks of IO controller {io_ctrl} "
+                f"during [{start}, {end})."
+            )
+
+        addr = prefer if prefer in candidates else min(candidates, key=cost)
+        buffer = Buffer(name, addr, size, io_ctrl, self.switch_mask(io_ctrl, addr, size), start, end)
+        self.buffers.append(buffer)
+        return buffer
+
+    def allocate_striped(self, name, nbytes, io_ctrls, start=0, end=float("inf")):
+        """Places a stream of `nbytes` striped across `io_ctrls` (see
+        commands.stripe()), one sub-buffer per controller. Sub-buffers
+        go at the same offset into each controller's banks where they
+        can, so the layouts match."""
+        # WRITE_DATA and READ_DATA move whole 64-bit words, so each
+        # sub-buffer has to be a multiple of them
+        if len(io_ctrls) > 1 and nbytes % (8 * len(io_ctrls)):
+            raise AllocationError(
+                f"`{name}` ({nbytes} bytes) can't be striped into 64-bit words across {len(io_ctrls)} IO controllers."
+            )
+        buffers = []
+        for j, io_ctrl in enumerate(io_ctrls):
+            prefer = None
+            if buffers:
+                offset = buffers[0].addr - self.region(io_ctrls[0])[0]
+                prefer = self.region(io_ctrl)[0] + offset
+            buffers.append(self.allocate(f"{name}[{j}]", nbytes // len(io_ctrls), io_ctrl, start, end, prefer=prefer))
+        return buffers
+
+    def allocate_layout(self, name, nbytes, kind="contiguous", io_ctrls=(0,), num_banks=2, start=0, end=float("inf")):
+        """Places `name` with one of the commands.GB_LAYOUTS and returns
+        its Layout. `nbytes` is the whole stream when striped, and one
+        chunk of it when interleaved across `num_banks` banks."""
+        if kind == "contiguous":
+            buf = self.allocate(name, nbytes, io_ctrls[0], start, end)
+            return Layout.contiguous(buf.addr, nbytes, buf.io_ctrl, buf.mask, self.width)
+
+        if kind == "striped":
+            bufs = self.allocate_striped(name, nbytes, io_ctrls, start, end)
+            return Layout.striped(
+                [buf.addr for buf in bufs], nbytes // len(bufs),
+                [buf.io_ctrl for buf in bufs], [buf.mask for buf in bufs],
+            )
+
+        if kind == "interleaved":
+            # Same offset into consecutive banks where possible, but
+            # never in a bank an earlier chunk already uses
+            bufs = []
+            try:
+                for j in range(num_banks):
+                    prefer = bufs[0].addr + j * GB_BANK_SIZE if bufs else None
+                    used = [bank for buf in bufs for bank in buf.banks]
+                    bufs.append(self.allocate(f"{name}[{j}]", nbytes, io_ctrls[0], start, end, prefer=prefer, avoid_banks=used))
+                return Layout.interleaved([buf.addr for buf in bufs], nbytes, io_ctrls[0], self.width)
+            except (AllocationError, ValueError) as e:
+                self.buffers = [buf for buf in self.buffers if buf not in bufs]
+                raise AllocationError(f"Can't interleave `{name}` ({nbytes} bytes) across {num_banks} banks: {e}")
+
+        raise AllocationError(f"Unknown layout `{kind}` for `{name}`.")
+
+    def banks_used(self):
+        return sorted({bank for b in self.buffers for bank in b.banks})
+
+    def report(self):
+        lines = [f"{len(self.buffers)} buffers in {len(self.banks_used())} banks"]
+        for b in sorted(self.buffers, key=lambda b: b.addr):
+            io = f"io {b.io_ctrl} mask 0b{b.mask:04b}" if b.io_ctrl is not None else "no io"
+            lines.append(f"    0x{b.addr:06x} {b.nbytes:>8} bytes  {io}  [{b.start}, {b.end})  {b.name}")
+        return "\n".join(lines)
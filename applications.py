@@ -1,13 +1,56 @@
+import json
+import os
 import numpy as np
+from allocator import GlobalBufferAllocator
 from commands import *
 
+
+def read_stripes(map_file):
+    """IO controllers each stream of an app's map.json runs on: its
+    "stripe" list if it has one, otherwise just its "location"."""
+    with open(map_file) as f:
+        mapping = json.load(f)
+    return {
+        stream['name']: [int(location) for location in stream.get('stripe', [stream['location']])]
+        for stream in mapping['inputs'] + mapping['outputs']
+    }
+
+
+def back_to_back(apps):
+    """Runs `apps` one after another without resetting the CGRA in
+    between, so each only loads the config words that differ from the
+    app before it."""
+    for before, app in zip(apps, apps[1:]):
+        app.previous = before.bitstream
+    return CommandBuffer([app.commands() for app in apps])
+
+
 class OneShotValid():
-    def __init__(self, bitstream, infile, goldfile, outfile, args):
+    def __init__(self, bitstream, infile, goldfile, outfile, args, stripes=None, previous=None):
         self.bitstream = bitstream
         self.infile = infile
         self.goldfile = goldfile
         self.outfile = outfile
         self.args = args
+        # Bitstream of the app that ran right before this one without a
+        # reset in between, see back_to_back()
+        self.previous = previous
+        # Streams can be striped across several IO controllers, see
+        # read_stripes()
+        self.stripes = {"input": [0], "output": [1], **(stripes or {})}
+
+    def outfiles(self):
+        # Same names READ_DATA.from_layout() gives striped outputs
+        if len(self.stripes["output"]) == 1:
+            return [self.outfile]
+        return [f"{self.outfile}.{j}" for j in range(len(self.stripes["output"]))]
+
+    def allocate(self, im, gold):
+        gb = GlobalBufferAllocator(width=self.args.width)
+        return [
+            gb.allocate_layout(name, data.nbytes, "striped" if len(self.stripes[name]) > 1 else "contiguous", self.stripes[name])
+            for name, data in [("input", im), ("output", gold)]
+        ]
 
     def commands(self):
         im = np.fromfile(
@@ -20,8 +63,10 @@ class OneShotValid():
             dtype=np.uint8
         ).astype(np.uint16)
 
-        return [
-            WRITE_REG(GLOBAL_RESET_REG, 1),
+        im_layout, out_layout = self.allocate(im, gold)
+
+        return CommandBuffer([
+            reset_commands(self.previous, width=self.args.width),
             # Stall the CGRA
             WRITE_REG(STALL_REG, 0b1111),
 
@@ -30,22 +75,22 @@ class OneShotValid():
 
             # Configure the CGRA
             PRINT("Configuring CGRA..."),
-            *gc_config_bitstream(self.bitstream),
+            gc_config_bitstream(self.bitstream, previous=self.previous),
             # *gb_config_bitstream(self.bitstream, width=self.args.width),
             PRINT("Done."),
 
             # Set up global buffer for pointwise
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(0), len(im), width=self.args.width),
+            configure_io(IO_INPUT_STREAM, im_layout, len(im)),
             # TODO: would be better if this took in the input and
             # output tiles of the application and then configured the
             # io controllers appropriately.
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16), len(gold), io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_layout, len(gold)),
             # *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16), len(gold), width=self.args.width),
             # *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(4), len(gold), width=self.args.width),
 
             # Put image into global buffer
             PRINT("Transferring input data..."),
-            WRITE_DATA(BANK_ADDR(0), 0xc0ffee, im.nbytes, im),
+            WRITE_DATA.from_layout(im_layout, im),
             PRINT("Done."),
 
             # Start the application
@@ -58,14 +103,9 @@ class OneShotValid():
             PRINT("Done."),
 
             PRINT("Reading output data..."),
-            READ_DATA(
-                BANK_ADDR(16),
-                gold.nbytes,
-                gold,
-                _file=self.outfile,
-            ),
+            READ_DATA.from_layout(out_layout, gold, _file=self.outfile),
             PRINT("All tasks complete!"),
-        ]
+        ])
 
     def verify(self, result=None):
         print("Comparing outputs...")
@@ -75,10 +115,13 @@ class OneShotValid():
         )
 
         if result is None:
-            result = np.fromfile(
-                self.outfile,
-                dtype=np.uint16,
-            ).astype(np.uint8)
+            result = unstripe([
+                np.fromfile(
+                    outfile,
+                    dtype=np.uint16,
+                )
+                for outfile in self.outfiles()
+            ]).astype(np.uint8)
 
         if not np.array_equal(gold, result):
             if len(gold) != len(result):
@@ -104,8 +147,10 @@ class OneShotStall(OneShotValid):
             dtype=np.uint8
         ).astype(np.uint16)
 
-        return [
-            WRITE_REG(GLOBAL_RESET_REG, 1),
+        im_layout, out_layout = self.allocate(im, gold)
+
+        return CommandBuffer([
+            reset_commands(self.previous, width=self.args.width),
             # Stall the CGRA
             WRITE_REG(STALL_REG, 0b1111),
 
@@ -118,7 +163,7 @@ class OneShotStall(OneShotValid):
             # Configure the CGRA
             PRINT("Configuring CGRA..."),
             # *gc_config_bitstream(self.bitstream),
-            *gb_config_bitstream(self.bitstream, width=self.args.width),
+            gb_config_bitstream(self.bitstream, width=self.args.width, previous=self.previous),
             PRINT("Done."),
 
             # # TODO: Do it again to test the interrupts, but remove later.
@@ -128,17 +173,17 @@ class OneShotStall(OneShotValid):
             # PRINT("Done."),
 
             # Set up global buffer for pointwise
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(0), len(im), width=self.args.width),
+            configure_io(IO_INPUT_STREAM, im_layout, len(im)),
             # TODO: would be better if this took in the input and
             # output tiles of the application and then configured the
             # io controllers appropriately.
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16), len(gold), io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_layout, len(gold)),
             # *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16), len(gold), width=self.args.width),
             # *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(4), len(gold), width=self.args.width),
 
             # Put image into global buffer
             PRINT("Transferring input data..."),
-            WRITE_DATA(BANK_ADDR(0), 0xc0ffee, im.nbytes, im),
+            WRITE_DATA.from_layout(im_layout, im),
             PRINT("Done."),
 
             # Start the application
@@ -168,43 +213,41 @@ class OneShotStall(OneShotValid):
             PRINT("Done."),
 
             PRINT("Reading output data..."),
-            READ_DATA(
-                BANK_ADDR(16),
-                gold.nbytes,
-                gold,
-                _file=self.outfile,
-            ),
+            READ_DATA.from_layout(out_layout, gold, _file=self.outfile),
             PRINT("All tasks complete!"),
-        ]
+        ])
 
 
 class Tiled():
-    def __init__(self, bitstream, infiles, goldfiles, outfiles, args):
+    def __init__(self, bitstream, infiles, goldfiles, outfiles, args, previous=None):
         self.bitstream = bitstream
         self.infiles = infiles
         self.goldfiles = goldfiles
         self.outfiles = outfiles
         self.args = args
+        # Bitstream of the app that ran right before this one without a
+        # reset in between, see back_to_back()
+        self.previous = previous
 
-    def commands(self):
-        ims = [
-            np.fromfile(
-                infile,
-                dtype=np.uint8
-            ).astype(np.uint16)
-            for infile in self.infiles
-        ]
-
-        golds = [
-            np.fromfile(
-                goldfile,
-                dtype=np.uint8
-            ).astype(np.uint16)
-            for goldfile in self.goldfiles
-        ]
+    def load(self, filename):
+        return np.fromfile(filename, dtype=np.uint8).astype(np.uint16)
 
-        command_list = [
-            WRITE_REG(GLOBAL_RESET_REG, 1),
+    def commands(self):
+        # Holds every tile, pass iter_commands() to
+        # write_straightline_code() to stream them instead
+        return CommandBuffer(self.iter_commands())
+
+    def iter_commands(self):
+        """commands() as a generator. Each tile's input and gold are
+        only read from disk right before the commands that use them, so
+        write_straightline_code(f, app.iter_commands()) can stream any
+        number of tiles."""
+        # Sizes of the uint16 arrays load() returns
+        im_sizes = [2 * os.path.getsize(infile) for infile in self.infiles]
+        gold_sizes = [2 * os.path.getsize(goldfile) for goldfile in self.goldfiles]
+
+        yield from CommandBuffer([
+            reset_commands(self.previous, width=self.args.width),
             # Stall the CGRA
             WRITE_REG(STALL_REG, 0b1111),
 
@@ -217,7 +260,7 @@ class Tiled():
             # Configure the CGRA
             PRINT("Configuring CGRA..."),
             # *gc_config_bitstream(self.bitstream),
-            *gb_config_bitstream(self.bitstream, width=self.args.width),
+            gb_config_bitstream(self.bitstream, width=self.args.width, previous=self.previous),
             PRINT("Done."),
 
             # # TODO: Do it again to test the interrupts, but remove later.
@@ -225,55 +268,51 @@ class Tiled():
             # # *gc_config_bitstream(self.bitstream),
             # *gb_config_bitstream(self.bitstream, width=self.args.width),
             # PRINT("Done."),
-        ]
-
-        in_addrs = [ BANK_ADDR(0) + 2048 * (k % 2) for k in range(len(ims)) ]
-        out_addrs = [ BANK_ADDR(16) + 2048 * (k % 2) for k in range(len(golds)) ]
-
-        for k in range(len(ims)):
-            command_list += [
+        ])
+
+        # Tile k is loaded in iteration k while tile k-1 is still being
+        # streamed, and its output is read back in iteration k+1. Every
+        # other tile goes in the other bank so the two never share one.
+        gb = GlobalBufferAllocator(width=self.args.width)
+        in_layout = gb.allocate_layout("input", max(im_sizes), "interleaved", io_ctrls=[0])
+        out_layout = gb.allocate_layout("output", max(gold_sizes), "interleaved", io_ctrls=[1])
+
+        for k in range(len(self.infiles)):
+            im = self.load(self.infiles[k])
+            yield from CommandBuffer([
                 PRINT(f"Loading input {k}..."),
-                WRITE_DATA(in_addrs[k], 0xc0ffee, ims[k].nbytes, ims[k]),
-                *configure_io(IO_INPUT_STREAM, in_addrs[k], len(ims[k]), width=self.args.width),
-                *configure_io(IO_OUTPUT_STREAM, out_addrs[k], len(golds[k]), io_ctrl=1, width=self.args.width),
-            ]
+                WRITE_DATA.from_layout(in_layout, im, chunk=k),
+                configure_io(IO_INPUT_STREAM, in_layout, len(im), chunk=k),
+                configure_io(IO_OUTPUT_STREAM, out_layout, gold_sizes[k] // 2, chunk=k),
+            ])
+            del im
 
             if k == 0:
-                command_list += [
+                yield from [
                     WRITE_REG(CGRA_SOFT_RESET_EN_REG, 1),
                     WRITE_REG(STALL_REG, 0),
                     PEND(0b01, f"start"),
                     WRITE_REG(CGRA_START_REG, 1),
                 ]
             else:
-                command_list += [
+                gold = self.load(self.goldfiles[k-1])
+                yield from [
                     WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
                     PRINT(f"Waiting on {k-1}..."),
                     WAIT(0b01, f"start"),
                     PRINT(f"Reading output {k-1}..."),
-                    READ_DATA(
-                        out_addrs[k-1],
-                        golds[k-1].nbytes,
-                        golds[k-1],
-                        _file=self.outfiles[k],
-                    ),
+                    READ_DATA.from_layout(out_layout, gold, chunk=k-1, _file=self.outfiles[k]),
                 ]
 
-        command_list += [
-            PRINT(f"Waiting on {len(golds)-1}..."),
+        gold = self.load(self.goldfiles[-1])
+        yield from [
+            PRINT(f"Waiting on {len(gold_sizes)-1}..."),
             WAIT(0b01, f"start"),
-            PRINT(f"Reading output {len(golds)-1}..."),
-            READ_DATA(
-                out_addrs[len(golds)-1],
-                golds[len(golds)-1].nbytes,
-                golds[len(golds)-1],
-                _file=self.outfiles[k],
-            ),
+            PRINT(f"Reading output {len(gold_sizes)-1}..."),
+            READ_DATA.from_layout(out_layout, gold, chunk=len(gold_sizes)-1, _file=self.outfiles[k]),
             PRINT("All tasks complete!"),
         ]
 
-        return command_list
-
     def verify(self, results=None):
         print("Comparing outputs...")
         golds = [
@@ -307,13 +346,16 @@ class Tiled():
 
 
 class OuterProduct():
-    def __init__(self, bitstream, weightfiles, infiles, goldfile, outfile, args):
+    def __init__(self, bitstream, weightfiles, infiles, goldfile, outfile, args, previous=None):
         self.bitstream = bitstream
         self.weightfiles = weightfiles
         self.infiles = infiles
         self.goldfile = goldfile
         self.outfile = outfile
         self.args = args
+        # Bitstream of the app that ran right before this one without a
+        # reset in between, see back_to_back()
+        self.previous = previous
 
     def commands(self):
         wts = [
@@ -337,8 +379,8 @@ class OuterProduct():
             dtype=np.uint8
         ).astype(np.uint16)
 
-        command_list = [
-            WRITE_REG(GLOBAL_RESET_REG, 1),
+        command_list = CommandBuffer([
+            reset_commands(self.previous, width=self.args.width),
             # Stall the CGRA
             WRITE_REG(STALL_REG, 0b1111),
 
@@ -348,12 +390,17 @@ class OuterProduct():
             # Configure the CGRA
             PRINT("Configuring CGRA..."),
             # *gc_config_bitstream(self.bitstream),
-            *gb_config_bitstream(self.bitstream, width=self.args.width),
+            gb_config_bitstream(self.bitstream, width=self.args.width, previous=self.previous),
             PRINT("Done."),
-        ]
+        ])
+
+        gb = GlobalBufferAllocator(width=self.args.width)
+        ims_buf = gb.allocate("images", sum(im.nbytes for im in ims), io_ctrl=0)
+        wts_buf = gb.allocate("weights", sum(wt.nbytes for wt in wts), io_ctrl=1)
+        out_buf = gb.allocate("output", gold.nbytes, io_ctrl=2)
 
         # Load images to consecutive memory in global buffer
-        im_addr = BANK_ADDR(0)
+        im_addr = ims_buf.addr
         im_len = 0
         for im in ims:
             command_list += [
@@ -363,7 +410,7 @@ class OuterProduct():
             im_len += len(im)
 
         # Load weights to consecutive memory in global buffer
-        wt_addr = BANK_ADDR(4)
+        wt_addr = wts_buf.addr
         wt_len = 0
         for wt in wts:
             command_list += [
@@ -384,9 +431,9 @@ class OuterProduct():
             # TODO: not sure if the offsets are 8-bit or 16-bit?
 
             # image row 0, weight row 0
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(0), 16, io_ctrl=0, width=self.args.width),
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4), 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16), 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, ims_buf.addr, 16, io_ctrl=0, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr, 1, io_ctrl=2, width=self.args.width),
 
             PRINT("Starting application..."),
             WRITE_REG(STALL_REG, 0),
@@ -395,95 +442,95 @@ class OuterProduct():
             WRITE_REG(CGRA_START_REG, 1),
 
             # weight row 1
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 32, 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 2, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr + 32, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 2, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
             # weight row 2 (needs compute to be done with row 0 first)
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 64, 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 4, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr + 64, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 4, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
             # weight row 3 (needs compute to be done with row 1 first)
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 96, 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 6, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr + 96, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 6, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
             # image row 1, weight row 0
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(0) + 32, 16, io_ctrl=0, width=self.args.width),
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4), 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 8, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, ims_buf.addr + 32, 16, io_ctrl=0, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 8, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
             # weight row 1
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 32, 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 10, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr + 32, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 10, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
             # weight row 2 (needs compute to be done with row 0 first)
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 64, 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 12, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr + 64, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 12, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
             # weight row 3 (needs compute to be done with row 1 first)
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 96, 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 14, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr + 96, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 14, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
             # image row 2, weight row 0
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(0) + 64, 16, io_ctrl=0, width=self.args.width),
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4), 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 16, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, ims_buf.addr + 64, 16, io_ctrl=0, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 16, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
             # weight row 1
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 32, 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 18, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr + 32, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 18, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
             # weight row 2 (needs compute to be done with row 0 first)
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 64, 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 20, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr + 64, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 20, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
             # weight row 3 (needs compute to be done with row 1 first)
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 96, 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 22, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr + 96, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 22, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
             # image row 3, weight row 0
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(0) + 96, 16, io_ctrl=0, width=self.args.width),
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4), 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 24, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, ims_buf.addr + 96, 16, io_ctrl=0, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 24, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
             # weight row 1
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 32, 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 26, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr + 32, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 26, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
             # weight row 2 (needs compute to be done with row 0 first)
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 64, 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 28, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr + 64, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 28, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
             # weight row 3 (needs compute to be done with row 1 first)
-            *configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 96, 16, io_ctrl=1, width=self.args.width),
-            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(16) + 30, 1, io_ctrl=2, width=self.args.width),
+            configure_io(IO_INPUT_STREAM, wts_buf.addr + 96, 16, io_ctrl=1, width=self.args.width),
+            configure_io(IO_OUTPUT_STREAM, out_buf.addr + 30, 1, io_ctrl=2, width=self.args.width),
             WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
             WAIT(0b01, "start"),
 
@@ -539,7 +586,7 @@ class OuterProduct():
             WAIT(0b01, "start"),
             PRINT("Reading output data..."),
             READ_DATA(
-                BANK_ADDR(16),
+                out_buf.addr,
                 gold.nbytes,
                 gold,
                 _file=self.outfile,
@@ -574,13 +621,16 @@ class OuterProduct():
         return True
 
 class Conv3x3ReLU():
-    def __init__(self, bitstream, weightfiles, infiles, goldfile, outfile, args):
+    def __init__(self, bitstream, weightfiles, infiles, goldfile, outfile, args, previous=None):
         self.bitstream = bitstream
         self.weightfiles = weightfiles
         self.infiles = infiles
         self.goldfile = goldfile
         self.outfile = outfile
         self.args = args
+        # Bitstream of the app that ran right before this one without a
+        # reset in between, see back_to_back()
+        self.previous = previous
 
     def commands(self):
         wts = [
@@ -604,8 +654,8 @@ class Conv3x3ReLU():
             dtype=np.uint8
         ).astype(np.uint16)
 
-        command_list = [
-            WRITE_REG(GLOBAL_RESET_REG, 1),
+        command_list = CommandBuffer([
+            reset_commands(self.previous, width=self.args.width),
             # Stall the CGRA
             WRITE_REG(STALL_REG, 0b1111),
 
@@ -615,12 +665,17 @@ class Conv3x3ReLU():
             # Configure the CGRA
             PRINT("Configuring CGRA..."),
             # *gc_config_bitstream(self.bitstream),
-            *gb_config_bitstream(self.bitstream, width=self.args.width),
+            gb_config_bitstream(self.bitstream, width=self.args.width, previous=self.previous),
             PRINT("Done."),
-        ]
+        ])
+
+        gb = GlobalBufferAllocator(width=self.args.width)
+        wts_buf = gb.allocate("weights", sum(wt.nbytes for wt in wts), io_ctrl=1)
+        ims_buf = gb.allocate("images", sum(im.nbytes for im in ims), io_ctrl=0)
+        out_buf = gb.allocate("output", gold.nbytes, io_ctrl=3)
 
         # Load weights to consecutive memory in global buffer
-        wt_addr = BANK_ADDR(4)
+        wt_addr = wts_buf.addr
         wt_addr_base = wt_addr
         wt_len = 0
         k = 0;
@@ -634,7 +689,7 @@ class Conv3x3ReLU():
             k += 1
 
         # Load images to consecutive memory in global buffer
-        im_addr = BANK_ADDR(0)
+        im_addr = ims_buf.addr
         im_addr_base = im_addr
         im_len = 0
         k = 0
@@ -658,37 +713,48 @@ class Conv3x3ReLU():
             for j in range(0, 9):
                 img_y = k // 3 + (j // 3 - 1)
                 img_x = k % 3 + (j % 3 - 1)
+                im_addr = im_addr_base + (img_y * in_x + img_x) * in_chan
                 #command_list += [
                 #    *configure_io(IO_INPUT_STREAM, im_addr_base + (img_y * in_x + img_x) * in_chan, in_chan, width=self.args.width),
                 #]
-                for i in range(0, out_chan):
+
+                # The weight address is affine in the output channel, so
+                # the innermost loop doesn't need to be unrolled.
+                def restart(i):
+                    return [
+                        configure_io(IO_INPUT_STREAM, im_addr, in_chan, width=self.args.width),
+                        configure_io(IO_INPUT_STREAM, wt_addr_base + (j * out_chan + i) * in_chan, in_chan, width=self.args.width),
+                        WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
+                        WAIT(0b01, "start"),
+                    ]
+
+                if j == 0 and k == 1:
+                    command_list += [
+                        configure_io(IO_INPUT_STREAM, im_addr, in_chan, width=self.args.width),
+                        configure_io(IO_INPUT_STREAM, wt_addr_base + (j * out_chan) * in_chan, in_chan, width=self.args.width),
+                        configure_io(IO_OUTPUT_STREAM, out_buf.addr, len(gold), io_ctrl=out_buf.io_ctrl, mask=out_buf.mask, width=self.args.width),
+
+                        # Run the application
+                        PRINT("Starting application..."),
+                        WRITE_REG(STALL_REG, 0),
+
+                        PEND(0b01, "start"),
+                        WRITE_REG(CGRA_START_REG, 1),
+                        # PRINT("Waiting for completion..."),
+                        # PRINT("Done."),
+
+                        LOOP(out_chan - 1, lambda i: restart(i + 1)),
+                    ]
+                else:
                     command_list += [
-                        *configure_io(IO_INPUT_STREAM, im_addr_base + (img_y * in_x + img_x) * in_chan, in_chan, width=self.args.width),
-                        *configure_io(IO_INPUT_STREAM, wt_addr_base + (j * out_chan + i) * in_chan, in_chan, width=self.args.width),
+                        LOOP(out_chan, restart),
                     ]
-                    if i == 0 and j == 0 and k == 1:
-                        command_list += [
-                            *configure_io(IO_OUTPUT_STREAM, BANK_ADDR(12), len(gold), width=self.args.width),
-                
-                            # Run the application
-                            PRINT("Starting application..."),
-                            WRITE_REG(STALL_REG, 0),
-                
-                            PEND(0b01, "start"),
-                            WRITE_REG(CGRA_START_REG, 1),
-                            # PRINT("Waiting for completion..."),
-                            # PRINT("Done."),
-                        ]
-                    else:
-                        command_list += [
-                            WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
-                            WAIT(0b01, "start") ]
 
         command_list += [
             WAIT(0b01, "start"),
             PRINT("Reading output data..."),
             READ_DATA(
-                BANK_ADDR(12),
+                out_buf.addr,
                 gold.nbytes,
                 gold,
                 _file=self.outfile,
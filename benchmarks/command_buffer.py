@@ -0,0 +1,137 @@
+# Compares memory use and build time of a CommandBuffer against the
+# old list of Command objects for a gc-configured bitstream and a
+# Conv3x3ReLU-sized sequence of configure_io calls.
+#
+#   python benchmarks/command_buffer.py --words 1000000
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), ".."))
+from commands import *
+
+
+def measure(f):
+    # Timing and memory are measured in separate runs since tracemalloc
+    # slows down allocation heavy code a lot.
+    t_start = time.perf_counter()
+    f()
+    t_end = time.perf_counter()
+
+    tracemalloc.start()
+    result = f()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, t_end - t_start, peak
+
+
+def bitstream_list(filename):
+    commands = []
+    with open(filename, 'r') as f:
+        for line in f:
+            addr, data = (int(x, 16) for x in line.strip().split(' '))
+            commands += [
+                WRITE_REG(CGRA_CONFIG_ADDR_REG, addr),
+                WRITE_REG(CGRA_CONFIG_DATA_REG, data),
+            ]
+    return commands
+
+
+def configure_io_list(mode, addr, size, io_ctrl=0, mask=0b1):
+    return [
+        WRITE_REG(IO_MODE_REG(io_ctrl), mode),
+        WRITE_REG(IO_ADDR_REG(io_ctrl), addr),
+        WRITE_REG(IO_SIZE_REG(io_ctrl), size),
+        WRITE_REG(IO_SWITCH_REG(io_ctrl), mask),
+    ]
+
+
+def schedule_list(iterations):
+    commands = []
+    for k in range(iterations):
+        commands += [
+            *configure_io_list(IO_INPUT_STREAM, BANK_ADDR(0) + 32 * (k % 64), 16),
+            *configure_io_list(IO_INPUT_STREAM, BANK_ADDR(4) + 32 * (k % 144), 16, io_ctrl=1),
+            WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
+            WAIT(0b01, "start"),
+        ]
+    return commands
+
+
+def schedule_buffer(iterations):
+    commands = CommandBuffer()
+    for k in range(iterations):
+        commands += [
+            configure_io(IO_INPUT_STREAM, BANK_ADDR(0) + 32 * (k % 64), 16),
+            configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 32 * (k % 144), 16, io_ctrl=1),
+            WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
+            WAIT(0b01, "start"),
+        ]
+    return commands
+
+
+def consume(commands):
+    # What every backend does: walk the commands once.
+    n = 0
+    for command in commands:
+        n += 1
+    return n
+
+
+def report(name, old, new):
+    (_, t_old, m_old), (_, t_new, m_new) = old, new
+    print(f"{name}")
+    print(f"    list:   {t_old:8.3f} s  {m_old / 2**20:10.1f} MiB")
+    print(f"    buffer: {t_new:8.3f} s  {m_new / 2**20:10.1f} MiB")
+    print(f"    speedup {t_old / t_new:.1f}x, memory {m_old / max(m_new, 1):.1f}x less")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--words", type=int, default=200000,
+                        help="number of config words in the synthetic bitstream")
+    parser.add_argument("--iterations", type=int, default=6*6*9*16,
+                        help="number of restarts in the synthetic schedule")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    bitstream = rng.integers(0, 2**32, size=(args.words, 2), dtype=np.uint64)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "bench.bs")
+        np.savetxt(filename, bitstream, fmt="%08X")
+
+        report(
+            f"gc_config_bitstream ({args.words} words)",
+            measure(lambda: bitstream_list(filename)),
+            measure(lambda: gc_config_bitstream(filename)),
+        )
+
+    report(
+        f"configure_io schedule ({args.iterations} restarts)",
+        measure(lambda: schedule_list(args.iterations)),
+        measure(lambda: schedule_buffer(args.iterations)),
+    )
+
+    commands = schedule_buffer(args.iterations)
+    report(
+        "iterate schedule",
+        measure(lambda: consume(list(commands))),
+        measure(lambda: consume(commands)),
+    )
+
+    report(
+        "create_command_bitstream",
+        measure(lambda: create_command_bitstream(list(commands))),
+        measure(lambda: create_command_bitstream(commands)),
+    )
+
+
+if __name__ == "__main__":
+    main()
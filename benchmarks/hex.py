@@ -0,0 +1,77 @@
+# Times formatting WRITE_DATA payloads as C initializers, the old way
+# (one f-string per word) against iter_hex(), for payloads from 1 KB to
+# 64 MB. Both write to a file under --out so the chunked writes are
+# part of what is measured.
+#
+# The per-word loop gets slow quickly, so it is only run up to
+# --loop-limit.
+#
+#   python benchmarks/hex.py --out /tmp/hex
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), ".."))
+from commands import *
+
+
+SIZES = [2**k for k in range(10, 27, 2)]  # 1 KB ... 64 MB
+
+
+def per_word(data, f):
+    vals = []
+    for k in range(len(data)):
+        vals.append(f"0x{data[k]:x}")
+    f.write(",\n".join(vals))
+
+
+def vectorized(data, f):
+    for text in iter_hex(data):
+        f.write(text)
+
+
+def timed(format, data, path):
+    t_start = time.perf_counter()
+    with open(path, "w") as f:
+        format(data, f)
+    return time.perf_counter() - t_start, os.path.getsize(path)
+
+
+def size_str(nbytes):
+    for unit in ["B", "KB", "MB"]:
+        if nbytes < 1024 or unit == "MB":
+            return f"{nbytes:.0f} {unit}"
+        nbytes /= 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", default=None,
+                        help="directory for the generated files (default: a temporary one)")
+    parser.add_argument("--loop-limit", type=int, default=2**24,
+                        help="largest payload in bytes to also format one word at a time")
+    args = parser.parse_args()
+
+    out = args.out or tempfile.mkdtemp()
+    os.makedirs(out, exist_ok=True)
+    rng = np.random.default_rng(0)
+
+    print(f"{'payload':>10}{'per word (s)':>16}{'vectorized (s)':>16}{'speedup':>10}{'MB/s':>10}")
+    for nbytes in SIZES:
+        data = rng.integers(0, 2**64, nbytes // 8, dtype=np.uint64, endpoint=False)
+        t_vec, _ = timed(vectorized, data, os.path.join(out, f"vectorized_{nbytes}.txt"))
+        if nbytes <= args.loop_limit:
+            t_loop, _ = timed(per_word, data, os.path.join(out, f"per_word_{nbytes}.txt"))
+            loop, speedup = f"{t_loop:16.4f}", f"{t_loop / t_vec:9.1f}x"
+        else:
+            loop, speedup = f"{'-':>16}", f"{'-':>10}"
+        print(f"{size_str(nbytes):>10}{loop}{t_vec:16.4f}{speedup}{nbytes / 2**20 / t_vec:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# Compares a schedule compiled with create_straightline_code against
+# the same schedule as a command bitstream run by the interpreter from
+# create_interpreter_code: size of the generated C, size of the blob,
+# and how long it takes to encode, decode and check on the host.
+#
+# The firmware for both is written to --out so the dispatch overhead
+# can be measured on the SoC.
+#
+#   python benchmarks/interpreter.py --iterations 5184 --out build
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), ".."))
+from commands import *
+
+
+def schedule(iterations):
+    commands = CommandBuffer()
+    for k in range(iterations):
+        commands += [
+            configure_io(IO_INPUT_STREAM, BANK_ADDR(0) + 32 * (k % 64), 16),
+            configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 32 * (k % 144), 16, io_ctrl=1),
+            WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
+            WAIT(0b01, "start"),
+        ]
+    return commands
+
+
+def looped_schedule(iterations):
+    return CommandBuffer([
+        LOOP(iterations, lambda k: [
+            configure_io(IO_INPUT_STREAM, BANK_ADDR(0) + 32 * k, 16),
+            configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 32 * k, 16, io_ctrl=1),
+            WRITE_REG(CGRA_AUTO_RESTART_REG, 1),
+            WAIT(0b01, "start"),
+        ]),
+    ])
+
+
+def timed(f):
+    t_start = time.perf_counter()
+    result = f()
+    return result, time.perf_counter() - t_start
+
+
+def report(name, commands, out):
+    straightline, t_straightline = timed(lambda: create_straightline_code(commands))
+    interpreter, t_interpreter = timed(lambda: create_interpreter_code(commands))
+    blob, t_encode = timed(lambda: create_command_bitstream(commands))
+    _, t_check = timed(lambda: check_command_bitstream(commands, blob))
+    num_ops = sum(1 for _ in expand(commands))
+
+    print(f"{name} ({num_ops} commands executed)")
+    print(f"    straightline C: {len(straightline) / 2**10:10.1f} KiB  {t_straightline:8.3f} s")
+    print(f"    interpreter C:  {len(interpreter) / 2**10:10.1f} KiB  {t_interpreter:8.3f} s")
+    print(f"    blob:           {len(blob) / 2**10:10.1f} KiB  {t_encode:8.3f} s")
+    print(f"    decode + check:                {t_check:8.3f} s")
+
+    if out is not None:
+        os.makedirs(out, exist_ok=True)
+        with open(os.path.join(out, f"{name}_straightline.c"), "w") as f:
+            f.write(straightline)
+        with open(os.path.join(out, f"{name}_interpreter.c"), "w") as f:
+            f.write(interpreter)
+        with open(os.path.join(out, f"{name}.cmd"), "wb") as f:
+            f.write(blob)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=64,
+                        help="number of restarts in the synthetic schedule")
+    parser.add_argument("--out", default=None,
+                        help="directory to write the generated firmware to")
+    args = parser.parse_args()
+
+    report("unrolled", schedule(args.iterations), args.out)
+    report("looped", looped_schedule(args.iterations), args.out)
+
+
+if __name__ == "__main__":
+    main()
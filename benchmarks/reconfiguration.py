@@ -0,0 +1,87 @@
+# Measures how much differential reconfiguration saves when apps run
+# back to back: the full bitstream of each app against only the words
+# that differ from the app already on the CGRA.
+#
+# Besides the word counts, whole schedules are compared with the cost
+# model in cost.py: the apps run one after another, each starting with
+# a GLOBAL_RESET and its full config, against back_to_back() from
+# applications.py, which skips the reset and only loads the diff. This
+# is done with OneShotValid for the gc_config_bitstream path and with
+# OneShotStall for the gb_config_bitstream path, on the `*_input.raw`
+# and `*_gold.raw` next to each app's bitstream.
+#
+# Only apps that actually run back to back are worth comparing, so they
+# are given explicitly, either as --pair OLD NEW or as a --sequence of
+# apps run in that order.
+#
+#   python benchmarks/reconfiguration.py \
+#       --sequence apps/camera_pipeline/first_half apps/camera_pipeline/second_half
+
+import argparse
+import os
+from pathlib import Path
+import sys
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), ".."))
+from applications import OneShotStall, OneShotValid, back_to_back
+from commands import *
+from cost import estimate
+
+
+def bitstream_file(app):
+    app = Path(app)
+    return app/"bin"/f"{app.name}.bs"
+
+
+def create_app(cls, app, width):
+    app = Path(app)
+    infiles = sorted(app.glob("*_input.raw"))
+    goldfiles = sorted(app.glob("*_gold.raw"))
+    if len(infiles) != 1 or len(goldfiles) != 1:
+        raise ValueError(f"`{app}` doesn't have exactly one input and one gold file.")
+    return cls(bitstream_file(app), infiles[0], goldfiles[0], os.devnull, argparse.Namespace(width=width))
+
+
+def report(sequence, width):
+    print(" -> ".join(map(str, sequence)))
+    for old, new in zip(sequence, sequence[1:]):
+        full = len(load_bitstream(bitstream_file(new)))
+        diff = len(load_config(bitstream_file(new), previous=bitstream_file(old)))
+        print(f"    {new.name} words: {full:10} full {diff:10} diff  ({100 * (1 - diff / max(full, 1)):5.1f}% fewer)")
+
+    for cls in [OneShotValid, OneShotStall]:
+        try:
+            t_reset = estimate(CommandBuffer([create_app(cls, app, width).commands() for app in sequence]), width=width).now
+            t_b2b = estimate(back_to_back([create_app(cls, app, width) for app in sequence]), width=width).now
+        except ValueError as e:
+            print(f"    {cls.__name__}: skipped, {e}")
+            continue
+        print(f"    {cls.__name__}: {t_reset:12} cycles with resets {t_b2b:12} back to back  ({t_reset - t_b2b} saved)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--width", type=int, default=32)
+    parser.add_argument("--pair", nargs=2, action="append", default=[],
+                        metavar=("OLD", "NEW"),
+                        help="compare reconfiguring from OLD to NEW")
+    parser.add_argument("--sequence", nargs="+", action="append", default=[],
+                        metavar="APP",
+                        help="compare running these apps back to back")
+    args = parser.parse_args()
+
+    sequences = [list(map(Path, sequence)) for sequence in args.pair + args.sequence]
+    if not any(len(sequence) > 1 for sequence in sequences):
+        parser.error("give the apps that run back to back with --pair or --sequence")
+
+    missing = sorted({str(bitstream_file(app)) for sequence in sequences for app in sequence if not bitstream_file(app).exists()})
+    if missing:
+        parser.error(f"no bitstream at {', '.join(missing)}, run `run.py` first")
+
+    for sequence in sequences:
+        if len(sequence) > 1:
+            report(sequence, args.width)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+import numpy as np
+
+
+# Maps ASCII hex digits to their value, everything else is invalid.
+HEX_DIGITS = np.full(256, 0xff, dtype=np.uint8)
+HEX_DIGITS[np.frombuffer(b"0123456789", dtype=np.uint8)] = np.arange(10)
+HEX_DIGITS[np.frombuffer(b"abcdef", dtype=np.uint8)] = np.arange(10, 16)
+HEX_DIGITS[np.frombuffer(b"ABCDEF", dtype=np.uint8)] = np.arange(10, 16)
+
+
+def parse_hex(text):
+    """Parses whitespace separated 32-bit hex words into a uint32 array."""
+    tokens = text.split()
+    if not tokens:
+        return np.empty(0, dtype=np.uint32)
+
+    tokens = np.array(tokens, dtype=bytes)
+    if tokens.itemsize > 8:
+        raise ValueError("Bitstream words must be at most 32 bits.")
+
+    # Right-align every token so each one is exactly 8 digits
+    tokens = np.char.rjust(tokens, 8, fillchar=b"0")
+    digits = HEX_DIGITS[tokens.view(np.uint8).reshape(-1, 8)]
+    if np.any(digits == 0xff):
+        raise ValueError("Bitstream contains a malformed hex word.")
+
+    weights = 16 ** np.arange(7, -1, -1, dtype=np.uint64)
+    return (digits.astype(np.uint64) @ weights).astype(np.uint32)
+
+
+# Config addresses are {reg[31:24], feature[23:16], tile[15:0]} and a
+# tile ID is {x[15:8], y[7:0]}.
+def decode_config_addr(addrs):
+    """Splits config addresses into (x, y, feature, reg) arrays."""
+    addrs = np.asarray(addrs, dtype=np.uint32)
+    return (
+        (addrs >> 8) & 0xff,
+        addrs & 0xff,
+        (addrs >> 16) & 0xff,
+        addrs >> 24,
+    )
+
+
+def sidecar_path(filename, digest):
+    filename = Path(filename)
+    return filename.with_name(f"{filename.name}.{digest}.npy")
+
+
+def load_bitstream(filename, cache=True):
+    """Loads a `.bs` file of "addr data" hex pairs.
+
+    Returns an (n, 2) uint32 array where column 0 is the address and
+    column 1 is the data. The parsed array is saved next to the
+    bitstream as `<name>.bs.<hash>.npy`, keyed by the contents of the
+    bitstream, and later loads just memory-map that file.
+    """
+    with open(filename, "rb") as f:
+        text = f.read()
+
+    if cache:
+        digest = hashlib.sha1(text).hexdigest()[:16]
+        sidecar = sidecar_path(filename, digest)
+        if sidecar.exists():
+            try:
+                return np.load(sidecar, mmap_mode="r")
+            except (OSError, ValueError):
+                logging.warning(f"Ignoring unreadable bitstream cache `{sidecar}`.")
+
+    words = parse_hex(text)
+    if len(words) % 2:
+        raise ValueError(f"`{filename}` has an odd number of words.")
+    bitstream = words.reshape(-1, 2)
+
+    if cache:
+        try:
+            # Drop caches for previous versions of this bitstream
+            for stale in Path(filename).parent.glob(f"{Path(filename).name}.*.npy"):
+                stale.unlink()
+
+            tmp = sidecar.with_name(f"{sidecar.name}.{os.getpid()}.tmp")
+            with open(tmp, "wb") as f:
+                np.save(f, bitstream)
+            os.replace(tmp, sidecar)
+            return np.load(sidecar, mmap_mode="r")
+        except OSError:
+            logging.warning(f"Couldn't write bitstream cache for `{filename}`.")
+
+    return bitstream
+
+
+def last_writes(bitstream):
+    """Collapses a bitstream to the value last written to each address.
+
+    Returns an (n, 2) uint32 array sorted by address.
+    """
+    bitstream = np.asarray(bitstream, dtype=np.uint32).reshape(-1, 2)
+    # np.unique keeps the first occurrence, so look from the end
+    reverse = bitstream[::-1]
+    _, index = np.unique(reverse[:, 0], return_index=True)
+    return reverse[index]
+
+
+def diff_bitstreams(old, new, default=0):
+    """Returns the writes that take a CGRA configured with `old` to `new`.
+
+    Only words whose value changes are kept. Addresses that `old` set
+    but `new` doesn't are reset to `default`, which is either a single
+    value for every register or a dict of address to value (registers
+    missing from it reset to 0). The result is sorted by address.
+    """
+    old = last_writes(old)
+    new = last_writes(new)
+
+    def keys(bitstream):
+        return (bitstream[:, 0].astype(np.uint64) << np.uint64(32)) | bitstream[:, 1]
+
+    changed = new[~np.isin(keys(new), keys(old))]
+
+    stale = old[~np.isin(old[:, 0], new[:, 0])]
+    if isinstance(default, dict):
+        values = [default.get(int(addr), 0) for addr in stale[:, 0]]
+    else:
+        values = np.full(len(stale), default)
+    resets = np.column_stack([stale[:, 0], np.asarray(values, dtype=np.uint32)]).astype(np.uint32)
+    resets = resets[resets[:, 1] != stale[:, 1]]
+
+    diff = np.concatenate([changed, resets])
+    return diff[np.argsort(diff[:, 0], kind="stable")]
+
+
+def canonicalize_bitstream(bitstream):
+    """Puts a bitstream into a canonical form.
+
+    Writes shadowed by a later write to the same address are dropped,
+    and the rest are sorted by tile (x, then y), then by feature and
+    register. Two bitstreams that configure the CGRA the same way end
+    up identical. Returns the (n, 2) uint32 array and a dict of stats.
+    """
+    bitstream = np.asarray(bitstream, dtype=np.uint32).reshape(-1, 2)
+    kept = last_writes(bitstream)
+
+    x, y, feature, reg = decode_config_addr(kept[:, 0])
+    canonical = kept[np.lexsort((reg, feature, y, x))]
+
+    tiles = np.unique((x.astype(np.uint32) << 8) | y)
+    stats = {
+        'words': len(bitstream),
+        'kept': len(canonical),
+        'shadowed': len(bitstream) - len(canonical),
+        'tiles': len(tiles),
+        'reordered': not np.array_equal(bitstream, canonical),
+    }
+    return canonical, stats
+
+
+def save_bitstream(filename, bitstream):
+    """Writes an (n, 2) array of config writes as a `.bs` file."""
+    tmp = Path(filename).with_name(f"{Path(filename).name}.{os.getpid()}.tmp")
+    np.savetxt(tmp, np.asarray(bitstream, dtype=np.uint32).reshape(-1, 2), fmt="%08X")
+    os.replace(tmp, filename)
+
+
+def canonicalize_file(filename):
+    """Canonicalizes a `.bs` file in place, returns its stats."""
+    canonical, stats = canonicalize_bitstream(load_bitstream(filename, cache=False))
+    if stats['reordered']:
+        save_bitstream(filename, canonical)
+    return stats
@@ -0,0 +1,214 @@
+# Content-addressed cache for the command lists applications.py builds
+# and for what the backends generate from them, so that running the
+# same app on the same files again is just a lookup.
+#
+#   cache = ArtifactCache(".shale-cache", max_bytes=2**30)
+#   commands = cache.commands(app)
+#   code = cache.artifact(app, create_straightline_code, optimize=True)
+#   blob = cache.artifact(app, create_command_bitstream)
+#
+# An app is keyed by its class, its arguments (args.width included),
+# the contents of the bitstream, input and gold files it names, and the
+# source of the modules that build and lower schedules, so changing any
+# of them is a miss. Artifacts are keyed by their app, the function
+# that generated them, its options and the BUILD_FLAGS of commands.py.
+#
+# Every entry is a directory named after its key. Looking one up bumps
+# its mtime, and once the cache grows past `max_bytes` the entries used
+# longest ago are evicted.
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import sys
+import numpy as np
+import allocator
+import bitstream
+import commands
+from commands import CommandBuffer
+
+
+# Attributes of an app that name files it writes rather than reads, so
+# only their paths are part of the key.
+OUTPUT_ATTRS = {"outfile", "outfiles"}
+
+# Options of the backends that write files on the side, which a cache
+# hit wouldn't recreate.
+SIDE_EFFECT_OPTIONS = {"blob_dir", "preload_dir", "out_dir"}
+
+# Modules whose code decides what a schedule turns into, on top of the
+# one that defines the app's class.
+SOURCE_MODULES = [allocator, bitstream, commands]
+
+# Switches in commands.py that change the generated code and can be
+# flipped at run time.
+BUILD_FLAGS = ["DMA", "MEMCPY", "TLX"]
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def describe(value):
+    """JSON-able description of an app argument, with the contents of
+    any file it names."""
+    if isinstance(value, (list, tuple)):
+        return [describe(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): describe(v) for k, v in sorted(value.items())}
+    if isinstance(value, argparse.Namespace):
+        return describe(vars(value))
+    if isinstance(value, (str, Path)) and os.path.isfile(value):
+        return {'file': str(value), 'sha1': file_digest(value)}
+    return repr(value)
+
+
+class ArtifactCache:
+    def __init__(self, root=".shale-cache", max_bytes=2**30):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # Files are hashed once per app state, not once per lookup
+        self._keys = {}
+        self._sources = {}
+
+    def source_digest(self, module):
+        if module.__name__ not in self._sources:
+            self._sources[module.__name__] = file_digest(module.__file__)
+        return self._sources[module.__name__]
+
+    def app_key(self, app):
+        # Apps can change after they are first looked up, e.g. through
+        # back_to_back(), so the memo is keyed on what they hold.
+        cls = type(app)
+        state = repr((cls, sorted(vars(app).items())))
+        if state not in self._keys:
+            modules = SOURCE_MODULES + [sys.modules[cls.__module__]]
+            desc = {
+                'class': f"{cls.__module__}.{cls.__qualname__}",
+                'args': {
+                    name: repr(value) if name in OUTPUT_ATTRS else describe(value)
+                    for name, value in sorted(vars(app).items())
+                },
+                'sources': {module.__name__: self.source_digest(module) for module in modules},
+                'bytecode': commands.BYTECODE_VERSION,
+            }
+            self._keys[state] = self.digest(desc)
+        return self._keys[state]
+
+    def digest(self, desc):
+        return hashlib.sha1(json.dumps(desc, sort_keys=True).encode()).hexdigest()
+
+    def commands(self, app):
+        """app.commands() as a CommandBuffer, from the cache if it is
+        there."""
+        key = self.app_key(app)
+        entry = self.lookup(key)
+        if entry is not None:
+            return CommandBuffer.load(entry / "commands.npz")
+
+        cmds = app.commands()
+        if not isinstance(cmds, CommandBuffer):
+            cmds = CommandBuffer(cmds)
+        try:
+            self.store(key, "commands.npz", cmds.save)
+        except TypeError as e:
+            logging.info(f"Not caching the commands of {type(app).__name__}: {e}")
+        return cmds
+
+    def artifact(self, app, generate, **options):
+        """generate(commands, **options) for the commands of `app`, which
+        has to return the whole artifact as a str or bytes."""
+        side_effects = {name for name, value in options.items() if value is not None} & SIDE_EFFECT_OPTIONS
+        if side_effects:
+            raise ValueError(f"Can't cache artifacts that also write {sorted(side_effects)}.")
+
+        key = self.digest({
+            'app': self.app_key(app),
+            'generate': f"{generate.__module__}.{generate.__qualname__}",
+            'options': {name: repr(value) for name, value in sorted(options.items())},
+            'flags': {name: repr(getattr(commands, name)) for name in BUILD_FLAGS},
+        })
+        entry = self.lookup(key)
+        if entry is not None:
+            if (entry / "artifact.txt").exists():
+                return (entry / "artifact.txt").read_text()
+            return (entry / "artifact.bin").read_bytes()
+
+        result = generate(self.commands(app), **options)
+        if isinstance(result, str):
+            self.store(key, "artifact.txt", lambda f: f.write(result.encode()))
+        elif isinstance(result, (bytes, bytearray, np.ndarray)):
+            self.store(key, "artifact.bin", lambda f: f.write(bytes(result)))
+        else:
+            raise TypeError(f"{generate.__name__} returned a {type(result).__name__}, not a str or bytes.")
+        return result
+
+    def lookup(self, key):
+        entry = self.root / key
+        if not entry.is_dir():
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        return entry
+
+    def store(self, key, name, write):
+        """Writes an entry with the single file `name` through
+        write(f). Entries are built in a temporary directory and renamed
+        into place, so readers never see half of one."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.root / f"{key}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir()
+        try:
+            with open(tmp / name, "wb") as f:
+                write(f)
+            try:
+                os.rename(tmp, self.root / key)
+            except OSError:
+                # Someone else stored it first
+                pass
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=key)
+
+    def entries(self):
+        """(key, bytes, last used) of every entry, least recently used
+        first."""
+        entries = []
+        for entry in self.root.iterdir() if self.root.is_dir() else []:
+            if not entry.is_dir() or entry.suffix == ".tmp":
+                continue
+            nbytes = sum(f.stat().st_size for f in entry.iterdir())
+            entries.append((entry.name, nbytes, entry.stat().st_mtime))
+        return sorted(entries, key=lambda e: e[2])
+
+    def size(self):
+        return sum(nbytes for _, nbytes, _ in self.entries())
+
+    def evict(self, keep=None):
+        entries = self.entries()
+        total = sum(nbytes for _, nbytes, _ in entries)
+        for key, nbytes, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.root / key, ignore_errors=True)
+            total -= nbytes
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
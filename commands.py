@@ -7,9 +7,21 @@
 # use of interrupts, etc.
 
 
+from collections import namedtuple
+import copy
+import filecmp
 from inspect import currentframe
+from itertools import zip_longest
+import io
+import json
+import logging
+import os
 import re
+import shutil
+import tempfile
+import zlib
 import numpy as np
+from bitstream import decode_config_addr, diff_bitstreams, load_bitstream
 
 
 DMA = True
@@ -113,6 +125,14 @@ CGRA_CONFIG_DATA_REG = 0x30
 IO_INPUT_STREAM = 1
 IO_OUTPUT_STREAM = 2
 
+# INTERRUPT_STATUS_REG bits
+CGRA_DONE_MASK = 0b01
+CONFIG_DONE_MASK = 0b10
+
+
+GB_BANKS = 32
+GB_BANK_SIZE = 2**17
+
 
 def BANK_ADDR(n):
     return int(f'{n:05b}{0:017b}', 2)
@@ -166,19 +186,142 @@ def FR_SWITCH_REG(n):
     return int(f'10{n:04b}{2:04b}00', 2)
 
 
+class LoopVar:
+    """The induction variable of a LOOP, counting from 0 to count-1."""
+
+    def __init__(self, name, count):
+        self.name = name
+        self.count = count
+
+    def __repr__(self):
+        return self.name
+
+
+class Affine:
+    """A value of the form base + sum(stride * var) over loop variables.
+
+    These show up as addresses (or data) of commands inside a LOOP
+    body, and are resolved when the loop is lowered or expanded.
+    """
+
+    def __init__(self, base=0, terms=None):
+        self.base = base
+        self.terms = dict(terms or {})
+
+    def __add__(self, other):
+        if isinstance(other, Affine):
+            terms = dict(self.terms)
+            for var, stride in other.terms.items():
+                terms[var] = terms.get(var, 0) + stride
+            return Affine(self.base + other.base, terms)
+        return Affine(self.base + other, self.terms)
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return self * -1
+
+    def __sub__(self, other):
+        return self + -other
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __mul__(self, other):
+        if isinstance(other, Affine):
+            raise TypeError("Loop variables can only be scaled by constants.")
+        return Affine(self.base * other, {var: stride * other for var, stride in self.terms.items()})
+
+    __rmul__ = __mul__
+
+    def subs(self, env):
+        """Substitutes the variables in `env`. Returns a plain value once
+        no variables are left."""
+        value = self.base
+        terms = {}
+        for var, stride in self.terms.items():
+            if var in env:
+                value = value + stride * env[var]
+            else:
+                terms[var] = stride
+        if terms:
+            return Affine(value, terms)
+        return value
+
+    def bounds(self):
+        lo = hi = self.base
+        for var, stride in self.terms.items():
+            lo += min(0, stride * (var.count - 1))
+            hi += max(0, stride * (var.count - 1))
+        return lo, hi
+
+    def c_expr(self):
+        base = f"-0x{-self.base:x}" if self.base < 0 else f"0x{self.base:x}"
+        return " + ".join([base, *(f"{stride}*{var.name}" for var, stride in self.terms.items())])
+
+    def __repr__(self):
+        return f"({self.c_expr()})"
+
+    def __format__(self, spec):
+        return repr(self)
+
+
+def subs(value, env):
+    if isinstance(value, Affine):
+        return value.subs(env)
+    return value
+
+
+def hex_repr(value):
+    # Inside a fault loop, values can be expressions on the loop index
+    if isinstance(value, (int, np.integer)):
+        return f"0x{value:08x}"
+    return f"{value}"
+
+
+def c_value(value, spec="x"):
+    """Formats an integer or Affine as a C expression."""
+    if isinstance(value, Affine):
+        return f"({value.c_expr()})"
+    return f"0x{value:{spec}}"
+
+
 class Command:
-    def ser(self):
+    # Number of argument words that follow the opcode in the bytecode
+    nargs = 0
+
+    def ser(self, code):
         return []
 
+    @classmethod
+    def deser(cls, args, code):
+        return cls(*args)
+
+    def pack(self):
+        # (addr, data, size, payload, label) as stored in a CommandBuffer
+        return 0, 0, 0, None, None
+
+    @classmethod
+    def unpack(cls, addr, data, size, payload, label):
+        return cls()
+
+    def bind(self, env):
+        # Returns this command with loop variables in `env` substituted
+        return self
+
     def sim(self, target):
         pass
 
+    def emulate(self, model):
+        pass
+
     def compile(self, _globals):
         return ""
 
     @staticmethod
     def interpret():
-        pass
+        # C run by the interpreter, with arguments in ARG_1, ARG_2, ...
+        return ""
 
 
 class NOP(Command):
@@ -187,17 +330,15 @@ class NOP(Command):
     def __init__(self):
         pass
 
-    def ser(self):
-        return [NOP.opcode]
+    def ser(self, code):
+        return code.op(NOP)
 
     def sim(self, tester):
         tester.step(2)
 
     @staticmethod
     def interpret():
-        return """
-        // poke DMA to copy commands over
-        """
+        return ""
 
 # input        axi4_ctrl_rready,
 # input [31:0] axi4_ctrl_araddr,
@@ -221,16 +362,27 @@ class NOP(Command):
 
 class WRITE_REG(Command):
     opcode = new_opcode()
+    nargs = 2
 
     def __repr__(self):
-        return f"writing 0x{self.data:08x} to 0x{self.addr:08x}"
+        return f"writing {hex_repr(self.data)} to {hex_repr(self.addr)}"
 
     def __init__(self, addr, data):
         self.addr = addr
         self.data = data
 
-    def ser(self):
-        return [WRITE_REG.opcode, self.addr, self.data]
+    def bind(self, env):
+        return WRITE_REG(subs(self.addr, env), subs(self.data, env))
+
+    def ser(self, code):
+        return code.op(WRITE_REG, self.addr, self.data)
+
+    def pack(self):
+        return self.addr, self.data, 0, None, None
+
+    @classmethod
+    def unpack(cls, addr, data, size, payload, label):
+        return cls(addr, data)
 
     def sim(self, tester):
         tester.print(f"{self}\n")
@@ -275,8 +427,11 @@ class WRITE_REG(Command):
 
         tester.step(2)
 
+    def emulate(self, model):
+        model.write_reg(self.addr, self.data)
+
     def compile(self, _globals):
-        return f"*(volatile uint32_t*)(CGRA_REG_BASE + 0x{self.addr:08x}) = 0x{self.data:x};"
+        return f"*(volatile uint32_t*)(CGRA_REG_BASE + {c_value(self.addr, '08x')}) = {c_value(self.data)};"
 
     @staticmethod
     def interpret():
@@ -291,13 +446,14 @@ class WRITE_REG(Command):
         # ]
 
         return """
-        *ARG_1 = ARG_2;
+        *(volatile uint32_t*)(CGRA_REG_BASE + ARG_1) = ARG_2;
         """
 
 
 # HACK this function doesn't even really exist outside of simulation
 class READ_REG(Command):
-    opcode = None
+    opcode = new_opcode()
+    nargs = 2
 
     def __repr__(self):
         return f"expecting 0x{self.expected:08x} at 0x{self.addr:08x}"
@@ -306,8 +462,15 @@ class READ_REG(Command):
         self.addr = addr
         self.expected = expected  # HACK only used for simulation
 
-    def ser(self):
-        return [WRITE_REG.opcode, self.addr]
+    def ser(self, code):
+        return code.op(READ_REG, self.addr, self.expected)
+
+    def pack(self):
+        return self.addr, self.expected, 0, None, None
+
+    @classmethod
+    def unpack(cls, addr, data, size, payload, label):
+        return cls(addr, data)
 
     def sim(self, tester):
         # drive inputs
@@ -348,12 +511,17 @@ class READ_REG(Command):
         tester.eval()  # HACK
         tester.step(2)  # HACK
 
+    def emulate(self, model):
+        model.expect_reg(self.addr, self.expected)
+
     def compile(self, _globals):
         return f"errors += *(volatile uint32_t*)(CGRA_REG_BASE + 0x{self.addr:08x}) != 0x{self.data:x}"
 
     @staticmethod
     def interpret():
-        pass
+        return """
+        errors += *(volatile uint32_t*)(CGRA_REG_BASE + ARG_1) != ARG_2;
+        """
 
 
 # input [21:0] soc_data_rd_addr,
@@ -367,6 +535,7 @@ class READ_REG(Command):
 
 class WRITE_DATA(Command):
     opcode = new_opcode()
+    nargs = 3
 
     def __repr__(self):
         return f"writing {self.size} bytes from 0x{self.src:08x} to 0x{self.dst:08x}"  # noqa
@@ -377,8 +546,30 @@ class WRITE_DATA(Command):
         self.size = size  # in bytes
         self.data = data  # HACK only used for simulation
 
-    def ser(self):
-        return [WRITE_DATA.opcode, self.dst, self.src, self.size]
+    def ser(self, code):
+        # The payload goes in the data section and src becomes its offset
+        return code.op(WRITE_DATA, self.dst, code.payload(self.data), self.size)
+
+    @classmethod
+    def deser(cls, args, code):
+        dst, src, size = args
+        return cls(dst, src, size, code.payload_at(src, size))
+
+    def pack(self):
+        return self.dst, self.src, self.size, self.data, None
+
+    @classmethod
+    def unpack(cls, addr, data, size, payload, label):
+        return cls(addr, data, size, payload)
+
+    @classmethod
+    def from_layout(cls, layout, data, chunk=0):
+        """Writes `data` (chunk `chunk` of an interleaved stream) to
+        wherever `layout` keeps it."""
+        return CommandBuffer([
+            cls(addr, 0xc0ffee, part.nbytes, part)
+            for addr, part in layout.parts(data, chunk)
+        ])
 
     def sim(self, tester):
         data = self.data.view(np.uint64)
@@ -406,19 +597,30 @@ class WRITE_DATA(Command):
             tester.eval()
             tester.step(2)  # HACK
 
-    def compile(self, _globals):
+    def emulate(self, model):
+        model.write_data(self.dst, self.size, self.data)
+
+    def define(self, _globals):
+        """Adds the payload to the globals and returns the name of the
+        array the M3 should copy it from."""
         data = self.data.view(np.uint64)
-        print(len(data))
 
         array_id = f"data_{new_id()}"
-        vals = []
-        for k in range(len(data)):
-            vals.append(f"0x{data[k]:x}")
-        _globals['src'] += [f"uint64_t {array_id}[] = {{" , ",\n".join(vals), "};"]
+        if _globals.get('blob_dir') is not None:
+            _globals['src'] += [link_blob(array_id, data, _globals['blob_dir'])]
+        else:
+            _globals['src'] += [HexArray(array_id, data)]
         _globals['ids'] += [array_id]
 
         if TLX:
             array_id = f"tlx_{array_id}"
+        return array_id
+
+    def compile(self, _globals):
+        data = self.data.view(np.uint64)
+        print(len(data))
+
+        array_id = self.define(_globals)
 
         if DMA:
             if MEMCPY:
@@ -426,33 +628,9 @@ class WRITE_DATA(Command):
                 aha_memcpy((uint64_t*)(CGRA_DATA_BASE + 0x{self.dst:08x}), &({array_id}[0]), {len(data)});
                 """
             else:
-                # print(array_id, self.size//8, len(data))
-                num_beats = len(data)
-                num_burst_16 = num_beats // 16
-                num_burst_end = num_beats % 16
-                # print(num_beats, num_burst_16, num_burst_end)
-                src = []
-                if num_burst_16 // 256 > 0 :
-                    src.append(f"""
-                    for (size_t k = 0; k < {num_burst_16 // 256}; k++) {{
-                        start_dma0((uint64_t*)(CGRA_DATA_BASE + 0x{self.dst:08x} + k*8*16*256), &({array_id}[k*16*256]), 16, 256);
-                        wait_dma0();
-                    }}
-                    """)
-
-                if num_burst_16 % 256 > 0:
-                    src.append(f"""
-                    start_dma0((uint64_t*)(CGRA_DATA_BASE + 0x{self.dst:08x} + {num_burst_16 // 256}*8*16*256), &({array_id}[{num_burst_16 // 256}*16*256]), 16, {num_burst_16 % 256});
-                    wait_dma0();
-                    """)
-
-                if num_burst_end > 0:
-                    src.append(f"""
-                    start_dma0((uint64_t*)(CGRA_DATA_BASE + 0x{self.dst:08x} + {num_beats - num_burst_end}*8), &({array_id}[{num_beats - num_burst_end}]), {num_burst_end}, 1);
-                    wait_dma0();
-                    """)
-
-                return "\n".join(src)
+                return f"""
+                dma_copy(0, (uint64_t*)(CGRA_DATA_BASE + 0x{self.dst:08x}), (const uint64_t*)&({array_id}[0]), {len(data)});
+                """
         else:
             return f"""
             for (size_t k = 0; k < {self.size}; k += 8) {{
@@ -460,16 +638,177 @@ class WRITE_DATA(Command):
             }}
            """
 
+    def compile_async(self, _globals, channel):
+        """Queues the copy on a DMA channel without waiting for it, see
+        create_straightline_code(overlap=True)."""
+        array_id = self.define(_globals)
+        return dma_enqueue(channel, f"(uint64_t*)(CGRA_DATA_BASE + 0x{self.dst:08x})", array_id, self.size // 8)
+
     @staticmethod
     def interpret():
-        return """
-        // memcpy(ARG_1, ARG_2, ARG_3);
-        """
+        if DMA:
+            return """
+            dma_copy(0, (uint64_t*)(CGRA_DATA_BASE + ARG_1), (const uint64_t*)(DATA + ARG_2), ARG_3 / 8);
+            """
+        else:
+            return """
+            for (size_t k = 0; k < ARG_3; k += 8) {
+                *(volatile uint64_t*)(CGRA_DATA_BASE + ARG_1 + k) = *(const uint64_t*)(DATA + ARG_2 + k);
+            }
+            """
+
+
+def dma_transfers(num_beats):
+    """Returns (first beat, beats per burst, number of bursts) for each
+    DMA transfer used to move `num_beats` 64-bit beats: chunks of 256
+    bursts of 16 beats, then the rest of the 16-beat bursts, then a
+    single short burst. This is the split dma_enqueue() and the cost
+    model use, and the one dma_copy() in DMA_COPY_RUNTIME, which the
+    synchronous WRITE_DATA.compile and READ_DATA.compile call, makes at
+    run time."""
+    num_burst_16 = num_beats // 16
+    num_burst_end = num_beats % 16
+    transfers = [(k*16*256, 16, 256) for k in range(num_burst_16 // 256)]
+    if num_burst_16 % 256 > 0:
+        transfers.append(((num_burst_16 // 256)*16*256, 16, num_burst_16 % 256))
+    if num_burst_end > 0:
+        transfers.append((num_beats - num_burst_end, num_burst_end, 1))
+    return transfers
+
+
+DMA_COPY_RUNTIME = """
+// Copies `num_beats` 64-bit words on DMA channel `ch` and waits for
+// it, split into transfers the same way as dma_transfers().
+static inline void dma_copy(uint32_t ch, uint64_t* dst, const uint64_t* src, uint32_t num_beats) {
+    while (num_beats > 0) {
+        uint32_t beats = num_beats >= 16 ? 16 : num_beats;
+        uint32_t bursts = num_beats / 16 < 256 ? num_beats / 16 : 256;
+        if (bursts == 0) bursts = 1;
+        if (ch == 0) {
+            start_dma0(dst, (uint64_t*)src, beats, bursts);
+            wait_dma0();
+        } else {
+            start_dma1(dst, (uint64_t*)src, beats, bursts);
+            wait_dma1();
+        }
+        dst += beats * bursts;
+        src += beats * bursts;
+        num_beats -= beats * bursts;
+    }
+}
+"""
+
+
+def dma_enqueue(channel, dst, src, num_beats):
+    """C that queues a copy of `num_beats` 64-bit words from `src` to
+    `dst` on a DMA channel of the async runtime. One of the two is an
+    array in SRAM and the other a pointer expression into the global
+    buffer, and the array is indexed directly."""
+    def at(ptr, k):
+        if ptr.startswith("("):
+            return f"{ptr} + {k}"
+        return f"(uint64_t*)&({ptr}[{k}])"
+
+    transfers = dma_transfers(num_beats)
+    src_lines = []
+    num_chunks = sum(1 for _, _, bursts in transfers if bursts == 256)
+    if num_chunks > 0:
+        src_lines.append(f"""
+        for (size_t k = 0; k < {num_chunks}; k++) {{
+            dma_enqueue({channel}, {at(dst, "k*16*256")}, {at(src, "k*16*256")}, 16, 256);
+        }}
+        """)
+    for first, beats, bursts in transfers[num_chunks:]:
+        src_lines.append(f"dma_enqueue({channel}, {at(dst, first)}, {at(src, first)}, {beats}, {bursts});")
+    return "\n".join(src_lines)
+
+
+# The two hex digits of every byte value, as one uint16 so a whole
+# word can be looked up with a single np.take
+HEX_PAIRS = np.frombuffer(
+    "".join(f"{byte:02x}" for byte in range(256)).encode(), dtype=np.uint16
+)
+
+# Words formatted per chunk by iter_hex()
+HEX_CHUNK_WORDS = 1 << 16
+
+
+def iter_hex(data, digits=16, prefix="0x", sep=",\n", chunk_words=HEX_CHUNK_WORDS):
+    """Formats every word of `data` as `prefix` + `digits` zero padded
+    hex digits, with `sep` between words, in chunks of `chunk_words`
+    words. The digits are looked up with numpy for a whole chunk at a
+    time instead of formatting each word in Python."""
+    # Big endian, so the bytes of each word come most significant first
+    data = np.asarray(data).ravel().astype(">u8")
+    prefix = np.frombuffer(prefix.encode(), dtype=np.uint8)
+    sep = np.frombuffer(sep.encode(), dtype=np.uint8)
+
+    row = len(prefix) + digits + len(sep)
+    for start in range(0, len(data), chunk_words):
+        words = data[start:start + chunk_words].view(np.uint8).reshape(-1, 8)
+        text = np.empty((len(words), row), dtype=np.uint8)
+        text[:, :len(prefix)] = prefix
+        text[:, len(prefix):len(prefix) + digits] = np.take(HEX_PAIRS, words).view(np.uint8)[:, 16 - digits:]
+        text[:, len(prefix) + digits:] = sep
+        text = text.tobytes()
+        if start + chunk_words >= len(data):
+            # No separator after the last word
+            text = text[:len(text) - len(sep)]
+        yield text.decode("ascii")
+
+
+def format_hex(data, digits=16, prefix="0x", sep=",\n"):
+    return "".join(iter_hex(data, digits, prefix, sep))
+
+
+class HexArray:
+    """Initializer of a uint64_t array, only formatted once it is
+    written out. write_straightline_code() writes it a chunk at a time,
+    anywhere else it is a string."""
+
+    def __init__(self, array_id, data, const=False):
+        self.array_id = array_id
+        self.data = data
+        self.const = const
+
+    def chunks(self):
+        yield f"{'const ' if self.const else ''}uint64_t {self.array_id}[] = {{\n"
+        yield from iter_hex(self.data)
+        yield "\n};"
+
+    def __str__(self):
+        return "".join(self.chunks())
+
+
+def link_blob(array_id, data, blob_dir):
+    """Writes `data` to `{blob_dir}/{array_id}.bin` and returns C that
+    pulls the file into the image with `.incbin` instead of spelling
+    it out as an initializer. The path in the `.incbin` is the one
+    given here, so either pass an absolute `blob_dir` or point the
+    assembler at it with `-Wa,-I`.
+    """
+    os.makedirs(blob_dir, exist_ok=True)
+    path = os.path.join(blob_dir, f"{array_id}.bin")
+    # Little endian on both sides, so this is the exact memory image
+    np.ascontiguousarray(data, dtype="<u8").tofile(path)
+
+    return f"""
+    extern uint64_t {array_id}[{len(data)}];
+    __asm__(
+        ".section .rodata.{array_id}, \\"a\\"\\n"
+        ".balign 8\\n"
+        ".global {array_id}\\n"
+        "{array_id}:\\n"
+        ".incbin \\"{path}\\"\\n"
+        ".previous\\n"
+    );
+    """
 
 
 # HACK shouldn't exist outside of simulation, just switch src and dst.
 class READ_DATA(Command):
-    opcode = None
+    opcode = new_opcode()
+    nargs = 2
 
     def __repr__(self):
         return f"reading {self.size} bytes from 0x{self.src:08x}"
@@ -480,8 +819,32 @@ class READ_DATA(Command):
         self.data = data  # HACK only used for simulation
         self._file = _file
 
-    def ser(self):
-        return []
+    def ser(self, code):
+        # The expected data and output file only matter in simulation
+        return code.op(READ_DATA, self.src, self.size)
+
+    @classmethod
+    def deser(cls, args, code):
+        src, size = args
+        return cls(src, size, None)
+
+    def pack(self):
+        return self.src, 0, self.size, self.data, self._file
+
+    @classmethod
+    def unpack(cls, addr, data, size, payload, label):
+        return cls(addr, size, payload, _file=label)
+
+    @classmethod
+    def from_layout(cls, layout, data, chunk=0, _file=None):
+        """Reads back what `layout` keeps, with `data` the expected
+        contents. Striped streams are read into one file per
+        sub-stream, `_file`.0, `_file`.1, ..."""
+        parts = layout.parts(data, chunk)
+        return CommandBuffer([
+            cls(addr, part.nbytes, part, _file=_file if len(parts) == 1 or _file is None else f"{_file}.{j}")
+            for j, (addr, part) in enumerate(parts)
+        ])
 
     def sim(self, tester):
         tester.print(f"{self}\n")
@@ -518,118 +881,174 @@ class READ_DATA(Command):
             # tester.expect(tester._circuit.soc_data_rd_data, self.data[k:k + 8])  # noqa
             tester.file_write(outfile, tester._circuit.soc_data_rd_data)
 
+    def emulate(self, model):
+        model.read_data(self.src, self.size, self.data)
+
+    def define(self, _globals):
+        array_id = f"data_{new_id()}"
+        _globals['src'].append(f"uint64_t {array_id}[{self.size//8}];")
+        _globals['ids'].append(array_id)
+        return array_id
+
+    def check(self, _globals, output):
+        """C that checks the low bytes of the 16-bit words at `output`
+        against the expected data on the M3 instead of printing them,
+        see CHECK_RUNTIME. In "gold" mode the expected data is linked
+        into the image, in "crc" mode only the CRC-32 of its low bytes
+        is."""
+        gold = np.ascontiguousarray(self.data).view(np.uint8).ravel()[:self.size]
+        n = len(gold) // 2
+        crc = zlib.crc32(gold[:2 * n:2].tobytes())
+
+        gold_id = "0"
+        if _globals['check'] == "gold":
+            gold_id = f"gold_{new_id()}"
+            words = np.zeros(-(-len(gold) // 8), dtype=np.uint64)
+            words.view(np.uint8)[:len(gold)] = gold
+            if _globals.get('blob_dir') is not None:
+                _globals['src'] += [link_blob(gold_id, words, _globals['blob_dir'])]
+            else:
+                _globals['src'] += [HexArray(gold_id, words, const=True)]
+
+        check_id = _globals['checks']
+        _globals['checks'] += 1
+        return f"errors += check_output({check_id}, (const volatile uint64_t*)({output}), (const uint16_t*){gold_id}, {n}, 0x{crc:08x});"
+
+    def compile_async(self, _globals, channel):
+        """Queues the copy out of the global buffer on a DMA channel.
+        Returns the C that starts it, and the C that prints the result
+        once it is done."""
+        array_id = self.define(_globals)
+        start = dma_enqueue(channel, array_id, f"(uint64_t*)(CGRA_DATA_BASE + 0x{self.src:08x})", self.size // 8)
+        if _globals.get('check'):
+            return start, self.check(_globals, array_id)
+        finish = f"""
+        for (size_t k = 0; k < {self.size//8}; k++) {{
+            print_hex64({array_id}[k]);
+        }}
+        """
+        return start, finish
+
     def compile(self, _globals):
         if DMA:
-            array_id = f"data_{new_id()}"
+            array_id = self.define(_globals)
             size = self.size//8
-            _globals['src'].append(f"uint64_t {array_id}[{size}];")
-            _globals['ids'].append(array_id)
             src = []
             if MEMCPY:
                 src.append(f"""
                 aha_memcpy(&({array_id}[0]), (uint64_t*)(CGRA_DATA_BASE + 0x{self.src:08x}), {self.size//8});
                 """)
             else:
-                num_beats = size
-                num_burst_16 = num_beats // 16
-                num_burst_end = num_beats % 16
-                # print(num_beats, num_burst_16, num_burst_end)
-                if num_burst_16 // 256 > 0 :
-                    src.append(f"""
-                    for (size_t k = 0; k < {num_burst_16 // 256}; k++) {{
-                        start_dma1(&({array_id}[k*16*256]), (uint64_t*)(CGRA_DATA_BASE + 0x{self.src:08x} + k*8*16*256), 16, 256);
-                        wait_dma1();
-                    }}
-                    """)
-
-                if num_burst_16 % 256 > 0:
-                    src.append(f"""
-                    start_dma1(&({array_id}[{num_burst_16 // 256}*16*256]), (uint64_t*)(CGRA_DATA_BASE + 0x{self.src:08x} + {num_burst_16 // 256}*8*16*256), 16, {num_burst_16 % 256});
-                    wait_dma1();
-                    """)
-
-                if num_burst_end > 0:
-                    src.append(f"""
-                    start_dma1(&({array_id}[{num_beats - num_burst_end}]), (uint64_t*)(CGRA_DATA_BASE + 0x{self.src:08x} + {num_beats - num_burst_end}*8), {num_burst_end}, 1);
-                    wait_dma1();
-                    """)
-
-            src.append(f"""
-            for (size_t k = 0; k < {self.size//8}; k++) {{
-                print_hex64({array_id}[k]);
-            }}
-            """)
+                src.append(f"""
+                dma_copy(1, &({array_id}[0]), (const uint64_t*)(CGRA_DATA_BASE + 0x{self.src:08x}), {size});
+                """)
+
+            if _globals.get('check'):
+                src.append(self.check(_globals, array_id))
+            else:
+                src.append(f"""
+                for (size_t k = 0; k < {self.size//8}; k++) {{
+                    print_hex64({array_id}[k]);
+                }}
+                """)
 
             return "\n".join(src)
+        elif _globals.get('check'):
+            # Checked straight out of the global buffer
+            return self.check(_globals, f"CGRA_DATA_BASE + 0x{self.src:08x}")
         else:
-            src = []
-            for k in range(0, self.size, 8):
-                src.append(f"print_hex64(*(volatile uint64_t*)(CGRA_DATA_BASE + 0x{self.src + k:08x}));")
-            return "\n".join(src)
+            src = format_hex(
+                np.arange(self.src, self.src + self.size, 8),
+                digits=8,
+                prefix="print_hex64(*(volatile uint64_t*)(CGRA_DATA_BASE + 0x",
+                sep="));\n",
+            )
+            return src + "));" if src else ""
 
     @staticmethod
     def interpret():
         return """
-        // memcpy(ARG_1, ARG_2, ARG_3);
+        for (size_t k = 0; k < ARG_2; k += 8) {
+            print_hex64(*(volatile uint64_t*)(CGRA_DATA_BASE + ARG_1 + k));
+        }
         """
 
 
-# TODO: this should probably be collapsed into wait by making the
-# interrupt handler permanent.
+# The CGRA interrupt is handled by the permanent dispatcher in
+# CGRA_RUNTIME, so PEND only documents which interrupt a WAIT is for.
 class PEND(Command):
-    opcode = None
+    opcode = new_opcode()
+    nargs = 1
 
     def __init__(self, mask, sem_id):
         self.mask = mask
+        # Only a label for the model, it isn't encoded
         self.sem_id = f"sem_{sem_id}"
 
-    def ser(self):
-        return []
+    def ser(self, code):
+        return code.op(PEND, self.mask)
+
+    @classmethod
+    def deser(cls, args, code):
+        mask, = args
+        return cls(mask, f"{mask:b}")
+
+    def pack(self):
+        return 0, self.mask, 0, None, self.sem_id
+
+    @classmethod
+    def unpack(cls, addr, data, size, payload, label):
+        cmd = cls.__new__(cls)
+        cmd.mask = data
+        cmd.sem_id = label
+        return cmd
 
     def sim(self, tester):
         pass
 
+    def emulate(self, model):
+        model.pend(self.mask, self.sem_id)
+
     def compile(self, _globals):
-        wait_id = f"wait_{new_id()}"
-
-        # TODO: just resets the interrupt status register for now,
-        # should tie to event and semaphores better. Needs to compare
-        # to make sure that the status is what we are expecting if we
-        # want to update this semaphore, and not block other
-        # interrupts like if we want to wait for config but there is a
-        # done signal that comes through. Also should install the
-        # interrupt handler prior to starting the application,
-        # probably.
-        _globals['src'].append(f"""
-        volatile uint32_t {self.sem_id} = 0;
-
-        void {wait_id}(void) {{
-            printf("Hello from {wait_id}!\\n");
-            *(volatile uint32_t*)(CGRA_REG_BASE + 0x{INTERRUPT_STATUS_REG:x}) = *(volatile uint32_t*)(CGRA_REG_BASE + 0x{INTERRUPT_STATUS_REG:x});
-            {self.sem_id} += 1;
-            __SEV();
-        }}
-        """)
+        return ""
 
-        return f"*(interrupt_handler_t*)(112) = &{wait_id};"
+    @staticmethod
+    def interpret():
+        return ""
 
 
 
 class WAIT(Command):
     opcode = new_opcode()
+    nargs = 1
 
     def __init__(self, mask, sem_id):
         # TODO: should take an enum instead of a mask
         self.mask = mask
-        # HACK: remove this for real semaphores
+        # Only a label, the semaphore is the INTERRUPT_STATUS bit
         self.sem_id = f"sem_{sem_id}"
 
-    def ser(self):
-        return []
+    def ser(self, code):
+        return code.op(WAIT, self.mask)
+
+    @classmethod
+    def deser(cls, args, code):
+        mask, = args
+        return cls(mask, f"{mask:b}")
+
+    def pack(self):
+        return 0, self.mask, 0, None, self.sem_id
+
+    @classmethod
+    def unpack(cls, addr, data, size, payload, label):
+        cmd = cls.__new__(cls)
+        cmd.mask = data
+        cmd.sem_id = label
+        return cmd
 
     def sim(self, tester):
         # HACK: assumes that the correct interrupt is coming, doesn't
-        # handle out of order interrupts.
+        # handle out of order interrupts like cgra_wait does.
 
         # for waiting on the interrupt from the cgra, the port will go
         # high and stay high. you need to write a 1 to toggle the
@@ -648,147 +1067,788 @@ class WAIT(Command):
         # TODO: clean way of clearing interrupts is reading it and then writing that value back
         WRITE_REG(INTERRUPT_STATUS_REG, self.mask).sim(tester)
 
-    def compile(self, _globals):
-        # if self.mask == 0b01:
-        #     return f"""
-        #     for (int k = 0; k < 100000; k++);
-        #     while (!{self.sem_id}) {{
-        #         if (*(volatile uint32_t*)(CGRA_REG_BASE + 0x{INTERRUPT_STATUS_REG:x})) {{
-        #             printf("INTERRUPT_STATUS went high but semaphore wasn't signaled.\\n");
-        #             break;
-        #         }}
-        #         if (*(volatile uint32_t*)(CGRA_REG_BASE + 0x{CGRA_START_REG:x}) == 0) {{
-        #             printf("CGRA_START went low but semaphore wasn't signaled.\\n");
-        #             break;
-        #         }}
-        #     }}
-        #     """
-        # else:
-        #     return f"""
-        #     for (int k = 0; k < 100000; k++);
-        #     while (!{self.sem_id}) {{
-        #         if (*(volatile uint32_t*)(CGRA_REG_BASE + 0x{INTERRUPT_STATUS_REG:x})) {{
-        #             printf("INTERRUPT_STATUS went high but semaphore wasn't signaled.\\n");
-        #             break;
-        #         }}
-        #         if (*(volatile uint32_t*)(CGRA_REG_BASE + 0x{CONFIG_START_REG:x}) == 0) {{
-        #             printf("CONFIG_START went low but semaphore wasn't signaled.\\n");
-        #             break;
-        #         }}
-        #     }}
-        #     """
-
-        return f"""
-        while (!{self.sem_id}) {{
-            __WFE(); // wait for event
-        }}
-        // TODO: should disable interrupts around this decrement
-        {self.sem_id} -= 1;
-        """
+    def emulate(self, model):
+        model.wait(self.mask, self.sem_id)
 
+    def compile(self, _globals):
+        return f"cgra_wait(0b{self.mask:b});"
 
     @staticmethod
     def interpret():
-        pass
+        return """
+        cgra_wait(ARG_1);
+        """
 
 
 class PRINT(Command):
-    opcode = None
+    opcode = new_opcode()
+    nargs = 1
 
     def __init__(self, string):
         self.string = string
 
+    def ser(self, code):
+        return code.op(PRINT, code.string(self.string))
+
+    @classmethod
+    def deser(cls, args, code):
+        return cls(code.string_at(args[0]))
+
+    def pack(self):
+        return 0, 0, 0, None, self.string
+
+    @classmethod
+    def unpack(cls, addr, data, size, payload, label):
+        return cls(label)
+
     def sim(self, tester):
         tester.print(self.string + "\\n")
 
+    def emulate(self, model):
+        model.print(self.string)
+
     def compile(self, _globals):
         return f'printf("{self.string}\\n");'
 
+    @staticmethod
+    def interpret():
+        return """
+        printf("%s\\n", (const char*)(DATA + ARG_1));
+        """
+
 
 class STALL(Command):
-    opcode = None
+    opcode = new_opcode()
+    nargs = 1
 
     def __init__(self, cycles):
         self.cycles = cycles
 
+    def ser(self, code):
+        return code.op(STALL, self.cycles)
+
+    def pack(self):
+        return 0, self.cycles, 0, None, None
+
+    @classmethod
+    def unpack(cls, addr, data, size, payload, label):
+        return cls(data)
+
     def sim(self, tester):
         tester.zero_inputs()
         loop = tester.loop(self.cycles)
         loop.step(2)
 
+    def emulate(self, model):
+        model.stall(self.cycles)
+
     def compile(self, _globals):
         # TODO: try to wait for some number of cycles on the M3?
         return f'printf("{self.cycles}\\n");'
 
+    @staticmethod
+    def interpret():
+        return """
+        for (volatile uint32_t k = 0; k < ARG_1; k++) {}
+        """
+
+
+class REPEAT(Command):
+    """Runs `body` `count` times."""
+
+    opcode = new_opcode()
+    nargs = 2
+
+    def __repr__(self):
+        return f"repeating {len(self.body)} commands {self.count} times"
+
+    def __init__(self, count, body):
+        self.count = count
+        self.var = LoopVar(f"k{new_id()}", count)
+        self.body = flatten(body)
+
+    def pack(self):
+        # Loops stay objects inside a CommandBuffer
+        return None
+
+    def bind(self, env):
+        loop = copy.copy(self)
+        loop.body = [command.bind(env) for command in self.body]
+        return loop
+
+    def expand(self):
+        for k in range(self.count):
+            for command in self.body:
+                yield from expand([command.bind({self.var: k})])
+
+    def ser(self, code):
+        # REPEAT count, skip, body..., ENDREPEAT, where skip is the
+        # number of words to jump over when count is 0.
+        code.push_loop(self.var)
+        body = [word for command in self.body for word in command.ser(code)]
+        code.loops.pop()
+        body += code.op(ENDREPEAT)
+        return code.op(REPEAT, self.count, len(body)) + body
+
+    @classmethod
+    def deser(cls, args, code):
+        # The decoder fills in the body
+        count, _ = args
+        loop = cls.__new__(cls)
+        loop.count = count
+        loop.var = LoopVar(f"k{new_id()}", count)
+        loop.body = []
+        return loop
+
+    def sim(self, tester):
+        loop = tester.loop(self.count)
+        for command in self.body:
+            command.bind({self.var: loop.index}).sim(loop)
+
+    def emulate(self, model):
+        for command in self.expand():
+            model.emulate(command)
+
+    def compile(self, _globals):
+        body = "\n".join(command.compile(_globals) for command in self.body)
+        return f"""
+        for (uint32_t {self.var.name} = 0; {self.var.name} < {self.count}; {self.var.name}++) {{
+            {body}
+        }}
+        """
+
+    @staticmethod
+    def interpret():
+        return """
+        if (ARG_1 == 0) {
+            PC += ARG_2;
+        } else if (depth == MAX_LOOP_DEPTH) {
+            printf("More than %u nested loops\\n", MAX_LOOP_DEPTH);
+            return errors + 1;
+        } else {
+            loop_start[depth] = PC;
+            loop_count[depth] = ARG_1;
+            loop_index[depth] = 0;
+            depth++;
+        }
+        """
+
+
+class ENDREPEAT(Command):
+    """Closes the innermost REPEAT in the bytecode. Only ever produced
+    by REPEAT.ser."""
+
+    opcode = new_opcode()
+
+    @staticmethod
+    def interpret():
+        return """
+        if (++loop_index[depth-1] < loop_count[depth-1]) {
+            PC = loop_start[depth-1];
+        } else {
+            depth--;
+        }
+        """
+
+
+class LOOP(REPEAT):
+    """Runs `body(k)` for k in range(count).
+
+    `body` is called once with the loop variable, and addresses or data
+    of the commands it returns can be affine in it, e.g.
+
+        LOOP(16, lambda i: configure_io(IO_INPUT_STREAM, BANK_ADDR(4) + 32*i, 16))
+    """
+
+    def __repr__(self):
+        return f"looping {len(self.body)} commands over {self.var} in range({self.count})"
+
+    def __init__(self, count, body):
+        self.count = count
+        self.var = LoopVar(f"k{new_id()}", count)
+        self.body = flatten(body(Affine(0, {self.var: 1})))
+
+
+class WRITE_REGS(Command):
+    """A batch of register writes, applied in order.
+
+    The (addr, data) records are a payload like WRITE_DATA's, so the
+    firmware keeps them as one table in the image and applies them with
+    cgra_write_regs() instead of spelling out every store. See
+    batch_writes()."""
+    opcode = new_opcode()
+    nargs = 2
+
+    def __repr__(self):
+        return f"writing {len(self.records)} registers"
+
+    def __init__(self, records):
+        # (addr, data) pairs, truncated to uint32 like the bytecode does
+        records = np.asarray(records, dtype=np.int64) & 0xffffffff
+        self.records = np.ascontiguousarray(records, dtype=np.uint32).reshape(-1, 2)
+
+    def writes(self):
+        return [WRITE_REG(addr, data) for addr, data in self.records.tolist()]
+
+    def ser(self, code):
+        return code.op(WRITE_REGS, code.payload(self.records), len(self.records))
+
+    @classmethod
+    def deser(cls, args, code):
+        offset, n = args
+        return cls(code.payload_at(offset, 8 * n).view(np.uint32))
 
+    def pack(self):
+        return 0, 0, len(self.records), self.records, None
+
+    @classmethod
+    def unpack(cls, addr, data, size, payload, label):
+        return cls(payload.view(np.uint32))
+
+    def sim(self, tester):
+        for command in self.writes():
+            command.sim(tester)
+
+    def emulate(self, model):
+        for addr, data in self.records.tolist():
+            model.write_reg(addr, data)
+
+    def compile(self, _globals):
+        array_id = f"regs_{new_id()}"
+        # Little endian, so each uint64_t is data << 32 | addr
+        _globals['src'] += [HexArray(array_id, self.records.view(np.uint64).ravel(), const=True)]
+        return f"cgra_write_regs((const uint32_t*){array_id}, {len(self.records)});"
+
+    @staticmethod
+    def interpret():
+        return """
+        cgra_write_regs((const uint32_t*)(DATA + ARG_1), ARG_2);
+        """
+
+
+def flatten(commands):
+    return list(iter_flat(commands))
+
+
+def iter_flat(commands):
+    """flatten() one command at a time, for schedules that are
+    generated as they are consumed."""
+    for command in commands:
+        if isinstance(command, (list, tuple, CommandBuffer)):
+            yield from iter_flat(command)
+        else:
+            yield command
+
+
+def expand(commands):
+    """Iterates over `commands` with every REPEAT/LOOP unrolled, for
+    consumers that need the flat stream."""
+    for command in commands:
+        if isinstance(command, REPEAT):
+            yield from command.expand()
+        else:
+            yield command
+
+
+# Everything the interpreter can run, in opcode order. LOOP shares
+# the REPEAT opcode.
 ops = [
     NOP,
     WRITE_REG,
+    READ_REG,
     WRITE_DATA,
+    READ_DATA,
+    PEND,
+    WAIT,
+    PRINT,
+    STALL,
+    REPEAT,
+    ENDREPEAT,
+    WRITE_REGS,
 ]
 
 
-def configure_io(mode, addr, size, io_ctrl=None, mask=None, num_active=None, num_inactive=None, width=32):
-    bank_size = 2**17
+# Every command that can be stored in a CommandBuffer. The index into
+# this list is the `opcode` column of the buffer.
+kinds = [
+    NOP,
+    WRITE_REG,
+    READ_REG,
+    WRITE_DATA,
+    READ_DATA,
+    PEND,
+    WAIT,
+    PRINT,
+    STALL,
+    REPEAT,
+    LOOP,
+    WRITE_REGS,
+]
+
+
+class CommandBuffer:
+    """Columnar storage for a list of commands.
+
+    Each command is one row of a structured array. Payloads
+    (WRITE_DATA/READ_DATA arrays) are copied into a single shared byte
+    arena and rows point into it with an offset, so a bitstream with a
+    million config words is a couple of numpy arrays instead of two
+    million Python objects. Strings (PRINT messages, semaphore ids,
+    output files) are rare and live in a side table keyed by row.
+
+    Iterating yields ordinary Command objects one at a time, so
+    `create_testbench`, `create_straightline_code` and `test.py` work
+    on a buffer the same way they work on a list.
+    """
+
+    dtype = np.dtype([
+        ('opcode', np.uint8),
+        ('addr', np.int64),
+        ('data', np.int64),
+        ('size', np.uint64),
+        ('offset', np.int64),
+        ('nbytes', np.uint64),
+    ])
+
+    # Rows appended one at a time are staged in a plain list and only
+    # moved into the array in blocks of this many.
+    flush_size = 4096
+
+    def __init__(self, commands=()):
+        # Zero-length arrays are never written to, so they can be
+        # shared until the first flush replaces them.
+        self._rows = CommandBuffer._no_rows
+        self._len = 0
+        self._pending = []
+        self._arena = CommandBuffer._no_arena
+        self._arena_len = 0
+        self.labels = {}
+        if commands:
+            self += commands
+
+    def __len__(self):
+        return self._len + len(self._pending)
+
+    def __repr__(self):
+        return f"CommandBuffer({len(self)} commands, {self._arena_len} payload bytes)"
+
+    @property
+    def rows(self):
+        self._flush()
+        return self._rows[:self._len]
+
+    @property
+    def arena(self):
+        return self._arena[:self._arena_len]
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self._arena_len
+
+    def _flush(self):
+        if self._pending:
+            n = len(self._pending)
+            self._reserve_rows(n)
+            self._rows[self._len:self._len + n] = self._pending
+            self._len += n
+            self._pending = []
+
+    def _reserve_rows(self, n):
+        if self._len + n > len(self._rows):
+            rows = np.empty(max(2 * len(self._rows), self._len + n), dtype=self.dtype)
+            rows[:self._len] = self._rows[:self._len]
+            self._rows = rows
+
+    def _reserve_arena(self, n):
+        # Old views into the arena stay valid since we never resize in
+        # place, the previous array is just left to the views holding it.
+        if self._arena_len + n > len(self._arena):
+            arena = np.empty(max(2 * len(self._arena), self._arena_len + n), dtype=np.uint8)
+            arena[:self._arena_len] = self._arena[:self._arena_len]
+            self._arena = arena
+
+    def _store(self, payload):
+        payload = np.ascontiguousarray(payload).view(np.uint8).ravel()
+        # Keep payloads 8-byte aligned so they can be viewed as uint64
+        start = (self._arena_len + 7) & ~7
+        self._reserve_arena(start - self._arena_len + len(payload))
+        self._arena[start:start + len(payload)] = payload
+        self._arena_len = start + len(payload)
+        return start, len(payload)
+
+    def append(self, command):
+        fields = command.pack()
+        if fields is None or any(isinstance(field, Affine) for field in fields[:3]):
+            # Loops, and commands inside loop bodies that depend on the
+            # loop variable, don't fit in the columns and are kept as
+            # objects in the side table.
+            self.labels[len(self)] = command
+            self._pending.append((kinds.index(type(command)), 0, 0, 0, -1, 0))
+            return
+
+        addr, data, size, payload, label = fields
+        offset, nbytes = -1, 0
+        if payload is not None:
+            offset, nbytes = self._store(payload)
+
+        if label is not None:
+            self.labels[len(self)] = label
+        self._pending.append((kinds.index(type(command)), addr, data, size, offset, nbytes))
+        if len(self._pending) >= self.flush_size:
+            self._flush()
+
+    def extend(self, commands):
+        if not isinstance(commands, CommandBuffer):
+            # Nested buffers (e.g. from configure_io) are spliced in
+            # without going through Command objects.
+            for command in commands:
+                if isinstance(command, CommandBuffer):
+                    self.extend(command)
+                else:
+                    self.append(command)
+            return
+
+        other = commands
+        if other.labels:
+            n = len(self)
+            for k, label in other.labels.items():
+                self.labels[k + n] = label
+
+        if other._len == 0 and other._arena_len == 0:
+            # Small buffers without payloads only have staged rows
+            self._pending += other._pending
+            if len(self._pending) >= self.flush_size:
+                self._flush()
+            return
+
+        self._flush()
+        rows = other.rows
+        if other._arena_len:
+            rows = rows.copy()
+            start = (self._arena_len + 7) & ~7
+            self._reserve_arena(start - self._arena_len + other._arena_len)
+            self._arena[start:start + other._arena_len] = other.arena
+            self._arena_len = start + other._arena_len
+            rows['offset'][rows['offset'] >= 0] += start
+
+        self._reserve_rows(len(rows))
+        self._rows[self._len:self._len + len(rows)] = rows
+        self._len += len(rows)
+
+    def __iadd__(self, commands):
+        self.extend(commands)
+        return self
+
+    def __add__(self, commands):
+        buf = CommandBuffer(self)
+        buf += commands
+        return buf
+
+    def payload(self, k):
+        offset, nbytes = self.rows[['offset', 'nbytes']][k].tolist()
+        if offset < 0:
+            return None
+        return self._arena[offset:offset + nbytes]
+
+    def __getitem__(self, k):
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError("CommandBuffer index out of range")
+        if isinstance(self.labels.get(k), Command):
+            return self.labels[k]
+        opcode, addr, data, size, _, _ = self.rows[k].tolist()
+        return kinds[opcode].unpack(
+            addr,
+            data,
+            size,
+            self.payload(k),
+            self.labels.get(k),
+        )
+
+    def __iter__(self):
+        rows = self.rows
+        for start in range(0, len(rows), self.flush_size):
+            block = rows[start:start + self.flush_size].tolist()
+            for k, (opcode, addr, data, size, offset, nbytes) in enumerate(block, start):
+                if isinstance(self.labels.get(k), Command):
+                    yield self.labels[k]
+                    continue
+                yield kinds[opcode].unpack(
+                    addr,
+                    data,
+                    size,
+                    None if offset < 0 else self._arena[offset:offset + nbytes],
+                    self.labels.get(k),
+                )
+
+    def runs(self):
+        """Yields (cls, start, stop) for each run of the same command."""
+        opcodes = self.rows['opcode']
+        bounds = [0, *(np.flatnonzero(np.diff(opcodes)) + 1).tolist(), len(opcodes)]
+        for start, stop in zip(bounds, bounds[1:]):
+            if start < stop:
+                yield kinds[opcodes[start]], start, stop
+
+    def ser(self, code):
+        # Only rows kept as objects (loops, affine writes) have to go
+        # through Command.ser, other labels are strings of PRINTs etc.
+        objects = np.array(sorted(k for k, label in self.labels.items() if isinstance(label, Command)), dtype=np.int64)
+        words = []
+        for cls, start, stop in self.runs():
+            if cls is WRITE_REG and np.searchsorted(objects, start) == np.searchsorted(objects, stop):
+                # Register writes make up almost everything, serialize
+                # them as a block instead of one object at a time.
+                rows = self.rows[start:stop]
+                block = np.empty((stop - start, 3), dtype=np.int64)
+                block[:, 0] = WRITE_REG.opcode
+                block[:, 1] = rows['addr']
+                block[:, 2] = rows['data']
+                words += (block.ravel() & 0xffffffff).tolist()
+            else:
+                for k in range(start, stop):
+                    words += self[k].ser(code)
+        return words
+
+    def save(self, f):
+        """Writes the buffer to `f` (a path or file object) as an .npz
+        of its columns, arena and labels. Buffers holding loops can't
+        be saved, their bodies are Python functions."""
+        if any(isinstance(label, Command) for label in self.labels.values()):
+            raise TypeError("CommandBuffers with LOOPs in them can't be saved.")
+        np.savez(
+            f,
+            rows=self.rows,
+            arena=self.arena,
+            labels=np.array(json.dumps({str(k): label for k, label in self.labels.items()})),
+        )
+
+    @classmethod
+    def load(cls, f):
+        """Reads a buffer written by save()."""
+        with np.load(f) as npz:
+            buf = cls()
+            # Both are replaced, never written in place, once the
+            # buffer grows
+            buf._rows = npz['rows']
+            buf._len = len(buf._rows)
+            buf._arena = npz['arena']
+            buf._arena_len = len(buf._arena)
+            buf.labels = {int(k): label for k, label in json.loads(str(npz['labels'])).items()}
+        return buf
+
+    @staticmethod
+    def from_writes(addrs, datas):
+        """Builds a buffer of WRITE_REGs from sequences of addresses and data."""
+        buf = CommandBuffer()
+        opcode = kinds.index(WRITE_REG)
+        if len(addrs) < CommandBuffer.flush_size:
+            if any(isinstance(x, Affine) for x in (*addrs, *datas)):
+                return CommandBuffer(map(WRITE_REG, addrs, datas))
+            buf._pending = [(opcode, addr, data, 0, -1, 0) for addr, data in zip(addrs, datas)]
+            return buf
+
+        buf._reserve_rows(len(addrs))
+        rows = buf._rows[:len(addrs)]
+        rows['opcode'] = opcode
+        rows['addr'] = addrs
+        rows['data'] = datas
+        rows['size'] = 0
+        rows['offset'] = -1
+        rows['nbytes'] = 0
+        buf._len = len(addrs)
+        return buf
+
+
+CommandBuffer._no_rows = np.empty(0, dtype=CommandBuffer.dtype)
+CommandBuffer._no_arena = np.empty(0, dtype=np.uint8)
+
+
+def configure_io(mode, addr, size, io_ctrl=None, mask=None, num_active=None, num_inactive=None, width=32, chunk=0):
+    # `addr` can also be a Layout, which knows its own controllers and
+    # masks
+    if isinstance(addr, Layout):
+        return addr.configure(mode, size, chunk=chunk, num_active=num_active, num_inactive=num_inactive)
 
     # 1 IO Controller per 4 Tile Width
     num_io_controllers = width // 4
 
+    # Inside a LOOP the address can depend on the loop variable. The
+    # controller and mask are only computed once, so every iteration
+    # has to land in the same banks.
+    bank_addr = addr
+    if isinstance(addr, Affine):
+        lo, hi = addr.bounds()
+        if (lo >> 17) != (hi >> 17) or (lo+size >> 17) != (hi+size >> 17):
+            raise NotImplementedError("Looped IO addresses must stay within the same banks.")
+        bank_addr = lo
+
     # Bank number is top 5 bits of 22-bit address
-    lo_bank_num = (addr >> 17) & 0b11111
+    bank_addr %= GB_BANKS * GB_BANK_SIZE
+    lo_bank_num = bank_addr // GB_BANK_SIZE
 
     # There are always 32 banks of memory
-    banks_per_io_controller = 32 // num_io_controllers
+    banks_per_io_controller = GB_BANKS // num_io_controllers
 
     if io_ctrl is None:
         # Figure out which IO Controller handles this bank
         io_ctrl = lo_bank_num // banks_per_io_controller
 
     if mask is None:
-        if (io_ctrl + 1) * banks_per_io_controller - 1 < lo_bank_num:
-            # print(f"IO controller {io_ctrl} is smaller than specified address, special case.")
-            # print((io_ctrl + 1) * banks_per_io_controller - 1)
-            # print(lo_bank_num)
-            mask = 0b1000
-        else:
-            # We use the size to compute how many banks we need
-            # control over and set the rest to 0. This can be
-            # overridden by manually specifying the mask in the
-            # function arguments.
-            hi_bank_num = (addr+size >> 17) & 0b11111
-
-            # Compute the mask
-            mask_start = lo_bank_num % banks_per_io_controller
-            mask_end = hi_bank_num % banks_per_io_controller
-
-            mask = 0
-            for k in range(mask_start, mask_end+1):
-                mask |= 1 << k
+        # Only the banks the `size` words touch are switched in, this
+        # can be overridden by manually specifying the mask.
+        mask = switch_mask(io_ctrl, bank_addr, 2 * size, width)
 
     # print(f"Configuring io controller {io_ctrl} with mask 0b{mask:04b}:")
     # print(f"    ADDR: 0x{addr:x}")
     # print(f"    SIZE: 0x{size:x}")
 
-    cmds = [
-        WRITE_REG(IO_MODE_REG(io_ctrl), mode),
-        WRITE_REG(IO_ADDR_REG(io_ctrl), addr),
-        WRITE_REG(IO_SIZE_REG(io_ctrl), size),
-        WRITE_REG(IO_SWITCH_REG(io_ctrl), mask),
+    regs = [
+        (IO_MODE_REG(io_ctrl), mode),
+        (IO_ADDR_REG(io_ctrl), addr),
+        (IO_SIZE_REG(io_ctrl), size),
+        (IO_SWITCH_REG(io_ctrl), mask),
     ]
 
     if num_active is not None:
         if num_inactive is None:
             raise NotImplementedError("num_inactive must be specified if num_active is not None.")
-        cmds += [
-            WRITE_REG(IO_NUM_ACTIVE_REG(io_ctrl), num_active),
-            WRITE_REG(IO_NUM_INACTIVE_REG(io_ctrl), num_inactive),
+        regs += [
+            (IO_NUM_ACTIVE_REG(io_ctrl), num_active),
+            (IO_NUM_INACTIVE_REG(io_ctrl), num_inactive),
         ]
 
-    return cmds
+    return CommandBuffer.from_writes(*zip(*regs))
+
+
+def stripe(data, n):
+    """Splits a stream into `n` interleaved sub-streams, word k going
+    to sub-stream k % n, one per IO controller of a striped stream."""
+    data = np.asarray(data)
+    if len(data) % n:
+        raise ValueError(f"Can't stripe {len(data)} words evenly across {n} IO controllers.")
+    return [np.ascontiguousarray(data[j::n]) for j in range(n)]
+
+
+def unstripe(parts):
+    """Interleaves the sub-streams from stripe() back into one."""
+    data = np.empty(sum(len(part) for part in parts), dtype=parts[0].dtype)
+    for j, part in enumerate(parts):
+        data[j::len(parts)] = part
+    return data
+
+
+def configure_striped_io(mode, addrs, size, io_ctrls, masks=None, num_active=None, num_inactive=None, width=32):
+    """configure_io() for a stream of `size` words striped across the
+    IO controllers `io_ctrls`, sub-stream j at `addrs[j]`. The active
+    and inactive cycles are split the same way, so each has to divide
+    evenly."""
+    n = len(io_ctrls)
+    if masks is None:
+        masks = [None] * n
+    for name, value in [("size", size), ("num_active", num_active), ("num_inactive", num_inactive)]:
+        if value is not None and value % n:
+            raise ValueError(f"Can't stripe {name} {value} evenly across {n} IO controllers.")
+
+    return CommandBuffer([
+        configure_io(
+            mode, addr, size // n,
+            io_ctrl=io_ctrl,
+            mask=mask,
+            num_active=None if num_active is None else num_active // n,
+            num_inactive=None if num_inactive is None else num_inactive // n,
+            width=width,
+        )
+        for addr, io_ctrl, mask in zip(addrs, io_ctrls, masks)
+    ])
+
+
+def gb_banks(addr, nbytes):
+    return list(range(addr // GB_BANK_SIZE, (addr + max(nbytes, 1) - 1) // GB_BANK_SIZE + 1))
+
+
+def switch_mask(io_ctrl, addr, nbytes, width=32):
+    """Switch bits IO (or FR) controller `io_ctrl` needs to reach
+    [addr, addr + nbytes). Bit k hands the controller bank k of its
+    group, and the last bit also reaches every bank after it."""
+    first = io_ctrl * (GB_BANKS // (width // 4))
+    mask = 0
+    for bank in gb_banks(addr, nbytes):
+        if bank < first:
+            raise ValueError(f"IO controller {io_ctrl} can't reach bank {bank}.")
+        mask |= 1 << min(bank - first, 3)
+    return mask
+
+
+GB_LAYOUTS = ["contiguous", "interleaved", "striped"]
+
+
+class Layout(namedtuple("Layout", ["kind", "addrs", "nbytes", "io_ctrls", "masks"])):
+    """Where a stream lives in the global buffer, and which IO
+    controllers and switch masks reach it. One of GB_LAYOUTS:
+
+    contiguous   `nbytes` at addrs[0], streamed by io_ctrls[0].
+    interleaved  Chunk k of a stream (a tile, a frame, ...) of `nbytes`
+                 at addrs[k % len(addrs)], each address in its own
+                 bank, so that the chunk being written and the one
+                 being streamed are never in the same SRAM bank. One
+                 controller, with a mask that reaches all of them.
+    striped      Word k at sub-stream k % len(addrs), see stripe(), with
+                 sub-stream j of `nbytes` at addrs[j] streamed by
+                 io_ctrls[j].
+
+    configure_io(), WRITE_DATA.from_layout() and READ_DATA.from_layout()
+    all take a Layout in place of an address.
+    """
 
+    @classmethod
+    def contiguous(cls, addr, nbytes, io_ctrl=None, mask=None, width=32):
+        if io_ctrl is None:
+            io_ctrl = addr // GB_BANK_SIZE // (GB_BANKS // (width // 4))
+        if mask is None:
+            mask = switch_mask(io_ctrl, addr, nbytes, width)
+        return cls("contiguous", (addr,), nbytes, (io_ctrl,), (mask,))
+
+    @classmethod
+    def interleaved(cls, addrs, nbytes, io_ctrl, width=32):
+        banks = [gb_banks(addr, nbytes) for addr in addrs]
+        if any(len(b) != 1 for b in banks) or len({b[0] for b in banks}) != len(banks):
+            raise ValueError("Every chunk of an interleaved layout needs a bank of its own.")
+        mask = 0
+        for addr in addrs:
+            mask |= switch_mask(io_ctrl, addr, nbytes, width)
+        return cls("interleaved", tuple(addrs), nbytes, (io_ctrl,), (mask,))
+
+    @classmethod
+    def striped(cls, addrs, nbytes, io_ctrls, masks=None, width=32):
+        if masks is None:
+            masks = [switch_mask(io_ctrl, addr, nbytes, width) for addr, io_ctrl in zip(addrs, io_ctrls)]
+        return cls("striped", tuple(addrs), nbytes, tuple(io_ctrls), tuple(masks))
+
+    def banks(self):
+        return sorted({bank for addr in self.addrs for bank in gb_banks(addr, self.nbytes)})
+
+    def addr(self, chunk=0):
+        if self.kind == "interleaved":
+            return self.addrs[chunk % len(self.addrs)]
+        return self.addrs[0]
+
+    def parts(self, data, chunk=0):
+        """(address, data) for every piece of `data` (chunk `chunk` of
+        an interleaved stream)."""
+        if self.kind == "striped":
+            return list(zip(self.addrs, stripe(data, len(self.addrs))))
+        return [(self.addr(chunk), data)]
+
+    def configure(self, mode, size, chunk=0, num_active=None, num_inactive=None):
+        """configure_io() for `size` words laid out like this."""
+        if self.kind == "striped":
+            return configure_striped_io(mode, self.addrs, size, self.io_ctrls, self.masks,
+                                        num_active=num_active, num_inactive=num_inactive)
+        return configure_io(mode, self.addr(chunk), size, io_ctrl=self.io_ctrls[0], mask=self.masks[0],
+                            num_active=num_active, num_inactive=num_inactive)
 
 
-# TODO: make this distribute the bitstream across the global buffer
 def configure_fr(addr, size, fr_ctrl=None, mask=None, width=32):
     bank_size = 2**17
 
@@ -827,55 +1887,576 @@ def configure_fr(addr, size, fr_ctrl=None, mask=None, width=32):
     # print(f"    ADDR: 0x{addr:x}")
     # print(f"    SIZE: 0x{size:x}")
 
-    return [
-        WRITE_REG(FR_ADDR_REG(fr_ctrl), addr),
-        WRITE_REG(FR_SIZE_REG(fr_ctrl), size),
-        WRITE_REG(FR_SWITCH_REG(fr_ctrl), mask),
-    ]
+    return CommandBuffer.from_writes(
+        [FR_ADDR_REG(fr_ctrl), FR_SIZE_REG(fr_ctrl), FR_SWITCH_REG(fr_ctrl)],
+        [addr, size, mask],
+    )
+
+
+def reset_commands(previous=None, width=32):
+    """How a schedule starts. Normally with a GLOBAL_RESET, but that
+    clears the CGRA config, so a schedule that only loads the
+    difference from the `previous` bitstream (see load_config) just
+    turns off every IO and FR controller instead."""
+    if previous is None:
+        return CommandBuffer([WRITE_REG(GLOBAL_RESET_REG, 1)])
+    n = width // 4
+    return CommandBuffer.from_writes(
+        [IO_MODE_REG(k) for k in range(n)] + [FR_SIZE_REG(k) for k in range(n)],
+        [0] * (2 * n),
+    )
+
+
+def load_config(filename, previous=None):
+    """Loads the bitstream in `filename` as config writes.
+
+    If `previous` names the bitstream the CGRA is currently configured
+    with, only the words that differ from it are returned, along with
+    resets for the registers it set that `filename` doesn't. This only
+    holds if nothing cleared the config since, in particular no
+    GLOBAL_RESET, so start such schedules with
+    reset_commands(previous).
+    """
+    bitstream = load_bitstream(filename)
+    if previous is not None:
+        bitstream = diff_bitstreams(load_bitstream(previous), bitstream)
+    return bitstream
 
 
-def gc_config_bitstream(filename):
-    commands = []
-    with open(filename, 'r') as f:
-        for line in f:
-            # TODO: might just make this use numpy instead
-            addr, data = (int(x, 16) for x in line.strip().split(' '))
-            commands += [
-                WRITE_REG(CGRA_CONFIG_ADDR_REG, addr),
-                WRITE_REG(CGRA_CONFIG_DATA_REG, data),
-                # WRITE_REG(CGRA_CONFIG_ADDR_REG, addr),
-                # READ_REG(CGRA_CONFIG_DATA_REG, data),
-            ]
-    return commands
+def gc_config_bitstream(filename, previous=None):
+    bitstream = load_config(filename, previous)
+
+    # Each config word turns into
+    #   WRITE_REG(CGRA_CONFIG_ADDR_REG, addr),
+    #   WRITE_REG(CGRA_CONFIG_DATA_REG, data),
+    addrs = np.empty(2 * len(bitstream), dtype=np.uint32)
+    addrs[0::2] = CGRA_CONFIG_ADDR_REG
+    addrs[1::2] = CGRA_CONFIG_DATA_REG
+    return CommandBuffer.from_writes(addrs, bitstream.ravel())
+
 
+def plan_config(bitstream, width=32):
+    """Splits config writes by column group, one slice per FR controller.
 
-def gb_config_bitstream(filename, width=8):
-    # TODO: only writes things to address 0 for now
-    commands = []
-    with open(filename, 'r') as f:
-        bitstream = []
-        for line in f:
-            # TODO: might just make this use numpy instead
-            addr, data = (int(x, 16) for x in line.strip().split(' '))
-            bitstream += [data, addr]
+    FR controller n handles columns 4n to 4n+3, so its slice is placed
+    at the start of the banks it owns. Returns a list of
+    (fr_ctrl, addr, words, mask) with the words as 64-bit {addr, data},
+    leaving out controllers with nothing to write.
+    """
+    num_fr_controllers = width // 4
+    banks_per_fr_controller = 32 // num_fr_controllers
+    bank_size = 2**17
+
+    x, _, _, _ = decode_config_addr(bitstream[:, 0])
+    group = np.minimum(x // 4, num_fr_controllers - 1)
+
+    # Stable, so writes keep their order within a column group
+    order = np.argsort(group, kind="stable")
+    words = np.ascontiguousarray(bitstream[order][:, ::-1]).view(np.uint64).ravel()
+    bounds = np.searchsorted(group[order], np.arange(num_fr_controllers + 1))
+
+    plan = []
+    for fr_ctrl in range(num_fr_controllers):
+        chunk = words[bounds[fr_ctrl]:bounds[fr_ctrl + 1]]
+        if len(chunk) == 0:
+            continue
 
-        bitstream = np.array(bitstream, dtype=np.uint32).view(np.uint64)
+        num_banks = (chunk.nbytes + bank_size - 1) // bank_size
+        if num_banks > banks_per_fr_controller:
+            raise ValueError(
+                f"Column group {fr_ctrl} has {len(chunk)} config words, more than the "
+                f"{banks_per_fr_controller} banks of FR controller {fr_ctrl} can hold."
+            )
+
+        # Switch bit k hands the controller bank k of its group, the
+        # last one also reaches every bank after it.
+        mask = (1 << min(num_banks, 4)) - 1
+        plan.append((fr_ctrl, BANK_ADDR(fr_ctrl * banks_per_fr_controller), chunk, mask))
+    return plan
+
+
+def gb_config_bitstream(filename, width=8, previous=None, parallel=True):
+    commands = CommandBuffer()
+
+    bitstream = load_config(filename, previous)
+    if len(bitstream) == 0:
+        return commands
+
+    if parallel:
+        plan = plan_config(bitstream, width=width)
+    else:
+        # Config words are stored as 64-bit {addr, data}
+        words = np.ascontiguousarray(bitstream[:, ::-1]).view(np.uint64).ravel()
+        plan = [(0, 0, words, 0b1111)]
 
-        config_id = f"config_{new_id()}"
+    used = {fr_ctrl for fr_ctrl, _, _, _ in plan}
+    for fr_ctrl, addr, words, mask in plan:
         commands += [
-            WRITE_DATA(0, 0xc0ffee, bitstream.nbytes, bitstream),
-            *configure_fr(0, len(bitstream), mask=0b1111, width=width),
-            PEND(0b10, f"{config_id}"),
-            WRITE_REG(CONFIG_START_REG, 1),
-            WAIT(0b10, f"{config_id}"),
+            WRITE_DATA(addr, 0xc0ffee, words.nbytes, words),
+            configure_fr(addr, len(words), fr_ctrl=fr_ctrl, mask=mask, width=width),
         ]
+    # Controllers left over from the previous config would run again
+    # on CONFIG_START.
+    if parallel:
+        for fr_ctrl in range(width // 4):
+            if fr_ctrl not in used:
+                commands += [WRITE_REG(FR_SIZE_REG(fr_ctrl), 0)]
+
+    config_id = f"config_{new_id()}"
+    commands += [
+        PEND(0b10, f"{config_id}"),
+        WRITE_REG(CONFIG_START_REG, 1),
+        WAIT(0b10, f"{config_id}"),
+    ]
     return commands
 
-def create_command_bitstream(commands):
-     return [arg for command in commands for arg in command.ser()]
+
+# Writes to these registers kick off something in the hardware rather
+# than just holding a value, so they are never redundant.
+TRIGGER_REGS = {
+    GLOBAL_RESET_REG,
+    CGRA_START_REG,
+    CGRA_AUTO_RESTART_REG,
+    CONFIG_START_REG,
+    INTERRUPT_STATUS_REG,  # write 1 to clear
+    CGRA_CONFIG_ADDR_REG,
+    CGRA_CONFIG_DATA_REG,
+}
+
+
+def is_trigger_reg(addr):
+    if addr in TRIGGER_REGS:
+        return True
+    # IO_AUTO_RESTART_REG(n) for any controller
+    return (addr >> 10) == 0b01 and (addr >> 2) & 0b1111 == 8
+
+
+# Shortest run of register writes batch_writes() turns into a WRITE_REGS
+BATCH_MIN_WRITES = 4
+
+
+def batch_writes(commands, min_batch=BATCH_MIN_WRITES):
+    """Turns runs of at least `min_batch` consecutive WRITE_REGs into
+    WRITE_REGS batches, e.g. the 4 to 6 writes of every configure_io.
+
+    Writes that trigger something (see is_trigger_reg) and writes with
+    loop-dependent values stay on their own, so nothing that starts the
+    CGRA, FR or DMA moves into a table. REPEAT bodies are left alone.
+    Returns a new CommandBuffer.
+    """
+    return CommandBuffer(iter_batched(commands, min_batch))
+
+
+def iter_batched(commands, min_batch=BATCH_MIN_WRITES):
+    """batch_writes() as a generator, only the current run of writes
+    is held back."""
+    run = []
+
+    def flush():
+        if len(run) >= min_batch:
+            yield WRITE_REGS([(command.addr, command.data) for command in run])
+        else:
+            yield from run
+        run.clear()
+
+    for command in iter_flat(commands):
+        if (isinstance(command, WRITE_REG)
+                and not isinstance(command.addr, Affine)
+                and not isinstance(command.data, Affine)
+                and not is_trigger_reg(command.addr)):
+            run.append(command)
+            continue
+        yield from flush()
+        yield command
+    yield from flush()
+
+
+def optimize_commands(commands, stats=None):
+    """Peephole pass that drops WRITE_REGs of values a register
+    already holds and merges runs of PRINTs.
+
+    The register file of the global, IO and FR controllers is tracked
+    as it is written. Nothing is ever reordered, so PEND/WAIT and the
+    writes that start the CGRA stay exactly where they were relative to
+    everything else. A GLOBAL_RESET_REG write forgets everything we
+    know, since registers go back to their reset values.
+
+    Returns a new CommandBuffer. If `stats` is a dict it is filled in
+    with how many commands were removed.
+    """
+    return CommandBuffer(iter_optimized(commands, stats))
+
+
+def iter_optimized(commands, stats=None):
+    """optimize_commands() as a generator. Only the pending run of
+    PRINTs is held back, so `commands` can be a generator too and
+    never has to be in memory all at once. `stats` is complete once
+    the generator is exhausted."""
+    if stats is None:
+        stats = {}
+    stats.update(writes_removed=0, prints_merged=0)
+
+    regs = {}
+    prints = []
+
+    def flush_prints():
+        if prints:
+            # PRINT strings are emitted verbatim into C and fault
+            # strings, so join with an escaped newline.
+            stats['prints_merged'] += len(prints) - 1
+            string = "\\n".join(prints)
+            prints.clear()
+            yield PRINT(string)
+
+    for command in iter_flat(commands):
+        if isinstance(command, PRINT):
+            prints.append(command.string)
+            continue
+
+        if isinstance(command, REPEAT):
+            # Whatever the loop body writes is unknown afterwards
+            regs.clear()
+        elif isinstance(command, WRITE_REG):
+            if command.addr == GLOBAL_RESET_REG:
+                regs.clear()
+            elif not is_trigger_reg(command.addr):
+                if regs.get(command.addr) == command.data:
+                    stats['writes_removed'] += 1
+                    continue
+                regs[command.addr] = command.data
+        elif isinstance(command, WRITE_REGS):
+            regs.update(command.records.tolist())
+
+        yield from flush_prints()
+        yield command
+
+    yield from flush_prints()
+
+
+def optimize_report(commands, lazy=False):
+    """optimize_commands() that logs what it removed. With `lazy`,
+    commands are optimized as they are pulled and the log line comes
+    once they have all been seen."""
+    if lazy:
+        return _optimize_report_lazy(commands)
+
+    stats = {}
+    commands = optimize_commands(commands, stats)
+    logging.info(f"Removed {stats['writes_removed']} redundant register writes "
+                 f"and merged {stats['prints_merged']} prints.")
+    return commands
+
+
+def _optimize_report_lazy(commands):
+    stats = {}
+    yield from iter_optimized(commands, stats)
+    logging.info(f"Removed {stats['writes_removed']} redundant register writes "
+                 f"and merged {stats['prints_merged']} prints.")
+
+
+BYTECODE_MAGIC = 0x4c414853  # "SHAL"
+BYTECODE_VERSION = 3
+BYTECODE_HEADER_WORDS = 4
+BYTECODE_MAX_LOOP_DEPTH = 8
+
+
+class Bytecode:
+    """State shared by the commands while they are serialized or
+    deserialized.
+
+    A command blob is a sequence of little endian 32-bit words:
+
+        magic, version, data size (bytes), program size (words),
+        data section..., program...
+
+    Each instruction is one word with the opcode in bits 7:0 and a mask
+    of which arguments are affine in bits 15:8, followed by `nargs`
+    arguments. A plain argument is a single word. An affine one is its
+    base, the number of terms and then a (loop depth, stride) pair per
+    term, which is evaluated against the counters of the enclosing
+    REPEATs. Payloads and strings live in the data section, 8-byte
+    aligned, and are referred to by their offset into it.
+
+    Bump BYTECODE_VERSION whenever any of this or an opcode changes.
+    """
+
+    def __init__(self, data=b""):
+        self.data = bytearray(data)
+        self.loops = []
+
+    def op(self, op, *args):
+        assert len(args) == op.nargs, f"{op.__name__} takes {op.nargs} arguments"
+        words = [op.opcode]
+        for k, arg in enumerate(args):
+            if isinstance(arg, Affine):
+                words[0] |= 1 << (8 + k)
+                words += [arg.base & 0xffffffff, len(arg.terms)]
+                for var, stride in arg.terms.items():
+                    if var not in self.loops:
+                        raise ValueError(f"{var} is used outside of its loop.")
+                    words += [self.loops.index(var), stride & 0xffffffff]
+            else:
+                words.append(int(arg) & 0xffffffff)
+        return words
+
+    def payload(self, payload):
+        payload = np.ascontiguousarray(payload).view(np.uint8).ravel()
+        offset = (len(self.data) + 7) & ~7
+        self.data += bytes(offset - len(self.data))
+        self.data += payload.tobytes()
+        return offset
+
+    def payload_at(self, offset, nbytes):
+        return np.frombuffer(self.data, dtype=np.uint8, count=nbytes, offset=offset)
+
+    def string(self, string):
+        # PRINT strings are written with C escapes, store what printf
+        # would have printed.
+        return self.payload(np.frombuffer(unescape(string).encode() + b"\0", dtype=np.uint8))
+
+    def string_at(self, offset):
+        end = self.data.index(b"\0", offset)
+        return escape(self.data[offset:end].decode())
+
+    def push_loop(self, var):
+        # The interpreter keeps a fixed size stack of loop counters
+        if len(self.loops) == BYTECODE_MAX_LOOP_DEPTH:
+            raise ValueError(f"More than {BYTECODE_MAX_LOOP_DEPTH} nested loops.")
+        self.loops.append(var)
+
+    def pack(self, program):
+        data = self.data + bytes(-len(self.data) % 8)
+        header = [BYTECODE_MAGIC, BYTECODE_VERSION, len(data), len(program)]
+        blob = np.array(header + program, dtype=np.uint32).tobytes()
+        blob = blob[:4*BYTECODE_HEADER_WORDS] + data + blob[4*BYTECODE_HEADER_WORDS:]
+        # Padded so it can be linked in as a uint64_t array
+        return blob + bytes(-len(blob) % 8)
+
+
+def unescape(string):
+    return string.encode("latin-1", "backslashreplace").decode("unicode_escape")
+
+
+def escape(string):
+    return string.encode("unicode_escape").decode("ascii")
+
+
+def decode_command_bitstream(blob):
+    """Turns a blob from create_command_bitstream back into a
+    CommandBuffer. PENDs and WAITs come back labeled with their mask
+    and READ_DATA loses its simulation-only expected data and file."""
+    header = np.frombuffer(blob, dtype="<u4", count=BYTECODE_HEADER_WORDS)
+    magic, version, data_size, program_size = header.tolist()
+    if magic != BYTECODE_MAGIC:
+        raise ValueError(f"Not a command bitstream (magic 0x{magic:08x}).")
+    if version != BYTECODE_VERSION:
+        raise ValueError(f"Command bitstream is version {version}, expected {BYTECODE_VERSION}.")
+
+    start = 4*BYTECODE_HEADER_WORDS
+    code = Bytecode(blob[start:start + data_size])
+    program = np.frombuffer(blob, dtype="<u4", count=program_size, offset=start + data_size).tolist()
+    opcodes = {op.opcode: op for op in ops}
+
+    def signed(word):
+        return word - (1 << 32) if word >> 31 else word
+
+    def decode(pc, end):
+        commands = []
+        while pc < end:
+            op = opcodes.get(program[pc] & 0xff)
+            if op is None:
+                raise ValueError(f"Unknown opcode {program[pc] & 0xff} at word {pc}.")
+            affine = program[pc] >> 8
+            pc += 1
+
+            args = []
+            for k in range(op.nargs):
+                if affine & (1 << k):
+                    base, num_terms = program[pc:pc + 2]
+                    pc += 2
+                    terms = {}
+                    for _ in range(num_terms):
+                        depth, stride = program[pc:pc + 2]
+                        terms[code.loops[depth]] = signed(stride)
+                        pc += 2
+                    args.append(Affine(base, terms))
+                else:
+                    args.append(program[pc])
+                    pc += 1
+
+            if op is ENDREPEAT:
+                return commands, pc
+
+            command = op.deser(args, code)
+            if op is REPEAT:
+                code.push_loop(command.var)
+                command.body, pc = decode(pc, pc + args[1])
+                code.loops.pop()
+            commands.append(command)
+        return commands, pc
+
+    commands, _ = decode(0, len(program))
+    return CommandBuffer(commands)
+
+
+def check_command_bitstream(commands, blob=None):
+    """Checks that `blob` (by default, `commands` serialized) decodes
+    to the same commands and serializes back to the same bytes.
+    Returns the decoded CommandBuffer."""
+    if blob is None:
+        blob = create_command_bitstream(commands)
+    decoded = decode_command_bitstream(blob)
+
+    if create_command_bitstream(decoded) != blob:
+        raise ValueError("Decoded command bitstream serializes differently.")
+
+    def fields(command):
+        # What the bytecode keeps of each command, after loops are
+        # expanded and every value truncated to 32 bits.
+        code = Bytecode()
+        return type(command), command.ser(code), bytes(code.data)
+
+    for k, (a, b) in enumerate(zip_longest(expand(commands), expand(decoded))):
+        if a is None or b is None:
+            raise ValueError(f"Decoded command bitstream has a different length at command {k}.")
+        if fields(a) != fields(b):
+            raise ValueError(f"Command {k} decoded as {b}, expected {a}.")
+
+    return decoded
+
+
+def create_command_bitstream(commands, optimize=False):
+    """Serializes `commands` into a blob that the firmware from
+    create_interpreter_code can run. See Bytecode for the format."""
+    if optimize:
+        commands = optimize_report(commands)
+
+    code = Bytecode()
+    if isinstance(commands, CommandBuffer):
+        program = commands.ser(code)
+    else:
+        program = [word for command in commands for word in command.ser(code)]
+    return code.pack(program)
+
+
+# The SRAM array of global buffer bank n. gb_preload is a top-level
+# module of its own, so the path starts at the testbench module fault
+# generates ({top}, `<circuit>_tb`) and its `dut` instance. Below
+# GlobalBuffer_inst0 it depends on the RTL, override it through
+# create_testbench.
+GB_BANK_PATH = "{top}.dut.GlobalBuffer_inst0.bank_{n}.mem"
+
+
+def split_preload(commands):
+    """Splits out the WRITE_DATAs whose data might as well be in the
+    global buffer before the test starts: nothing earlier reads or
+    writes the same bytes, and they aren't inside or after a REPEAT.
+
+    Returns (preloaded WRITE_DATAs, every other command in order).
+    """
+    regs = {}
+    touched = []
+    barrier = False
+    preload, rest = [], []
+
+    for command in flatten(commands):
+        if isinstance(command, WRITE_DATA) and not barrier:
+            dst = [(command.dst, command.dst + command.size)]
+            if not overlaps(dst, touched):
+                touched += dst
+                preload.append(command)
+                continue
+            touched += dst
+        elif isinstance(command, REPEAT):
+            barrier = True
+        elif isinstance(command, READ_DATA):
+            touched.append((command.src, command.src + command.size))
+        elif isinstance(command, WRITE_REG):
+            if command.addr == GLOBAL_RESET_REG:
+                regs.clear()
+            elif command.addr in (CGRA_START_REG, CGRA_AUTO_RESTART_REG):
+                reads, writes = gb_ranges(regs)
+                touched += reads + writes
+            elif command.addr == CONFIG_START_REG:
+                touched += fr_ranges(regs)
+            else:
+                regs[command.addr] = command.data
+        elif isinstance(command, WRITE_REGS):
+            regs.update(command.records.tolist())
+        rest.append(command)
+
+    return preload, rest
 
 
-def create_testbench(tester, commands):
+def create_gb_preload(writes, out_dir, top, bank_path=GB_BANK_PATH):
+    """Writes the data of `writes` as one `$readmemh` image per global
+    buffer bank, 64 bits per word, and a `gb_preload` module that loads
+    them into the bank SRAMs at time 0, through hierarchical names
+    rooted at the testbench module `top`. Returns the path of the
+    module, which has to be compiled along with the testbench.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    words_per_bank = GB_BANK_SIZE // 8
+
+    banks = {}
+    for command in writes:
+        if command.dst % 8:
+            raise ValueError(f"Can't preload {command}, it isn't 64-bit aligned.")
+        data = np.frombuffer(np.asarray(command.data).tobytes()[:command.size], dtype=np.uint8)
+        data = np.pad(data, (0, -len(data) % 8)).view("<u8")
+        # Split at bank boundaries
+        first = word = command.dst // 8
+        while word < first + len(data):
+            bank, offset = divmod(word, words_per_bank)
+            chunk = data[word - first:word - first + words_per_bank - offset]
+            banks.setdefault(bank, []).append((offset, chunk))
+            word += len(chunk)
+
+    loads = []
+    for bank, chunks in sorted(banks.items()):
+        path = os.path.abspath(os.path.join(out_dir, f"gb_bank_{bank}.hex"))
+        with open(path, "w") as f:
+            for offset, chunk in sorted(chunks, key=lambda chunk: chunk[0]):
+                f.write(f"@{offset:x}\n")
+                for text in iter_hex(chunk, prefix="", sep="\n"):
+                    f.write(text)
+                f.write("\n")
+        loads.append(f'        $readmemh("{path}", {bank_path.format(top=top, n=bank)});')
+
+    module = os.path.abspath(os.path.join(out_dir, "gb_preload.sv"))
+    with open(module, "w") as f:
+        f.write("module gb_preload;\n    initial begin\n")
+        f.write("\n".join(loads))
+        f.write("\n    end\nendmodule\n")
+    return module
+
+
+def create_testbench(tester, commands, optimize=False, preload_dir=None, bank_path=GB_BANK_PATH, top=None):
+    """Drives `commands` through a fault tester.
+
+    With `preload_dir`, the WRITE_DATAs from split_preload() aren't
+    clocked in through the SoC data port. Their data is written there
+    as `$readmemh` images instead, loaded by a module whose path is
+    returned. Callers compile it along with the testbench:
+
+        module = create_testbench(tester, commands, preload_dir="build")
+        tester.compile_and_run(..., ext_srcs=[..., module])
+
+    The SRAM of bank n is `bank_path` with n and the testbench module
+    `top` (fault's `<circuit>_tb` by default) filled in.
+    """
+    if optimize:
+        commands = optimize_report(commands, lazy=preload_dir is None)
+
+    module = None
+    if preload_dir is not None:
+        if top is None:
+            top = f"{tester._circuit.name}_tb"
+        preload, commands = split_preload(commands)
+        module = create_gb_preload(preload, preload_dir, top, bank_path)
+        for command in preload:
+            tester.print(f"preloaded: {command}\n")
+
     # Generate Fault testbench
     for command in commands:
         tester.print(f"command: {command}\n")
@@ -905,44 +2486,720 @@ def create_testbench(tester, commands):
         # circuit.axi4_ctrl_wvalid = 0
         tester.poke(tester._circuit.axi4_ctrl_wvalid, 0)
 
+    return module
 
 def create_interpreter(ops):
-    defines = """
-    #define OPCODE (*PC)
-    #define ARG_1  (*(PC+1))
-    #define ARG_2  (*(PC+2))
-    #define ARG_3  (*(PC+3))
-    #define ARG_4  (*(PC+4))
+    """Generates C for `run_commands`, which runs a blob from
+    create_command_bitstream and returns the number of errors. The case
+    for each op is its interpret(), with the decoded arguments in
+    ARG_1, ARG_2, ..."""
+    max_args = max(op.nargs for op in ops)
+    nargs = [0] * (1 + max(op.opcode for op in ops))
+    for op in ops:
+        args_used = [int(x) for x in re.findall(r"ARG_(\d+)", op.interpret())]
+        assert max([0] + args_used) <= op.nargs, f"{op.__name__} uses more than {op.nargs} arguments"
+        nargs[op.opcode] = op.nargs
+
+    src = f"""
+    #define BYTECODE_MAGIC 0x{BYTECODE_MAGIC:08x}
+    #define BYTECODE_VERSION {BYTECODE_VERSION}
+    #define MAX_LOOP_DEPTH {BYTECODE_MAX_LOOP_DEPTH}
+    #define NUM_OPCODES {len(nargs)}
     """
 
-    src = """
-    switch (OPCODE) {
+    for k in range(max_args):
+        src += f"""
+    #define ARG_{k + 1} (args[{k}])
+    """
+
+    src += f"""
+    static const uint8_t NARGS[NUM_OPCODES] = {{{", ".join(map(str, nargs))}}};
+
+    uint32_t run_commands(const uint32_t* blob) {{
+        if (blob[0] != BYTECODE_MAGIC || blob[1] != BYTECODE_VERSION) {{
+            printf("Bad command bitstream (magic 0x%08x, version %u)\\n", blob[0], blob[1]);
+            return 1;
+        }}
+
+        const uint8_t* DATA = (const uint8_t*)(blob + {BYTECODE_HEADER_WORDS});
+        const uint32_t* PC = (const uint32_t*)(DATA + blob[2]);
+        const uint32_t* END = PC + blob[3];
+
+        const uint32_t* loop_start[MAX_LOOP_DEPTH];
+        uint32_t loop_count[MAX_LOOP_DEPTH];
+        uint32_t loop_index[MAX_LOOP_DEPTH];
+        uint32_t depth = 0;
+
+        uint32_t args[{max(1, max_args)}];
+        uint32_t errors = 0;
+
+        while (PC < END) {{
+            uint32_t opcode = *PC & 0xff;
+            uint32_t affine = *PC >> 8;
+            PC++;
+
+            if (opcode >= NUM_OPCODES) {{
+                printf("Unknown opcode %u\\n", opcode);
+                return errors + 1;
+            }}
+
+            for (uint32_t k = 0; k < NARGS[opcode]; k++) {{
+                if (affine & (1 << k)) {{
+                    uint32_t value = *PC++;
+                    uint32_t num_terms = *PC++;
+                    for (uint32_t t = 0; t < num_terms; t++, PC += 2) {{
+                        value += PC[1] * loop_index[PC[0]];
+                    }}
+                    args[k] = value;
+                }} else {{
+                    args[k] = *PC++;
+                }}
+            }}
+
+            switch (opcode) {{
     """
 
     for op in ops:
-        args_used = [int(x) for x in re.findall(r"ARG_(\d+)", op.interpret())]
-        incr = 1 + max([0] + args_used)
         src += f"""
-        case {op.opcode}: // {op}
-            {op.interpret()}
-            PC += {incr};
-            break;
+            case {op.opcode}: // {op.__name__}
+                {op.interpret()}
+                break;
         """
 
     src += """
+            }
+        }
+
+        return errors;
     }
     """
 
     return src
 
 
-def create_straightline_code(ops):
+def create_interpreter_code(commands, optimize=False, blob_dir=None):
+    """Generates C for the M3 that runs `commands` with the interpreter
+    from create_interpreter instead of compiling them. The firmware
+    stays the same for any schedule, only the linked blob changes, so
+    with `blob_dir` (see link_blob) a new schedule just needs the
+    `.bin` swapped out before linking.
+    """
+    blob = np.frombuffer(create_command_bitstream(commands, optimize), dtype=np.uint64)
+
     _globals = {
         'src': [],
         'ids': [],
+        'init': [],
+        'blob_dir': blob_dir,
     }
-    test_body = "\n".join([op.compile(_globals) for op in ops])
 
+    array_id = "commands"
+    if blob_dir is not None:
+        _globals['src'] += [link_blob(array_id, blob, blob_dir)]
+    else:
+        _globals['src'] += [HexArray(array_id, blob)]
+    _globals['ids'] += [array_id]
+    _globals['src'] += [create_interpreter(ops)]
+
+    if TLX:
+        array_id = f"tlx_{array_id}"
+
+    return create_firmware(_globals, f"errors += run_commands((const uint32_t*){array_id});")
+
+
+PROFILE_MODES = ["command", "phase"]
+
+PROFILE_RUNTIME = """
+#define DEMCR      (*(volatile uint32_t*)0xE000EDFC)
+#define DWT_CTRL   (*(volatile uint32_t*)0xE0001000)
+#define DWT_CYCCNT (*(volatile uint32_t*)0xE0001004)
+
+#define PROFILE_SIZE 1024
+
+// Ring buffer of (mark, cycle count), only the last PROFILE_SIZE marks
+// are kept.
+static uint32_t profile_ids[PROFILE_SIZE];
+static uint32_t profile_cycles[PROFILE_SIZE];
+static uint32_t profile_count;
+
+static inline void profile_mark(uint32_t id) {
+    uint32_t k = profile_count++ % PROFILE_SIZE;
+    profile_cycles[k] = DWT_CYCCNT;
+    profile_ids[k] = id;
+}
+
+void profile_dump(void) {
+    uint32_t first = profile_count > PROFILE_SIZE ? profile_count - PROFILE_SIZE : 0;
+    printf("PROFILE_BEGIN %u %u\\n", (unsigned)profile_count, (unsigned)first);
+    for (uint32_t k = first; k < profile_count; k++) {
+        printf("PROFILE %u %u\\n", (unsigned)profile_ids[k % PROFILE_SIZE], (unsigned)profile_cycles[k % PROFILE_SIZE]);
+    }
+    printf("PROFILE_END\\n");
+}
+"""
+
+PROFILE_INIT = """
+// Start the cycle counter
+DEMCR |= 1 << 24;
+DWT_CYCCNT = 0;
+DWT_CTRL |= 1;
+"""
+
+
+CHECK_MODES = ["gold", "crc"]
+
+# First mismatches printed per READ_DATA in "gold" mode
+CHECK_MAX_MISMATCHES = 8
+
+CHECK_RUNTIME = """
+#define CHECK_MAX_MISMATCHES %(max_mismatches)d
+
+// CRC-32 (the one zlib.crc32 computes), a byte at a time
+static const uint32_t crc32_table[256] = {
+%(crc_table)s
+};
+
+// Checks the low bytes of `n` 16-bit words of output, read 64 bits at
+// a time, against `gold`, or only against the CRC-32 `gold_crc` of
+// them if `gold` is NULL. The apps' verify() truncates outputs to 8
+// bits the same way. Prints a one line summary and the first
+// CHECK_MAX_MISMATCHES mismatches, returns the number of errors.
+uint32_t check_output(uint32_t id, const volatile uint64_t* out, const uint16_t* gold, size_t n, uint32_t gold_crc) {
+    uint32_t crc = 0xffffffff;
+    uint32_t mismatches = 0;
+    uint64_t beat = 0;
+    for (size_t k = 0; k < n; k++) {
+        if (k %% 4 == 0) beat = out[k / 4];
+        uint8_t byte = (beat >> (16 * (k %% 4))) & 0xff;
+        crc = crc32_table[(crc ^ byte) & 0xff] ^ (crc >> 8);
+        if (gold && byte != (gold[k] & 0xff)) {
+            if (mismatches < CHECK_MAX_MISMATCHES) {
+                printf("MISMATCH %%u [%%u] expected 0x%%02x got 0x%%02x\\n", (unsigned)id, (unsigned)k, gold[k] & 0xff, byte);
+            }
+            mismatches++;
+        }
+    }
+    crc = ~crc;
+
+    uint32_t errors = gold ? mismatches : crc != gold_crc;
+    printf("CHECK %%u %%s %%u words crc 0x%%08x expected 0x%%08x mismatches %%u\\n",
+           (unsigned)id, errors ? "FAIL" : "PASS", (unsigned)n, (unsigned)crc, (unsigned)gold_crc, (unsigned)mismatches);
+    return errors;
+}
+"""
+
+
+def crc32_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0xedb88320 if crc & 1 else 0)
+        table.append(crc)
+    return table
+
+
+def check_runtime():
+    return CHECK_RUNTIME % {
+        'max_mismatches': CHECK_MAX_MISMATCHES,
+        'crc_table': format_hex(crc32_table(), digits=8),
+    }
+
+
+def describe(op):
+    if isinstance(op, PRINT):
+        return f'PRINT "{op.string}"'
+    if type(op).__repr__ is object.__repr__:
+        return type(op).__name__
+    return f"{type(op).__name__} ({op!r})"
+
+
+def profile_points(ops, profile="command"):
+    """Where firmware built with create_straightline_code(...,
+    profile=profile) marks the cycle counter.
+
+    Returns a list of (mark id, index into `ops`, label). Mark k times
+    everything from its command up to the next mark. With "command"
+    every top-level command is a mark (a REPEAT is timed as a whole),
+    with "phase" only the PRINTs are, so a phase is named after the
+    message that starts it. The last mark is the end of the schedule.
+    """
+    if profile not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode `{profile}`, expected one of {PROFILE_MODES}.")
+
+    points = []
+    num_ops = 0
+    for k, op in enumerate(ops):
+        num_ops += 1
+        if profile == "command" or isinstance(op, PRINT) or k == 0:
+            points.append((len(points), k, describe(op)))
+    points.append((len(points), num_ops, "end"))
+    return points
+
+
+def create_straightline_code(ops, optimize=False, blob_dir=None, overlap=False, profile=None, check=None, batch=False):
+    """Generates C for the M3 that runs `ops` in order.
+
+    If `blob_dir` is given, WRITE_DATA payloads are written there as raw
+    `.bin` files and linked into the image with `.incbin` rather than
+    formatted into the source.
+
+    With `overlap`, DMA transfers are queued on both channels and run in
+    the background from their completion interrupts. Input loads are
+    moved up past config and earlier runs where they don't touch the
+    same part of the global buffer, and are only waited on right before
+    something needs them. Transfers inside loops still run one at a
+    time, with the DMA interrupts masked. Requires DMA.
+
+    With `profile` ("command" or "phase"), the DWT cycle counter is
+    read at every point from profile_points() into a ring buffer, which
+    is printed once at the end. profiling.py turns that back into a
+    latency table.
+
+    With `check` ("gold" or "crc"), READ_DATAs are checked on the M3
+    instead of printed word by word, see CHECK_RUNTIME. "gold" links the
+    expected data into the image and prints the first mismatches, "crc"
+    only compares a CRC-32. Either way one `CHECK` line is printed per
+    READ_DATA and failures count towards the test's errors.
+
+    With `batch`, runs of register writes are applied from tables, see
+    batch_writes().
+
+    Returns the source as a string, see write_straightline_code() to
+    stream it to a file instead.
+    """
+    f = io.StringIO()
+    write_straightline_code(f, ops, optimize=optimize, blob_dir=blob_dir, overlap=overlap, profile=profile, check=check, batch=batch)
+    return f.getvalue()
+
+
+def lower_commands(ops, optimize=False, batch=False):
+    """The commands create_straightline_code(ops, optimize=optimize,
+    batch=batch) compiles, lazily. Anything numbering them the way the
+    firmware does, like parse_profile(), has to start from these."""
+    if optimize:
+        ops = optimize_report(ops, lazy=True)
+    if batch:
+        ops = iter_batched(ops)
+    return ops
+
+
+def write_straightline_code(f, ops, optimize=False, blob_dir=None, overlap=False, profile=None, check=None, batch=False):
+    """create_straightline_code() written to the file object `f` as
+    it is generated.
+
+    `ops` is consumed one command at a time. Globals are written out as
+    soon as a command defines them and the body is spooled to a
+    temporary file until main() can be written, so the generated source
+    is never held in memory all at once. The schedule only stays out of
+    memory if `ops` is a generator, which so far only
+    Tiled.iter_commands() is; app.commands() and the cache build the
+    whole schedule first. Overlap and profiling need to see the whole
+    schedule up front and build it in memory either way.
+    """
+    ops = lower_commands(ops, optimize=optimize, batch=batch)
+
+    _globals = {
+        'src': [],
+        'ids': [],
+        'init': [],
+        'blob_dir': blob_dir,
+        'check': check,
+        'checks': 0,
+    }
+    if check is not None:
+        if check not in CHECK_MODES:
+            raise ValueError(f"Unknown check mode `{check}`, expected one of {CHECK_MODES}.")
+        _globals['src'].append(check_runtime())
+
+    def body():
+        if overlap:
+            if not DMA or MEMCPY:
+                raise NotImplementedError("Overlapping transfers needs DMA without MEMCPY.")
+            if profile:
+                raise NotImplementedError("Profiling doesn't support overlapped transfers.")
+            yield create_async_body(ops, _globals)
+        elif profile:
+            _ops = list(ops)
+            marks = {k: mark for mark, k, _ in profile_points(_ops, profile)}
+            _globals['src'].append(PROFILE_RUNTIME)
+            _globals['init'].append(PROFILE_INIT)
+
+            for k, op in enumerate(_ops):
+                if k in marks:
+                    yield f"profile_mark({marks[k]});"
+                yield op.compile(_globals)
+            yield f"profile_mark({marks[len(_ops)]});"
+            yield "profile_dump();"
+        else:
+            for op in ops:
+                yield op.compile(_globals)
+
+    f.write(firmware_head())
+    with tempfile.TemporaryFile("w+") as spool:
+        for k, line in enumerate(body()):
+            for src in _globals['src']:
+                if isinstance(src, HexArray):
+                    f.writelines(src.chunks())
+                else:
+                    f.write(src)
+                f.write("\n")
+            _globals['src'].clear()
+            if k:
+                spool.write("\n")
+            spool.write(line)
+
+        f.write(firmware_main(_globals))
+        spool.seek(0)
+        shutil.copyfileobj(spool, f)
+    f.write(FIRMWARE_TAIL)
+
+
+def gb_ranges(regs):
+    """Global buffer ranges the IO controllers read and write on the
+    next run of the CGRA, given the register values in `regs`."""
+    reads, writes = [], []
+    for n in range(16):
+        mode = regs.get(IO_MODE_REG(n), 0)
+        addr = regs.get(IO_ADDR_REG(n), 0)
+        nbytes = 2 * regs.get(IO_SIZE_REG(n), 0)
+        if mode == IO_INPUT_STREAM:
+            reads.append((addr, addr + nbytes))
+        elif mode == IO_OUTPUT_STREAM:
+            writes.append((addr, addr + nbytes))
+    return reads, writes
+
+
+def fr_ranges(regs):
+    """Global buffer ranges the FR controllers read on CONFIG_START."""
+    reads = []
+    for n in range(16):
+        addr = regs.get(FR_ADDR_REG(n), 0)
+        nbytes = 8 * regs.get(FR_SIZE_REG(n), 0)
+        if nbytes:
+            reads.append((addr, addr + nbytes))
+    return reads
+
+
+def overlaps(ranges, others):
+    return any(lo < other_hi and other_lo < hi for lo, hi in ranges for other_lo, other_hi in others)
+
+
+class Step:
+    """A command in the async schedule along with the global buffer
+    ranges it reads and writes. Triggers and the WAITs that retire them
+    carry the ranges of the hardware operation they start or end."""
+
+    def __init__(self, command, reads=(), writes=(), barrier=False):
+        self.command = command
+        self.reads = list(reads)
+        self.writes = list(writes)
+        self.barrier = barrier
+
+    def conflicts(self, reads, writes):
+        return overlaps(writes, self.reads + self.writes) or overlaps(reads, self.writes)
+
+
+def schedule_commands(commands):
+    """Reorders top-level commands so that every WRITE_DATA is issued as
+    early as it can be: above config, other transfers, triggers and
+    WAITs that don't touch the same part of the global buffer. Returns
+    a list of Steps.
+
+    Register values are tracked to know what each CGRA run and each
+    CONFIG_START touches. Loops and global resets are barriers that
+    nothing moves across.
+    """
+    regs = {}
+    in_flight = {CGRA_DONE_MASK: [], CONFIG_DONE_MASK: []}
+    steps = []
+
+    for command in flatten(commands):
+        if isinstance(command, REPEAT):
+            regs.clear()
+            steps.append(Step(command, barrier=True))
+            continue
+
+        if isinstance(command, WRITE_REG):
+            step = Step(command)
+            if command.addr == GLOBAL_RESET_REG:
+                regs.clear()
+                step.barrier = True
+            elif command.addr in (CGRA_START_REG, CGRA_AUTO_RESTART_REG):
+                step.reads, step.writes = gb_ranges(regs)
+                in_flight[CGRA_DONE_MASK].append(step)
+            elif command.addr == CONFIG_START_REG:
+                step.reads = fr_ranges(regs)
+                in_flight[CONFIG_DONE_MASK].append(step)
+            else:
+                regs[command.addr] = command.data
+            steps.append(step)
+            continue
+
+        if isinstance(command, WRITE_REGS):
+            regs.update(command.records.tolist())
+            steps.append(Step(command))
+            continue
+
+        if isinstance(command, WAIT):
+            # Retires the oldest operation that raises this interrupt
+            step = Step(command)
+            for mask, ops in in_flight.items():
+                if command.mask & mask and ops:
+                    op = ops.pop(0)
+                    step.reads += op.reads
+                    step.writes += op.writes
+            steps.append(step)
+            continue
+
+        if isinstance(command, READ_DATA):
+            steps.append(Step(command, reads=[(command.src, command.src + command.size)]))
+            continue
+
+        if not isinstance(command, WRITE_DATA):
+            steps.append(Step(command, barrier=isinstance(command, READ_REG)))
+            continue
+
+        # Hoist the write above everything it doesn't conflict with
+        step = Step(command, writes=[(command.dst, command.dst + command.size)])
+        k = len(steps)
+        while k > 0 and not steps[k-1].barrier and not steps[k-1].conflicts(step.reads, step.writes):
+            k -= 1
+        steps.insert(k, step)
+
+    return steps
+
+
+def create_async_body(ops, _globals):
+    """Compiles `ops` with DMA transfers queued on both channels and only
+    waited on when something later touches the same global buffer
+    range, see create_straightline_code(overlap=True)."""
+    _globals['src'].append(DMA_RUNTIME)
+    _globals['init'].append("""
+        *DMA0_INTEN = 0x00000001;
+        *DMA1_INTEN = 0x00000001;
+        NVIC_EnableIRQ(DMA0_IRQn);
+        NVIC_EnableIRQ(DMA1_IRQn);
+    """)
+
+    body = []
+    # (step, channel, ticket) for each transfer that may be in flight
+    outstanding = []
+    # C that prints each READ_DATA once its transfer is done
+    prints = []
+    queued = [0, 0]
+
+    def wait_for(reads, writes):
+        for transfer in list(outstanding):
+            step, channel, ticket = transfer
+            if step.conflicts(reads, writes):
+                body.append(f"dma_wait({channel}, {ticket});")
+                outstanding.remove(transfer)
+
+    def wait_all():
+        for _, channel, ticket in outstanding:
+            body.append(f"dma_wait({channel}, {ticket});")
+        outstanding.clear()
+        queued[:] = [0, 0]
+        body.extend(prints)
+        prints.clear()
+
+    def flush_prints():
+        # Output has to come out in the same order as before, so all
+        # reads are finished before anything else is printed.
+        for step, channel, ticket in list(outstanding):
+            if isinstance(step.command, READ_DATA):
+                body.append(f"dma_wait({channel}, {ticket});")
+                outstanding.remove((step, channel, ticket))
+        body.extend(prints)
+        prints.clear()
+
+    for step in schedule_commands(ops):
+        command = step.command
+        if isinstance(command, REPEAT):
+            # Loop bodies use the synchronous helpers, which poll for
+            # the completion the handlers would otherwise take first.
+            wait_all()
+            body.append(f"dma_sync_begin();\n{command.compile(_globals)}\ndma_sync_end();")
+        elif step.barrier:
+            wait_all()
+            body.append(command.compile(_globals))
+        elif isinstance(command, (WRITE_DATA, READ_DATA)):
+            wait_for(step.reads, step.writes)
+            # Reads go out on dma1, writes on whichever has less queued
+            channel = 1 if isinstance(command, READ_DATA) or queued[1] < queued[0] else 0
+            queued[channel] += command.size
+            ticket = f"ticket_{new_id()}"
+            if isinstance(command, READ_DATA):
+                start, finish = command.compile_async(_globals, channel)
+                prints.append(finish)
+            else:
+                start = command.compile_async(_globals, channel)
+            body.append(f"{start}\nuint32_t {ticket} = dma_tail[{channel}];")
+            outstanding.append((step, channel, ticket))
+        elif isinstance(command, WRITE_REG) and command.addr in (CGRA_START_REG, CGRA_AUTO_RESTART_REG, CONFIG_START_REG):
+            wait_for(step.reads, step.writes)
+            body.append(command.compile(_globals))
+        else:
+            if isinstance(command, PRINT):
+                flush_prints()
+            body.append(command.compile(_globals))
+
+    wait_all()
+    return "\n".join(body)
+
+
+DMA_RUNTIME = """
+#define DMA0_BASE            0x40007000
+#define DMA0_INTEN           ((volatile uint32_t*)(DMA0_BASE + 0x020))
+#define DMA0_INTCLR          ((volatile uint32_t*)(DMA0_BASE + 0x02C))
+
+#define DMA1_BASE            0x40008000
+#define DMA1_INTEN           ((volatile uint32_t*)(DMA1_BASE + 0x020))
+#define DMA1_INTCLR          ((volatile uint32_t*)(DMA1_BASE + 0x02C))
+
+#define DMA_QUEUE_SIZE 64
+
+typedef struct {
+    uint64_t* dst;
+    uint64_t* src;
+    uint32_t beats;
+    uint32_t bursts;
+} dma_desc_t;
+
+// Each channel works through its queue from the completion interrupt.
+// dma_tail counts transfers queued and dma_done transfers finished, so
+// a transfer is done once dma_done has caught up to its ticket.
+static dma_desc_t dma_queue[2][DMA_QUEUE_SIZE];
+static volatile uint32_t dma_tail[2];
+static volatile uint32_t dma_done[2];
+
+static void dma_start(uint32_t ch) {
+    dma_desc_t* desc = &dma_queue[ch][dma_done[ch] % DMA_QUEUE_SIZE];
+    if (ch == 0) start_dma0(desc->dst, desc->src, desc->beats, desc->bursts);
+    else start_dma1(desc->dst, desc->src, desc->beats, desc->bursts);
+}
+
+static void dma_complete(uint32_t ch) {
+    if (dma_done[ch] == dma_tail[ch]) {
+        // Not one of ours, e.g. left pending by the synchronous helpers
+        return;
+    }
+    dma_done[ch]++;
+    if (dma_done[ch] != dma_tail[ch]) {
+        dma_start(ch);
+    }
+    __SEV();
+}
+
+void DMA0_Handler(void) {
+    *DMA0_INTCLR = 0x00000001;
+    dma_complete(0);
+}
+
+void DMA1_Handler(void) {
+    *DMA1_INTCLR = 0x00000001;
+    dma_complete(1);
+}
+
+// start_dma0()/wait_dma0() and the rest of the synchronous helpers wait
+// for the interrupt status the handlers clear, so DMA interrupts are
+// masked while they run. Both channels have to be idle.
+static void dma_sync_begin(void) {
+    NVIC_DisableIRQ(DMA0_IRQn);
+    NVIC_DisableIRQ(DMA1_IRQn);
+}
+
+static void dma_sync_end(void) {
+    NVIC_ClearPendingIRQ(DMA0_IRQn);
+    NVIC_ClearPendingIRQ(DMA1_IRQn);
+    NVIC_EnableIRQ(DMA0_IRQn);
+    NVIC_EnableIRQ(DMA1_IRQn);
+}
+
+static void dma_enqueue(uint32_t ch, uint64_t* dst, uint64_t* src, uint32_t beats, uint32_t bursts) {
+    while (dma_tail[ch] - dma_done[ch] == DMA_QUEUE_SIZE) {
+        __WFE();
+    }
+    dma_desc_t* desc = &dma_queue[ch][dma_tail[ch] % DMA_QUEUE_SIZE];
+    desc->dst = dst;
+    desc->src = src;
+    desc->beats = beats;
+    desc->bursts = bursts;
+
+    __disable_irq();
+    uint32_t idle = dma_tail[ch] == dma_done[ch];
+    dma_tail[ch]++;
+    if (idle) {
+        dma_start(ch);
+    }
+    __enable_irq();
+}
+
+static void dma_wait(uint32_t ch, uint32_t ticket) {
+    while ((int32_t)(dma_done[ch] - ticket) < 0) {
+        __WFE();
+    }
+}
+"""
+
+
+# Every INTERRUPT_STATUS bit (CGRA_DONE_MASK, CONFIG_DONE_MASK, ...) is
+# its own counting semaphore. The dispatcher is installed once and
+# never replaced, so a config load and several runs can be in flight
+# at once and their interrupts can come back in any order, a WAIT only
+# takes the event it asked for.
+CGRA_RUNTIME = f"""
+#define CGRA_STATUS (*(volatile uint32_t*)(CGRA_REG_BASE + 0x{INTERRUPT_STATUS_REG:x}))
+
+static volatile uint32_t cgra_events[32];
+
+void cgra_dispatch(void) {{
+    uint32_t status = CGRA_STATUS;
+    // Write 1 to clear, only the bits we're about to count
+    CGRA_STATUS = status;
+    for (uint32_t bit = 0; status; bit++, status >>= 1) {{
+        if (status & 1) cgra_events[bit] += 1;
+    }}
+    __SEV();
+}}
+
+void cgra_wait(uint32_t mask) {{
+    for (uint32_t bit = 0; mask; bit++, mask >>= 1) {{
+        if (!(mask & 1)) continue;
+        while (!cgra_events[bit]) {{
+            __WFE(); // wait for event
+        }}
+        __disable_irq();
+        cgra_events[bit] -= 1;
+        __enable_irq();
+    }}
+}}
+
+// Applies a WRITE_REGS table of `n` (addr, data) records
+void cgra_write_regs(const uint32_t* records, uint32_t n) {{
+    for (uint32_t k = 0; k < n; k++) {{
+        *(volatile uint32_t*)(CGRA_REG_BASE + records[2*k]) = records[2*k + 1];
+    }}
+}}
+"""
+
+
+def create_firmware(_globals, test_body):
+    """Wraps `test_body` in a main() for the M3, along with the globals
+    the commands asked for."""
+    return (
+        firmware_head()
+        + "\n".join(map(str, _globals['src']))
+        + firmware_main(_globals)
+        + test_body
+        + FIRMWARE_TAIL
+    )
+
+
+def firmware_head(runtime=True):
+    """Everything create_firmware() puts before the globals. Without
+    `runtime`, only the includes and definitions a header needs."""
     src = """
     #include "AHASOC.h"
     #include "stdio.h"
@@ -955,6 +3212,7 @@ def create_straightline_code(ops):
         src += """
         #include "dma_utils.h"
         """
+        src += DMA_COPY_RUNTIME
 
     #     src += """
     #     #define DMA0_BASE            0x40007000
@@ -999,9 +3257,19 @@ def create_straightline_code(ops):
     typedef void(*interrupt_handler_t)(void);
     """
 
-    src += "\n".join(_globals['src'])
+    if runtime:
+        src += CGRA_RUNTIME
+    return src
+
 
-    src += """
+def firmware_main(_globals, declare=True):
+    """Everything create_firmware() puts between the globals and the
+    test body, which depends on the arrays in `_globals['ids']`.
+
+    The `tlx_` pointers to the copies in TLX memory are declared here
+    unless `declare` is False, in which case they have to be globals
+    defined elsewhere."""
+    src = """
     int main() {
     """
 
@@ -1010,12 +3278,28 @@ def create_straightline_code(ops):
         volatile uint64_t* tlx_base = (volatile uint64_t*)TLX_BASE;
         """
 
+        # Arrays are staged into TLX with as few DMA transfers as the
+        # descriptors allow.
         for gid in _globals['ids']:
             src += f"""
-            volatile uint64_t* tlx_{gid} = tlx_base;
-            for(size_t k = 0; k < sizeof({gid}) / sizeof({gid}[0]); k++) {{
-                *(tlx_base++) = {gid}[k];
-            }}
+            {"volatile uint64_t* " if declare else ""}tlx_{gid} = tlx_base;
+            """
+            if DMA and MEMCPY:
+                src += f"""
+                aha_memcpy((uint64_t*)tlx_base, &({gid}[0]), sizeof({gid}) / sizeof({gid}[0]));
+                """
+            elif DMA:
+                src += f"""
+                dma_copy(0, (uint64_t*)tlx_base, &({gid}[0]), sizeof({gid}) / sizeof({gid}[0]));
+                """
+            else:
+                src += f"""
+                for(size_t k = 0; k < sizeof({gid}) / sizeof({gid}[0]); k++) {{
+                    tlx_base[k] = {gid}[k];
+                }}
+                """
+            src += f"""
+            tlx_base += sizeof({gid}) / sizeof({gid}[0]);
             """
 
     src += """
@@ -1023,15 +3307,21 @@ def create_straightline_code(ops):
         UartStdOutInit();
 
         // Enable interrupts
+        *(interrupt_handler_t*)(112) = &cgra_dispatch;
         NVIC_EnableIRQ(CGRA_IRQn);
+    """
+
+    src += "\n".join(_globals.get('init', []))
 
+    src += """
         uint32_t errors = 0;
         printf("Starting test...\\n");
     """
 
-    src += test_body
+    return src
 
-    src += """
+
+FIRMWARE_TAIL = """
         if(errors) printf("TEST FAILED (%u errors)\\n", errors);
         else printf("TEST PASSED!\\n");
 
@@ -1042,4 +3332,229 @@ def create_straightline_code(ops):
     }
     """
 
-    return src
+
+# Declarations of everything in CGRA_RUNTIME and CHECK_RUNTIME, for
+# the header of write_firmware_dir().
+RUNTIME_DECLS = """
+void cgra_dispatch(void);
+void cgra_wait(uint32_t mask);
+void cgra_write_regs(const uint32_t* records, uint32_t n);
+uint32_t check_output(uint32_t id, const volatile uint64_t* out, const uint16_t* gold, size_t n, uint32_t gold_crc);
+"""
+
+FIRMWARE_MAKEFILE = """\
+# Generated by write_firmware_dir(). Builds every translation unit on
+# its own (make -j) and links them into one relocatable object for the
+# SoC build to pick up in place of a single firmware .c.
+CC ?= arm-none-eabi-gcc
+LD ?= arm-none-eabi-ld
+CFLAGS ?= -O2 -mcpu=cortex-m3 -mthumb
+INCLUDES ?=
+
+SRCS := $(sort $(wildcard *.c))
+OBJS := $(SRCS:.c=.o)
+
+firmware.o: $(OBJS)
+\t$(LD) -r -o $@ $^
+
+%.o: %.c firmware.h
+\t$(CC) $(CFLAGS) $(INCLUDES) -c -o $@ $<
+
+clean:
+\trm -f $(OBJS) firmware.o
+
+.PHONY: clean
+"""
+
+# Phases are also cut after this many commands when there are no
+# PRINTs, to bound what write_firmware_dir() holds in memory
+PHASE_MAX_COMMANDS = 4096
+
+# `uint64_t data_3[512];` from READ_DATA.define(), or the `extern`
+# declaration at the top of link_blob()
+ARRAY_DECL = re.compile(r"^\s*(?:extern\s+)?(const\s+)?uint64_t\s+(\w+)\[(\d+)\];")
+
+
+def array_decl(src):
+    """`extern` declaration of the array a global from
+    `_globals['src']` defines, or None if it isn't an array."""
+    if isinstance(src, HexArray):
+        const = "const " if src.const else ""
+        return f"extern {const}uint64_t {src.array_id}[{len(src.data)}];"
+    match = ARRAY_DECL.match(src)
+    if match is None:
+        return None
+    const, array_id, size = match.groups()
+    return f"extern {const or ''}uint64_t {array_id}[{size}];"
+
+
+class _UnitWriter:
+    """Writes a generated file through a temporary one and only
+    replaces the file if its contents changed, so make only rebuilds
+    what did."""
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path + ".tmp", "w")
+
+    def close(self, keep=True):
+        self.f.close()
+        if keep and not (os.path.exists(self.path) and filecmp.cmp(self.path + ".tmp", self.path, shallow=False)):
+            os.replace(self.path + ".tmp", self.path)
+        else:
+            os.remove(self.path + ".tmp")
+
+    def __enter__(self):
+        return self.f
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(keep=exc_type is None)
+
+
+def write_firmware_dir(out_dir, ops, optimize=False, blob_dir=None, check=None, batch=False, shard_bytes=1 << 20):
+    """Generates the same firmware as create_straightline_code(), split
+    into translation units under `out_dir`:
+
+        firmware.h       includes, runtime declarations
+        runtime.c        CGRA_RUNTIME (and CHECK_RUNTIME)
+        payload_N.c      the global arrays, about `shard_bytes` of
+                         payload per file
+        phase_N.c        uint32_t phase_N(void), the commands from one
+                         PRINT up to the next
+        main.c           TLX copies, init, and a call to every phase
+        Makefile
+
+    Like write_straightline_code(), `ops` is consumed one command at a
+    time and only one phase and one shard are buffered. Files whose
+    contents didn't change are left alone, and files left over from a
+    previous, longer schedule are removed. Returns the paths of the
+    translation units.
+
+    Overlapped transfers and profiling keep their state in static
+    globals of a single file and aren't supported here.
+    """
+    if check is not None and check not in CHECK_MODES:
+        raise ValueError(f"Unknown check mode `{check}`, expected one of {CHECK_MODES}.")
+    if optimize:
+        ops = optimize_report(ops, lazy=True)
+    if batch:
+        ops = iter_batched(ops)
+
+    os.makedirs(out_dir, exist_ok=True)
+    _globals = {
+        'src': [],
+        'ids': [],
+        'init': [],
+        'blob_dir': blob_dir,
+        'check': check,
+        'checks': 0,
+    }
+    decls = []
+    units = []
+
+    def unit(name):
+        path = os.path.join(out_dir, name)
+        units.append(path)
+        return _UnitWriter(path)
+
+    with _UnitWriter(os.path.join(out_dir, "firmware.h")) as f:
+        f.write("#pragma once\n")
+        f.write(firmware_head(runtime=False))
+        f.write(RUNTIME_DECLS)
+
+    with unit("runtime.c") as f:
+        f.write('#include "firmware.h"\n')
+        f.write(CGRA_RUNTIME)
+        if check is not None:
+            f.write(check_runtime())
+
+    shard = None
+    shard_size = 0
+    num_shards = 0
+
+    def write_globals(phase_decls):
+        nonlocal shard, shard_size, num_shards
+        for src in _globals['src']:
+            decl = array_decl(src)
+            if decl is None:
+                raise NotImplementedError(f"Only arrays can be split into payload files, got:\n{src}")
+            phase_decls.append(decl)
+            decls.append(decl)
+
+            if shard is None:
+                shard = unit(f"payload_{num_shards}.c")
+                shard.f.write('#include "firmware.h"\n')
+                num_shards += 1
+            if isinstance(src, HexArray):
+                shard.f.writelines(src.chunks())
+                shard_size += 8 * len(src.data)
+            else:
+                shard.f.write(src)
+            shard.f.write("\n")
+            if shard_size >= shard_bytes:
+                shard.close()
+                shard, shard_size = None, 0
+        _globals['src'].clear()
+
+    def phases():
+        phase = []
+        for op in ops:
+            if isinstance(op, PRINT) and phase:
+                yield phase
+                phase = []
+            phase.append(op)
+            # Only the current phase is kept around
+            if len(phase) >= PHASE_MAX_COMMANDS:
+                yield phase
+                phase = []
+        if phase:
+            yield phase
+
+    num_phases = 0
+    for k, phase in enumerate(phases()):
+        phase_decls = []
+        first_id = len(_globals['ids'])
+        with tempfile.TemporaryFile("w+") as spool:
+            for op in phase:
+                spool.write(op.compile(_globals))
+                spool.write("\n")
+                write_globals(phase_decls)
+
+            with unit(f"phase_{k}.c") as f:
+                f.write('#include "firmware.h"\n')
+                f.write("\n".join(phase_decls))
+                if TLX:
+                    f.write("\n")
+                    f.write("\n".join(f"extern volatile uint64_t* tlx_{gid};" for gid in _globals['ids'][first_id:]))
+                f.write(f"\n\nuint32_t phase_{k}(void) {{\n    uint32_t errors = 0;\n")
+                spool.seek(0)
+                shutil.copyfileobj(spool, f)
+                f.write("    return errors;\n}\n")
+        num_phases += 1
+    if shard is not None:
+        shard.close()
+
+    with unit("main.c") as f:
+        f.write('#include "firmware.h"\n')
+        if TLX:
+            # The TLX copies need the sizes of the arrays
+            f.write("\n".join(decls))
+            f.write("\n")
+            f.write("\n".join(f"volatile uint64_t* tlx_{gid};" for gid in _globals['ids']))
+            f.write("\n")
+        f.write("\n".join(f"uint32_t phase_{k}(void);" for k in range(num_phases)))
+        f.write(firmware_main(_globals, declare=False))
+        f.write("\n".join(f"        errors += phase_{k}();" for k in range(num_phases)))
+        f.write(FIRMWARE_TAIL)
+
+    with _UnitWriter(os.path.join(out_dir, "Makefile")) as f:
+        f.write(FIRMWARE_MAKEFILE)
+
+    # Leftovers of a previous, longer schedule
+    for name in os.listdir(out_dir):
+        path = os.path.join(out_dir, name)
+        stem = os.path.splitext(path)[0]
+        if re.fullmatch(r"(phase|payload)_\d+\.(c|o)", name) and stem + ".c" not in units:
+            os.remove(path)
+
+    return units
@@ -0,0 +1,211 @@
+# Static estimate of how long a schedule from applications.py takes
+# on the host side, and how many bytes it moves, without simulating.
+#
+#   cost = estimate(app.commands(), width=32)
+#   print(cost.table())
+#   with open("cost.json", "w") as f:
+#       f.write(cost.json())
+#
+# Time is tracked in M3 cycles. The latencies below are rough and meant
+# to be calibrated against a simulation, they are all overridable
+# through estimate(..., **params).
+
+from collections import deque
+import json
+from commands import *
+from model import *
+
+
+PHASES = ["config", "load", "compute", "drain"]
+
+DEFAULT_PARAMS = {
+    # One AXI-lite write/read from the M3 to a CGRA register
+    'axi_write_cycles': 8,
+    'axi_read_cycles': 10,
+    # Programming a DMA transfer and waiting on it, per transfer
+    'dma_setup_cycles': 40,
+    'dma_burst_cycles': 4,
+    'dma_beat_cycles': 1,
+    # One 64-bit store or load by the M3 when DMA is off
+    'store_cycles': 4,
+    # printf over the UART, per character
+    'print_char_cycles': 10,
+    # Taking an interrupt and returning from WAIT
+    'irq_cycles': 30,
+    # Fast reconfiguration, per 64-bit config word per FR controller
+    'config_word_cycles': 1,
+    # CGRA run time, per 16-bit word on the longest IO stream
+    'io_word_cycles': 1,
+    'run_overhead_cycles': 20,
+}
+
+
+class CostModel(Model):
+    """Model that also keeps time on the host.
+
+    Every command is charged the cycles the M3 spends on it and the
+    bytes it moves, and is assigned to one of PHASES. The CGRA and the
+    FR controllers run in the background, so a WAIT only costs whatever
+    part of the run the host hasn't already covered.
+    """
+
+    def __init__(self, width=32, **params):
+        super().__init__(width)
+        unknown = set(params) - set(DEFAULT_PARAMS)
+        if unknown:
+            raise TypeError(f"Unknown cost parameters {sorted(unknown)}.")
+        self.params = {**DEFAULT_PARAMS, **params}
+
+        self.now = 0
+        self.nbytes = 0
+        self.phase = "config"
+        self.entries = []
+
+        # When the CGRA is next free, and when each event of each
+        # INTERRUPT_STATUS bit happens.
+        self.cgra_free = 0
+        self.event_time = 0
+        self.signals = {}
+        # Entry of the last WRITE_DATA to each address
+        self.last_write = {}
+
+    def emulate(self, command):
+        if isinstance(command, REPEAT):
+            # The commands of the body are charged as they are expanded
+            super().emulate(command)
+            return
+        start, nbytes = self.now, self.nbytes
+        super().emulate(command)
+        self.entries.append([command, self.phase, self.now - start, self.nbytes - nbytes])
+
+    def dma_cycles(self, nbytes):
+        p = self.params
+        if not DMA or MEMCPY:
+            return (nbytes + 7) // 8 * p['store_cycles']
+        transfers = dma_transfers((nbytes + 7) // 8)
+        return sum(
+            p['dma_setup_cycles'] + bursts * (p['dma_burst_cycles'] + beats * p['dma_beat_cycles'])
+            for _, beats, bursts in transfers
+        )
+
+    def write_reg(self, addr, data):
+        self.now += self.params['axi_write_cycles']
+        self.nbytes += 4
+
+        reg = self.decode_reg(addr)
+        if reg is not None and reg[0] is self.io:
+            self.phase = "load"
+        elif addr in (CGRA_START_REG, CGRA_AUTO_RESTART_REG):
+            self.phase = "compute"
+        else:
+            self.phase = "config"
+        super().write_reg(addr, data)
+
+    def expect_reg(self, addr, expected):
+        self.now += self.params['axi_read_cycles']
+        self.nbytes += 4
+        super().expect_reg(addr, expected)
+
+    def write_data(self, addr, size, data):
+        # Bitstreams for the FR controllers are moved to "config" once
+        # we see them used, in fast_reconfigure().
+        self.phase = "load"
+        self.last_write[addr] = len(self.entries)
+        self.now += self.dma_cycles(size)
+        self.nbytes += size
+        super().write_data(addr, size, data)
+
+    def read_data(self, addr, size, expected=None):
+        # READ_DATA.compile prints every word it reads back
+        self.phase = "drain"
+        self.now += self.dma_cycles(size)
+        self.now += (size + 7) // 8 * 17 * self.params['print_char_cycles']
+        self.nbytes += size
+        super().read_data(addr, size, expected)
+
+    def fast_reconfigure(self):
+        words = [fr.size for fr in self.fr if fr.size]
+        for fr in self.fr:
+            if fr.size and fr.addr in self.last_write:
+                self.entries[self.last_write.pop(fr.addr)][1] = "config"
+        self.nbytes += 8 * sum(words)
+        self.event_time = self.now + max(words, default=0) * self.params['config_word_cycles']
+        super().fast_reconfigure()
+
+    def finish(self):
+        # Runs back to back with the previous one if it was queued up
+        # with CGRA_AUTO_RESTART before that one finished.
+        sizes = [io.size for io in self.io if io.mode]
+        self.nbytes += 2 * sum(sizes)
+        start = max(self.now, self.cgra_free)
+        self.cgra_free = start + self.params['run_overhead_cycles'] + max(sizes, default=0) * self.params['io_word_cycles']
+        self.event_time = self.cgra_free
+        super().finish()
+
+    def interrupt(self, bit):
+        count = self.events.get(bit, 0)
+        super().interrupt(bit)
+        if self.events.get(bit, 0) > count:
+            self.signals.setdefault(bit, deque()).append(self.event_time)
+
+    def wait(self, mask, sem_id):
+        self.phase = "compute" if mask & CGRA_DONE_MASK else "config"
+        times = [
+            self.signals[bit].popleft()
+            for bit in (1 << k for k in range(mask.bit_length()) if mask >> k & 1)
+            if self.signals.get(bit)
+        ]
+        if times:
+            self.now = max(self.now, *times) + self.params['irq_cycles']
+        super().wait(mask, sem_id)
+
+    def print(self, string):
+        self.now += (len(string) + 1) * self.params['print_char_cycles']
+        super().print(string)
+
+    def stall(self, cycles):
+        self.now += cycles
+
+    def summary(self):
+        phases = {phase: {'commands': 0, 'cycles': 0, 'bytes': 0} for phase in PHASES}
+        for command, phase, cycles, nbytes in self.entries:
+            phases[phase]['commands'] += 1
+            phases[phase]['cycles'] += cycles
+            phases[phase]['bytes'] += nbytes
+
+        return {
+            'params': self.params,
+            'total': {
+                'commands': len(self.entries),
+                'cycles': self.now,
+                'bytes': self.nbytes,
+                'runs': self.num_runs,
+            },
+            'phases': phases,
+            'errors': len(self.errors),
+        }
+
+    def table(self):
+        summary = self.summary()
+        total = summary['total']
+        lines = [f"{'phase':<10}{'commands':>10}{'cycles':>14}{'%':>7}{'bytes':>14}{'B/cycle':>10}"]
+        for phase, row in summary['phases'].items():
+            share = 100 * row['cycles'] / max(total['cycles'], 1)
+            bandwidth = row['bytes'] / max(row['cycles'], 1)
+            lines.append(f"{phase:<10}{row['commands']:>10}{row['cycles']:>14}{share:>7.1f}{row['bytes']:>14}{bandwidth:>10.2f}")
+        lines.append(f"{'total':<10}{total['commands']:>10}{total['cycles']:>14}{100:>7.1f}{total['bytes']:>14}"
+                     f"{total['bytes'] / max(total['cycles'], 1):>10.2f}")
+        return "\n".join(lines)
+
+    def json(self, per_command=False):
+        summary = self.summary()
+        if per_command:
+            summary['commands'] = [
+                {'command': f"{command}", 'phase': phase, 'cycles': cycles, 'bytes': nbytes}
+                for command, phase, cycles, nbytes in self.entries
+            ]
+        return json.dumps(summary, indent=2)
+
+
+def estimate(commands, width=32, **params):
+    return CostModel(width, **params).run(commands)
@@ -0,0 +1,395 @@
+# Functional model of the host-visible side of the CGRA: the global
+# controller, IO and FR controllers, and the global buffer. Runs a
+# command list from applications.py in Python, checks that it is
+# consistent, and records what each IO controller would stream.
+#
+#   model = create_model(app.commands(), width=32)
+#   print(model.report())
+#
+# The CGRA itself isn't modeled. Runs finish as soon as they start
+# (and aren't stalled), and output streams are only filled in if a
+# `compute` function is given that maps the input streams of a run to
+# its outputs.
+
+from collections import namedtuple
+import logging
+import numpy as np
+from commands import *
+
+
+GB_SIZE = GB_BANKS * GB_BANK_SIZE
+
+GLOBAL_REGS = {
+    TEST_REG: "TEST",
+    GLOBAL_RESET_REG: "GLOBAL_RESET",
+    STALL_REG: "STALL",
+    RD_DELAY_REG: "RD_DELAY",
+    SOFT_RESET_DELAY_REG: "SOFT_RESET_DELAY",
+    CGRA_START_REG: "CGRA_START",
+    CGRA_AUTO_RESTART_REG: "CGRA_AUTO_RESTART",
+    CONFIG_START_REG: "CONFIG_START",
+    INTERRUPT_ENABLE_REG: "INTERRUPT_ENABLE",
+    INTERRUPT_STATUS_REG: "INTERRUPT_STATUS",
+    CGRA_SOFT_RESET_EN_REG: "CGRA_SOFT_RESET_EN",
+    CGRA_CONFIG_ADDR_REG: "CGRA_CONFIG_ADDR",
+    CGRA_CONFIG_DATA_REG: "CGRA_CONFIG_DATA",
+}
+
+# Register index within a controller, as in IO_*_REG(n) and FR_*_REG(n)
+IO_REGS = ["mode", "addr", "size", "switch", "done_delay", "done_gate",
+           "num_active", "num_inactive", "auto_restart"]
+FR_REGS = ["addr", "size", "switch"]
+
+
+# One IO controller stream of one run of the CGRA. `data` is the 16-bit
+# words streamed, or None for an output that nothing computed.
+Stream = namedtuple("Stream", ["run", "io_ctrl", "mode", "addr", "size", "data"])
+
+
+class ModelError(Exception):
+    pass
+
+
+class Controller:
+    def __init__(self, regs):
+        self.regs = dict.fromkeys(regs, 0)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["regs"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class Model:
+    """Executes commands against the register map in commands.py.
+
+    Problems are collected in `errors` rather than raised, so a single
+    run reports everything wrong with a schedule. Pass `strict=True` to
+    raise a ModelError on the first one instead.
+    """
+
+    def __init__(self, width=32, compute=None, strict=False):
+        self.width = width
+        self.num_controllers = width // 4
+        self.banks_per_controller = GB_BANKS // self.num_controllers
+        self.compute = compute
+        self.strict = strict
+
+        self.gb = np.zeros(GB_SIZE, dtype=np.uint8)
+        # Bytes of the global buffer that something has written
+        self.valid = np.zeros(GB_SIZE, dtype=bool)
+
+        self.errors = []
+        self.prints = []
+        self.streams = []
+        self.produced = set()
+        self.reads = []
+        self.num_runs = 0
+        self.num_commands = 0
+
+        # Firmware state, which survives a GLOBAL_RESET: how many
+        # times each INTERRUPT_STATUS bit was dispatched and not yet
+        # waited on, and what each PEND said it was waiting for.
+        self.events = {}
+        self.pending = {}
+
+        self.command = None
+        self.reset()
+
+    def reset(self):
+        self.regs = dict.fromkeys(GLOBAL_REGS, 0)
+        self.io = [Controller(IO_REGS) for _ in range(self.num_controllers)]
+        self.fr = [Controller(FR_REGS) for _ in range(self.num_controllers)]
+        self.config = {}
+        self.config_addr = None
+        self.running = False
+
+    def error(self, message):
+        message = f"{self.command}: {message}" if self.command is not None else message
+        if self.strict:
+            raise ModelError(message)
+        logging.error(message)
+        self.errors.append(message)
+
+    def run(self, commands):
+        for command in commands:
+            self.emulate(command)
+        if self.running:
+            self.error("CGRA is still running at the end of the schedule.")
+        for bit, count in self.events.items():
+            if count:
+                logging.warning(f"Interrupt 0b{bit:02b} was signaled {count} more times than it was waited on.")
+        return self
+
+    def emulate(self, command):
+        self.command = command
+        self.num_commands += 1
+        command.emulate(self)
+
+    # Global buffer
+
+    def check_gb(self, addr, nbytes, what):
+        if addr < 0 or addr + nbytes > GB_SIZE:
+            self.error(f"{what} [0x{addr:x}, 0x{addr + nbytes:x}) is outside of the global buffer.")
+            return False
+        return True
+
+    def write_data(self, addr, size, data):
+        data = np.ascontiguousarray(data).view(np.uint8).ravel()
+        if size != len(data):
+            self.error(f"WRITE_DATA of {size} bytes has a {len(data)} byte payload.")
+        if addr % 8 or size % 8:
+            self.error(f"WRITE_DATA to 0x{addr:x} of {size} bytes isn't 64-bit aligned.")
+        if self.check_gb(addr, size, "WRITE_DATA"):
+            n = min(size, len(data))
+            self.gb[addr:addr + n] = data[:n]
+            self.valid[addr:addr + n] = True
+
+    def read_data(self, addr, size, expected=None):
+        if not self.check_gb(addr, size, "READ_DATA"):
+            return
+        if not self.valid[addr:addr + size].all():
+            self.error(f"READ_DATA of [0x{addr:x}, 0x{addr + size:x}) reads bytes nothing wrote.")
+        data = self.gb[addr:addr + size].copy()
+        self.reads.append((addr, data))
+
+        if self.compute is not None and expected is not None:
+            expected = np.ascontiguousarray(expected).view(np.uint8).ravel()
+            mismatches = np.flatnonzero(data[:len(expected)] != expected[:size])
+            if len(mismatches):
+                self.error(f"READ_DATA of 0x{addr:x} has {len(mismatches)} bytes that don't match, first at offset {mismatches[0]}.")
+
+    # Registers
+
+    def decode_reg(self, addr):
+        """Returns (controllers, n, register name) for a register
+        address, or None if it isn't one."""
+        if addr & 0b11 or not 0 <= addr < 1 << 12:
+            return None
+        kind, n, r = addr >> 10, (addr >> 6) & 0b1111, (addr >> 2) & 0b1111
+        if kind == 0b00 and addr in GLOBAL_REGS:
+            return None, None, GLOBAL_REGS[addr]
+        if kind == 0b01 and n < self.num_controllers and r < len(IO_REGS):
+            return self.io, n, IO_REGS[r]
+        if kind == 0b10 and n < self.num_controllers and r < len(FR_REGS):
+            return self.fr, n, FR_REGS[r]
+        return None
+
+    def read_reg(self, addr):
+        reg = self.decode_reg(addr)
+        if reg is None:
+            self.error(f"0x{addr:x} isn't a register.")
+            return 0
+        controllers, n, name = reg
+        if controllers is None:
+            return self.regs[addr]
+        return controllers[n].regs[name]
+
+    def expect_reg(self, addr, expected):
+        value = self.read_reg(addr)
+        if value != expected:
+            self.error(f"Expected 0x{expected:x} at 0x{addr:x} but the model has 0x{value:x}.")
+
+    def write_reg(self, addr, data):
+        reg = self.decode_reg(addr)
+        if reg is None:
+            self.error(f"0x{addr:x} isn't a register.")
+            return
+        if not 0 <= data < 1 << 32:
+            self.error(f"0x{data:x} doesn't fit in a 32-bit register.")
+        controllers, n, name = reg
+
+        if controllers is not None:
+            if name == "mode" and data not in (0, IO_INPUT_STREAM, IO_OUTPUT_STREAM):
+                self.error(f"Unknown IO mode {data} for IO controller {n}.")
+            controllers[n].regs[name] = data
+            return
+
+        if addr == GLOBAL_RESET_REG:
+            self.reset()
+        elif addr == INTERRUPT_STATUS_REG:
+            # Write 1 to clear
+            self.regs[addr] &= ~data
+        elif addr == CGRA_CONFIG_ADDR_REG:
+            self.config_addr = data
+        elif addr == CGRA_CONFIG_DATA_REG:
+            if self.config_addr is None:
+                self.error("CGRA_CONFIG_DATA written without an address.")
+            self.config[self.config_addr] = data
+            self.config_addr = None
+        elif addr == CONFIG_START_REG:
+            if data:
+                self.fast_reconfigure()
+        elif addr in (CGRA_START_REG, CGRA_AUTO_RESTART_REG):
+            if data:
+                if addr == CGRA_AUTO_RESTART_REG and self.num_runs == 0:
+                    self.error("CGRA_AUTO_RESTART before the CGRA was ever started.")
+                self.start()
+        else:
+            self.regs[addr] = data
+            if addr == STALL_REG and data == 0 and self.running:
+                self.finish()
+
+    # Controllers
+
+    def reachable_banks(self, n, switch):
+        # Each switch bit hands controller n one more bank of its own
+        # group. The last bit also chains on to every bank after the
+        # group, which is how one controller reaches all 32 banks.
+        first = n * self.banks_per_controller
+        banks = {first + k for k in range(switch.bit_length()) if switch >> k & 1}
+        if switch >> 3 & 1:
+            banks |= set(range(first + 3, GB_BANKS))
+        return banks
+
+    def check_banks(self, what, n, switch, addr, nbytes):
+        if switch == 0:
+            self.error(f"{what} {n} is used with a switch of 0.")
+            return False
+        banks = set(range(addr // GB_BANK_SIZE, (addr + max(nbytes, 1) - 1) // GB_BANK_SIZE + 1))
+        missing = banks - self.reachable_banks(n, switch)
+        if missing:
+            self.error(f"{what} {n} with switch 0b{switch:04b} can't reach bank(s) {sorted(missing)}.")
+            return False
+        return True
+
+    def fast_reconfigure(self):
+        used = False
+        for n, fr in enumerate(self.fr):
+            if fr.size == 0:
+                continue
+            used = True
+            nbytes = 8 * fr.size
+            if fr.addr % 8:
+                self.error(f"FR controller {n} address 0x{fr.addr:x} isn't 64-bit aligned.")
+                continue
+            if not self.check_gb(fr.addr, nbytes, f"FR controller {n} bitstream"):
+                continue
+            if not self.check_banks("FR controller", n, fr.switch, fr.addr, nbytes):
+                continue
+            if not self.valid[fr.addr:fr.addr + nbytes].all():
+                self.error(f"FR controller {n} reads bytes nothing wrote.")
+
+            # Config words are stored as 64-bit {addr, data}
+            words = self.gb[fr.addr:fr.addr + nbytes].view(np.uint32).reshape(-1, 2)
+            self.config.update(zip(words[:, 1].tolist(), words[:, 0].tolist()))
+
+        if not used:
+            self.error("CONFIG_START without any FR controller set up.")
+        self.interrupt(CONFIG_DONE_MASK)
+
+    def start(self):
+        if not self.config:
+            self.error("CGRA started before it was configured.")
+        if self.running:
+            self.error("CGRA started while it was still running.")
+        self.running = True
+        if self.regs[STALL_REG] == 0:
+            self.finish()
+
+    def finish(self):
+        run = self.num_runs
+        self.num_runs += 1
+        self.running = False
+
+        inputs = {}
+        outputs = {}
+        for n, io in enumerate(self.io):
+            if io.mode == 0:
+                continue
+            nbytes = 2 * io.size
+            if io.size == 0:
+                self.error(f"IO controller {n} is set up with a size of 0.")
+                continue
+            if io.addr % 2:
+                self.error(f"IO controller {n} address 0x{io.addr:x} isn't 16-bit aligned.")
+                continue
+            if not self.check_gb(io.addr, nbytes, f"IO controller {n} stream"):
+                continue
+            if not self.check_banks("IO controller", n, io.switch, io.addr, nbytes):
+                continue
+
+            if io.mode == IO_INPUT_STREAM:
+                if not self.valid[io.addr:io.addr + nbytes].all():
+                    self.error(f"IO controller {n} streams [0x{io.addr:x}, 0x{io.addr + nbytes:x}) which nothing wrote.")
+                inputs[n] = self.gb[io.addr:io.addr + nbytes].view(np.uint16).copy()
+            else:
+                outputs[n] = None
+
+        if not inputs and not outputs:
+            self.error("CGRA ran without any IO controllers set up.")
+
+        if self.compute is not None and outputs:
+            results = self.compute(inputs)
+            for n in outputs:
+                if n not in results:
+                    self.error(f"compute didn't produce an output for IO controller {n}.")
+                    continue
+                data = np.asarray(results[n], dtype=np.uint16)
+                if len(data) != self.io[n].size:
+                    self.error(f"IO controller {n} expects {self.io[n].size} words but compute produced {len(data)}.")
+                    data = data[:self.io[n].size]
+                addr = self.io[n].addr
+                self.gb[addr:addr + data.nbytes] = data.view(np.uint8)
+                outputs[n] = data
+
+        for n in outputs:
+            # Even without compute, the output region counts as written
+            region = self.io[n].addr, 2 * self.io[n].size
+            if region not in self.produced:
+                self.produced.add(region)
+                self.valid[region[0]:sum(region)] = True
+
+        for n, data in {**inputs, **outputs}.items():
+            io = self.io[n]
+            self.streams.append(Stream(run, n, io.mode, io.addr, io.size, data))
+
+        self.interrupt(CGRA_DONE_MASK)
+
+    # Interrupts and firmware
+
+    def interrupt(self, bit):
+        self.regs[INTERRUPT_STATUS_REG] |= bit
+        if not self.regs[INTERRUPT_ENABLE_REG] & bit:
+            return
+        # cgra_dispatch clears the bit and counts it
+        self.regs[INTERRUPT_STATUS_REG] &= ~bit
+        self.events[bit] = self.events.get(bit, 0) + 1
+
+    def pend(self, mask, sem_id):
+        self.pending[sem_id] = mask
+
+    def wait(self, mask, sem_id):
+        if not self.regs[INTERRUPT_ENABLE_REG] & mask:
+            self.error(f"Waiting on 0b{mask:02b} with INTERRUPT_ENABLE 0b{self.regs[INTERRUPT_ENABLE_REG]:02b}.")
+        if self.pending.get(sem_id, mask) != mask:
+            self.error(f"{sem_id} was pended on 0b{self.pending[sem_id]:02b}, not 0b{mask:02b}.")
+        bits = [1 << k for k in range(mask.bit_length()) if mask >> k & 1]
+        missing = [bit for bit in bits if not self.events.get(bit)]
+        if missing:
+            self.error(f"Waiting on 0b{missing[0]:02b} would never return.")
+            return
+        for bit in bits:
+            self.events[bit] -= 1
+
+    def print(self, string):
+        self.prints.append(string)
+
+    def stall(self, cycles):
+        pass
+
+    def report(self):
+        lines = [f"{self.num_commands} commands, {self.num_runs} runs, {len(self.config)} config words, {len(self.errors)} errors"]
+        for n in range(self.num_controllers):
+            streams = [s for s in self.streams if s.io_ctrl == n]
+            if streams:
+                mode = {IO_INPUT_STREAM: "in", IO_OUTPUT_STREAM: "out"}[streams[0].mode]
+                words = sum(s.size for s in streams)
+                lines.append(f"    IO controller {n} ({mode}): {len(streams)} streams, {words} words")
+        lines += [f"    ERROR: {error}" for error in self.errors]
+        return "\n".join(lines)
+
+
+def create_model(commands, width=32, compute=None, strict=False):
+    return Model(width, compute, strict).run(commands)
@@ -0,0 +1,109 @@
+# Reads back the cycle counts that firmware built with
+# create_straightline_code(..., profile="command") or profile="phase"
+# dumps over the UART at the end of the test.
+#
+#   with open("uart.log") as f:
+#       profile = parse_profile(f.read(), app.commands(), "command", optimize=True)
+#   print(profile.table())
+#   with open("app.folded", "w") as f:
+#       f.write(profile.folded())  # for flamegraph.pl
+#
+# The marks are numbered the same way on both sides by
+# profile_points(), so the parser needs the schedule the firmware was
+# built from, along with the same `optimize` and `batch` options.
+
+from collections import OrderedDict
+import json
+import re
+from commands import *
+
+
+PROFILE_BEGIN = re.compile(r"PROFILE_BEGIN (\d+) (\d+)")
+PROFILE_ENTRY = re.compile(r"PROFILE (\d+) (\d+)")
+
+
+class ProfileError(Exception):
+    pass
+
+
+class Profile:
+    """Cycles spent between consecutive marks, per mark."""
+
+    def __init__(self, points, marks, dropped=0):
+        self.points = points
+        self.dropped = dropped
+
+        # DWT_CYCCNT is 32 bits and wraps around
+        self.samples = {mark: [] for mark, _, _ in points}
+        for (mark, start), (_, end) in zip(marks, marks[1:]):
+            self.samples[mark].append((end - start) % 2**32)
+        self.total = sum(map(sum, self.samples.values()))
+
+    def rows(self):
+        for mark, _, label in self.points:
+            samples = self.samples[mark]
+            if samples:
+                yield mark, label, samples
+
+    def phases(self):
+        # Every command is charged to the last PRINT before it
+        phases = OrderedDict()
+        phase = "start"
+        for mark, label, samples in self.rows():
+            if label.startswith("PRINT"):
+                phase = label[len("PRINT "):].strip('"')
+            phases.setdefault(phase, []).append((label, sum(samples)))
+        return phases
+
+    def table(self):
+        lines = [f"{'mark':>6}{'count':>8}{'cycles':>14}{'mean':>12}{'min':>10}{'max':>10}{'%':>7}  command"]
+        for mark, label, samples in self.rows():
+            share = 100 * sum(samples) / max(self.total, 1)
+            lines.append(
+                f"{mark:>6}{len(samples):>8}{sum(samples):>14}{sum(samples) // len(samples):>12}"
+                f"{min(samples):>10}{max(samples):>10}{share:>7.1f}  {label}"
+            )
+        lines.append(f"{'total':>6}{'':>8}{self.total:>14}")
+        if self.dropped:
+            lines.append(f"({self.dropped} earlier marks were overwritten in the ring buffer)")
+        return "\n".join(lines)
+
+    def folded(self):
+        """Collapsed stacks, one `phase;command cycles` line each, as
+        taken by flamegraph.pl and speedscope."""
+        lines = []
+        for phase, entries in self.phases().items():
+            for label, cycles in entries:
+                frames = [phase] if label.startswith("PRINT") else [phase, label]
+                lines.append(f"{';'.join(frame.replace(';', ',') for frame in frames)} {cycles}")
+        return "\n".join(lines) + "\n"
+
+    def json(self):
+        return json.dumps({
+            'total': self.total,
+            'dropped': self.dropped,
+            'commands': [
+                {'mark': mark, 'command': label, 'count': len(samples), 'cycles': sum(samples)}
+                for mark, label, samples in self.rows()
+            ],
+            'phases': {phase: sum(cycles for _, cycles in entries) for phase, entries in self.phases().items()},
+        }, indent=2)
+
+
+def parse_profile(log, commands, profile="command", optimize=False, batch=False):
+    points = profile_points(list(lower_commands(commands, optimize=optimize, batch=batch)), profile)
+
+    begin = PROFILE_BEGIN.search(log)
+    if begin is None:
+        raise ProfileError("No PROFILE_BEGIN in the log, was the firmware built with profile=...?")
+    count, first = map(int, begin.groups())
+
+    end = log.find("PROFILE_END", begin.end())
+    marks = [tuple(map(int, m.groups())) for m in PROFILE_ENTRY.finditer(log, begin.end(), end if end >= 0 else len(log))]
+    if len(marks) != count - first:
+        raise ProfileError(f"Expected {count - first} profile entries, found {len(marks)}.")
+    unknown = {mark for mark, _ in marks} - {mark for mark, _, _ in points}
+    if unknown:
+        raise ProfileError(f"Profile marks {sorted(unknown)} aren't in this schedule.")
+
+    return Profile(points, marks, dropped=first)
@@ -22,6 +22,8 @@ parser.add_argument("--app-root", type=str, default="apps",
 parser.add_argument("--power", action="store_true",
                     help="Use this flag if you are using this flow for generating power numbers")
 parser.add_argument("--garnet-flow", action="store_true")
+parser.add_argument("--no-canonicalize", action="store_true",
+                    help="Keep the bitstreams exactly as Garnet wrote them")
 
 # Logging
 parser.add_argument('-v', '--verbose',
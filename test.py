@@ -12,6 +12,7 @@ from pathlib import Path
 import textwrap
 import logging
 
+from allocator import GlobalBufferAllocator
 from commands import *
 
 parser = argparse.ArgumentParser(description="""
@@ -153,6 +154,9 @@ with open(f"{args.app}/bin/global_buffer.json", "r") as f:
         inst = instances[i['instance']]
         _in = process_inst(inst)
         _in['location'] = i['location']
+        # Striped streams list every IO controller they run on
+        _in['stripe'] = [int(location) for location in i.get('stripe', [i['location']])]
+        _in['layout'] = i.get('layout', "striped" if len(_in['stripe']) > 1 else "contiguous")
 
         if i.get('num_active'):
             num_active = i['num_active']
@@ -182,6 +186,8 @@ with open(f"{args.app}/bin/global_buffer.json", "r") as f:
         inst = instances[o['instance']]
         _out = process_inst(inst)
         _out['location'] = o['location']
+        _out['stripe'] = [int(location) for location in o.get('stripe', [o['location']])]
+        _out['layout'] = o.get('layout', "striped" if len(_out['stripe']) > 1 else "contiguous")
         _out['kind'] = 'output'
 
         # TODO this is metadata for testing... not sure where to put it...
@@ -192,14 +198,14 @@ with open(f"{args.app}/bin/global_buffer.json", "r") as f:
         outputs.append(_out)
 
     def allocate_gb(inputs, outputs):
-        bank = 0
-        for _in in inputs:
-            _in['addr'] = BANK_ADDR(bank)
-            bank += 4
-
-        for _out in outputs:
-            _out['addr'] = BANK_ADDR(bank)
-            bank += 4
+        # Every stream is live for the whole test, and is placed in the
+        # banks of the IO controller at its location, laid out the way
+        # its "layout" asks (see commands.GB_LAYOUTS).
+        gb = GlobalBufferAllocator(width=args.width)
+        for stream in inputs + outputs:
+            stream['layout'] = gb.allocate_layout(stream['name'], stream['nbytes'], stream['layout'], stream['stripe'])
+            stream['addr'] = stream['layout'].addrs[0]
+            stream['mask'] = stream['layout'].masks[0]
 
     allocate_gb(inputs, outputs)
 
@@ -451,6 +457,12 @@ with open(f"{args.app}/bin/global_buffer.json", "r") as f:
         tb.body += parse_ast("\n".join(f"cocotb.fork(monitor_{name}())" for name in monitors)).body
 
 
+    # Parse the bitstream now so the testbench only has to map the
+    # cached copy when it runs.
+    bitstream_file = f"{cwd}/{args.app}/bin/{app_name}.bs"
+    if os.path.exists(bitstream_file):
+        load_bitstream(bitstream_file)
+
     tb.body += parse_ast(f"""
     # reset
     dut.reset = 1
@@ -465,8 +477,9 @@ with open(f"{args.app}/bin/global_buffer.json", "r") as f:
     yield gc.write(INTERRUPT_ENABLE_REG, 0b11)
 
     dut._log.info("Configuring CGRA...")
-    for command in gc_config_bitstream("{cwd}/{args.app}/bin/{app_name}.bs"):
-        yield gc.write(command.addr, command.data)
+    for addr, data in load_bitstream("{bitstream_file}"):
+        yield gc.write(CGRA_CONFIG_ADDR_REG, int(addr))
+        yield gc.write(CGRA_CONFIG_DATA_REG, int(data))
     dut._log.info("Done.")
     """).body
 
@@ -507,12 +520,24 @@ with open(f"{args.app}/bin/global_buffer.json", "r") as f:
             curr_body = context[-1]
             del curr_body[0]
 
-        if _in['double_buffered']:
+        if _in['layout'].kind != "contiguous":
+            assert len(_in['dims']) == 1, "ERROR: Only linear streams can be striped or interleaved."
+            curr_body.append(parse_ast(f"""
+            for command in configure_io(mode=IO_INPUT_STREAM,
+                         addr={_in['layout']!r},
+                         size={_in['dims'][0][0]},
+                         num_active={_in['num_active']},
+                         num_inactive={_in['num_inactive']},
+                         width=32):
+                yield gc.write(command.addr, command.data)
+            """).body[0])
+        elif _in['double_buffered']:
             curr_body.append(parse_ast(f"""
             for command in configure_io(mode=IO_INPUT_STREAM,
                          addr={" + ".join(idxs)},
                          size={_in['dims'][0][0]},
                          io_ctrl={_in['location']},
+                         mask={_in['mask']},
                          num_active={_in['num_active']},
                          num_inactive=0,
                          width=32):
@@ -524,6 +549,7 @@ with open(f"{args.app}/bin/global_buffer.json", "r") as f:
                          addr={" + ".join(idxs)},
                          size={_in['dims'][0][0]},
                          io_ctrl={_in['location']},
+                         mask={_in['mask']},
                          num_active={_in['num_active']},
                          num_inactive={_in['num_inactive']},
                          width=32):
@@ -550,6 +576,7 @@ with open(f"{args.app}/bin/global_buffer.json", "r") as f:
                              addr={" + ".join(idxs)},
                              size={_in['dims'][0][0]},
                              io_ctrl={_in['location']},
+                             mask={_in['mask']},
                              num_active={_in['num_active']},
                              num_inactive={_in['num_inactive']},
                              width=32):
@@ -584,14 +611,25 @@ with open(f"{args.app}/bin/global_buffer.json", "r") as f:
             attr='coroutine',
         ))
 
-        temp.body.append(parse_ast(f"""
-        for command in configure_io(mode=IO_OUTPUT_STREAM,
-                     addr={_out['addr']},
-                     size={_out['dims'][0][0]},
-                     io_ctrl={_out['location']},
-                     width=32):
-            yield gc.write(command.addr, command.data)
-        """).body[0])
+        if _out['layout'].kind != "contiguous":
+            assert len(_out['dims']) == 1, "ERROR: Only linear streams can be striped or interleaved."
+            temp.body.append(parse_ast(f"""
+            for command in configure_io(mode=IO_OUTPUT_STREAM,
+                         addr={_out['layout']!r},
+                         size={_out['dims'][0][0]},
+                         width=32):
+                yield gc.write(command.addr, command.data)
+            """).body[0])
+        else:
+            temp.body.append(parse_ast(f"""
+            for command in configure_io(mode=IO_OUTPUT_STREAM,
+                         addr={_out['addr']},
+                         size={_out['dims'][0][0]},
+                         io_ctrl={_out['location']},
+                         mask={_out['mask']},
+                         width=32):
+                yield gc.write(command.addr, command.data)
+            """).body[0])
 
         temp.body.append(parse_ast(f"""
         init_done[{_out['location']}].set()
@@ -606,6 +644,23 @@ with open(f"{args.app}/bin/global_buffer.json", "r") as f:
 
     num_streams = len(inputs) + len(outputs)
     for _in in inputs:
+        if _in['layout'].kind != "contiguous":
+            # The layout knows which piece of the data goes where
+            tb.body += parse_ast(f"""
+            {_in['name']}_data = np.fromfile("{cwd}/{args.app}/{_in['file']}", dtype=np.uint8).astype(np.uint16)
+            dut._log.info("Transferring {_in['name']} data...")
+            tasks = []
+            for addr, part in {_in['layout']!r}.parts({_in['name']}_data):
+                for k,x in enumerate(part.view(np.uint64)):
+                    tasks.append(cocotb.fork(gb.write(addr + 8*k, int(x))))
+            for task in tasks:
+                yield task.join()
+            dut._log.info("Done.")
+
+            """).body
+            tb.body.append(process_input(_in))
+            continue
+
         tb.body += parse_ast(f"""
         {_in['name']}_data = np.fromfile("{cwd}/{args.app}/{_in['file']}", dtype=np.uint8).astype(np.uint16)
         # TODO: this should probably use WRITE_DATA instead and use the byte enables
@@ -5,6 +5,7 @@ import os
 from pathlib import Path
 import re
 import subprocess
+from bitstream import canonicalize_file
 from util.apps import gather_apps
 
 cgra_utilization = re.compile(r"PE: (?P<PE>\d+) IO: (?P<IO>\d+) MEM: (?P<MEM>\d+) REG: (?P<REG>\d+)")
@@ -27,6 +28,19 @@ def should_run_app(entry, args):
     return True
 
 
+def canonicalize_app_bitstream(entry):
+    name = entry.parts[-1]
+    bitstream = entry/"bin"/f"{name}.bs"
+    if not bitstream.exists():
+        return
+
+    stats = canonicalize_file(bitstream)
+    logging.info(
+        f"Canonicalized `{bitstream}`: {stats['words']} -> {stats['kept']} words "
+        f"({stats['shadowed']} shadowed) over {stats['tiles']} tiles."
+    )
+
+
 def generate_bitstreams(args):
     if args.garnet_flow:
         raise NotImplementedError("This probably isn't correct.")
@@ -111,6 +125,11 @@ def generate_bitstreams(args):
                             d["name"] = name
                             w.writerow(d)
 
+                # Dedupe and tile-order every bitstream, including ones
+                # that were already up to date.
+                if not args.no_canonicalize:
+                    canonicalize_app_bitstream(entry)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -120,6 +139,8 @@ if __name__ == "__main__":
     parser.add_argument("--force", action="store_true")
     parser.add_argument("--app-root", type=str, default="apps")
     parser.add_argument("--garnet-flow", action="store_true")
+    parser.add_argument("--no-canonicalize", action="store_true",
+                        help="Keep the bitstreams exactly as Garnet wrote them")
     args = parser.parse_args()
     args.apps = list(map(Path, args.apps))
     args.apps = list(map(lambda x: Path(args.app_root) / x, args.apps))